@@ -1,14 +1,18 @@
 import argparse
 import logging
 import json
+import multiprocessing
 import os
-import tempfile
 import sys
 import re
 
 import flywheel
 
-from .supporting_files import bidsify_flywheel, utils, templates
+from .supporting_files import bidsify_flywheel, resolver, utils, templates, update_dispatcher
+from .supporting_files.template_cache import get_default_cache
+from .supporting_files.watermarks import CurationWatermarks, template_signature
+from .supporting_files.errors import BIDSCurationError
+from .supporting_files import project_tree
 from .supporting_files.project_tree import get_project_tree
 
 PROJECT_TEMPLATE_FILE_NAME_REGEX = re.compile('^([a-z0-9]+\-)*project-template\.json$')
@@ -16,6 +20,9 @@ PROJECT_TEMPLATE_FILE_NAME_REGEX = re.compile('^([a-z0-9]+\-)*project-template\.
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('curate-bids')
 
+# Log parallel curation progress every this many sessions
+SESSION_PROGRESS_INTERVAL = 100
+
 def clear_meta_info(context, template):
     if 'info' in context and template.namespace in context['info']:
         del context['info'][template.namespace]
@@ -79,49 +86,20 @@ def validate_meta_info(container, template):
         container['info'][namespace]['valid'] = valid
         container['info'][namespace]['error_message'] = error_message
 
-def update_meta_info(fw, context):
+def update_meta_info(fw, context, replace=False):
     """ Update file information
 
-    """
-    # Modify file
-    if context['container_type'] == 'file':
-        # Modify acquisition file
-        if context['parent_container_type'] == 'acquisition':
-            fw.set_acquisition_file_info(
-                    context['acquisition']['id'],
-                    context['file']['name'],
-                    context['file']['info']
-                    )
-        # Modify project file
-        elif context['parent_container_type'] == 'project':
-            fw.set_project_file_info(
-                    context['project']['id'],
-                    context['file']['name'],
-                    context['file']['info']
-                    )
-        # Modify session file
-        elif context['parent_container_type'] == 'session':
-            fw.set_session_file_info(
-                    context['session']['id'],
-                    context['file']['name'],
-                    context['file']['info']
-                    )
-        else:
-            logger.info('Cannot determine file parent container type: ' + context['parent_container_type'])
-    # Modify project
-    elif context['container_type'] == 'project':
-        fw.replace_project_info(context['project']['id'], context['project']['info'])
-    # Modify session
-    elif context['container_type'] == 'session':
-        fw.replace_session_info(context['session']['id'], context['session']['info'])
-    # Modify acquisition
-    elif context['container_type'] == 'acquisition':
-        fw.replace_acquisition_info(context['acquisition']['id'], context['acquisition']['info'])
-    # Cannot determine container type
-    else:
-        logger.info('Cannot determine container type: ' + context['container_type'])
+    Only the changed info keys are sent, unless replace is set
 
-def curate_bids_dir(fw, project_id, session_id=None, reset=False, template_file=None, session_only=False):
+    """
+    update = update_dispatcher.get_update(context, replace=replace)
+    if update is not None:
+        container, target, method, args = update
+        getattr(fw, method)(*args)
+
+def curate_bids_dir(fw, project_id, session_id=None, reset=False, template_file=None, session_only=False,
+        max_workers=update_dispatcher.DEFAULT_MAX_WORKERS, processes=None, incremental=False,
+        snapshot_file=None):
     """
 
     fw: Flywheel client
@@ -130,12 +108,166 @@ def curate_bids_dir(fw, project_id, session_id=None, reset=False, template_file=
     reset: Whether or not to reset bids info before curation
     template_file: The template file to use
     session_only: If true, then only curate the provided session
+    max_workers: Number of containers to update concurrently
+    processes: Number of processes to curate sessions in, or None to curate serially
+    incremental: If true, only curate sessions that changed since they were last curated
+    snapshot_file: Optional file to save a snapshot of the project tree to, before curation
 
     """
     project = get_project_tree(fw, project_id, session_id=session_id, session_only=session_only)
-    curate_bids_tree(fw, project, reset, template_file, True)
+    if snapshot_file:
+        project_tree.save_snapshot(project, snapshot_file)
+        logger.info('Saved project tree snapshot to {0}'.format(snapshot_file))
+    curate_bids_tree(fw, project, reset, template_file, True, max_workers=max_workers,
+            processes=processes, incremental=incremental)
+
+def match_context(context, template, reset=False):
+    """ Do initial template matching and updating for a single context (pass 1)
+
+    """
+    ctype = context['container_type']
+    parent_ctype = context['parent_container_type']
+
+    if reset:
+        clear_meta_info(context[ctype], template)
+
+    elif context[ctype].get('info',{}).get('BIDS') == 'NA':
+        return
+
+    if ctype == 'project':
+        bidsify_flywheel.process_matching_templates(context, template)
+        # Validate meta information
+        # TODO: Improve the validator to understand what is valid for dataset_description file...
+        # validate_meta_info(context['project'])
+
+    elif ctype == 'session':
+        bidsify_flywheel.process_matching_templates(context, template)
+
+        # Add run_counter
+        context['run_counters'] = utils.RunCounterMap()
+
+    elif ctype == 'acquisition':
+        bidsify_flywheel.process_matching_templates(context, template)
+
+    elif ctype == 'file':
+        if parent_ctype == 'project' and PROJECT_TEMPLATE_FILE_NAME_REGEX.search(context['file']['name']):
+            # Don't BIDSIFY project template
+            return
+
+        # Process matching
+        context['file'] = bidsify_flywheel.process_matching_templates(context, template)
+        # Validate meta information
+        validate_meta_info(context['file'], template)
+
+def curate_node(node, template, reset=False, context=None):
+    """ Match templates and resolve paths for a node and its children (passes 1 and 2)
+
+    node: The tree node to curate
+    template: The template
+    reset: Whether or not to reset bids info before curation
+    context: The context of the parent node, unless node is the project
+
+    """
+    # 1. Do initial template matching and updating
+    for ctx in node.context_iter(dict(context) if context else None):
+        match_context(ctx, template, reset)
+
+    # 2. Perform any path resolutions, sharing one index of the contexts resolved from
+    index = resolver.ResolutionIndex()
+    for ctx in node.context_iter(dict(context) if context else None):
+        # Resolution
+        bidsify_flywheel.process_resolvers(ctx, template, index)
+
+def iter_nodes(node):
+    """ Iterate a tree node and its children, depth-first
+
+    """
+    yield node
+    for child in node.children:
+        for descendant in iter_nodes(child):
+            yield descendant
+
+def is_session_local(template):
+    """ Check if every resolver of the template only looks within a session,
+    so that sessions can be curated independently
+
+    """
+    return all(res.resolve_for in ('session', 'acquisition')
+            for resolvers in template.resolver_map.values() for res in resolvers)
+
+# The template used by a session worker process
+_worker_template = None
+
+def _init_session_worker(template_file):
+    global _worker_template
+    if template_file:
+        _worker_template = templates.loadTemplate(template_file)
+    else:
+        _worker_template = templates.DEFAULT_TEMPLATE
+
+def _curate_session(task):
+    """ Curate a session subtree in a worker process
 
-def curate_bids_tree(fw, project, reset=False, template_file=None, update=True):
+    Returns the resulting info of every node of the session, depth-first
+    """
+    project, session, reset = task
+    context = {'parent_container_type': 'project', 'container_type': 'project', 'project': project}
+    curate_node(session, _worker_template, reset, context)
+    return [(node.type, 'info' in node.data, node.data.get('info')) for node in iter_nodes(session)]
+
+def start_session_pool(processes, template_file=None):
+    """ Start a pool of worker processes for curate_sessions_parallel
+
+    processes: The number of worker processes
+    template_file: The template file workers load, or None for the default template
+
+    """
+    return multiprocessing.Pool(processes, initializer=_init_session_worker, initargs=(template_file,))
+
+def curate_sessions_parallel(project, template, pool, reset=False):
+    """ Match templates and resolve paths for a project, spreading its sessions over a pool
+    of worker processes
+
+    The project node and its files are curated once, up front. Each worker then curates
+    whole sessions, and the resulting info is copied back into the tree, which ends up
+    identical to a serial run: run counters are kept per session, so run numbers don't
+    depend on how sessions are distributed. The pool is closed when done.
+
+    project: The project tree node
+    template: The template, which must match the one the pool was started with
+    pool: The pool, from start_session_pool
+    reset: Whether or not to reset bids info before curation
+
+    """
+    sessions = [child for child in project.children if child.type == 'session']
+
+    try:
+        # Curate the project and its files, without the sessions
+        top = project_tree.TreeNode(project.type, project.data)
+        top.children = [child for child in project.children if child.type != 'session']
+        curate_node(top, template, reset)
+
+        # Workers only need the project data for their contexts
+        top.children = []
+        results = pool.imap(_curate_session, [(top, session, reset) for session in sessions])
+        for i, (session, infos) in enumerate(zip(sessions, results)):
+            for node, (node_type, has_info, info) in zip(iter_nodes(session), infos):
+                if has_info:
+                    node.data['info'] = info
+                else:
+                    node.data.pop('info', None)
+            if (i + 1) % SESSION_PROGRESS_INTERVAL == 0:
+                logger.info('Curated {0}/{1} sessions'.format(i + 1, len(sessions)))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def curate_bids_tree(fw, project, reset=False, template_file=None, update=True,
+        max_workers=update_dispatcher.DEFAULT_MAX_WORKERS, processes=None, incremental=False,
+        template_cache=None):
     # Get project
     project_files = project.get('files', [])
 
@@ -146,16 +278,14 @@ def curate_bids_tree(fw, project, reset=False, template_file=None, update=True):
     if not template_file:
         for f in project_files:
             if PROJECT_TEMPLATE_FILE_NAME_REGEX.search(f['name']):
-                fd, path = tempfile.mkstemp('.json')
-                os.close(fd)
-
                 logger.info('Using project template: {0}'.format(f['name']))
-                fw.download_file_from_project(project['id'], f['name'], path)
-                template_file = path
+                if template_cache is None:
+                    template_cache = get_default_cache()
+                template, template_file = template_cache.load_project_template(fw, project, f)
                 # Don't look for another file that might match
                 break
 
-    if template_file:
+    elif template_file:
         template = templates.loadTemplate(template_file)
 
     ##
@@ -165,55 +295,65 @@ def curate_bids_tree(fw, project, reset=False, template_file=None, update=True):
     # 3. Send updates to server
     ##
 
-    # 1. Do initial template matching and updating
-    for context in project.context_iter():
-        ctype = context['container_type']
-        parent_ctype = context['parent_container_type']
-
-        if reset:
-            clear_meta_info(context[ctype], template)
-
-        elif context[ctype].get('info',{}).get('BIDS') == 'NA':
-            continue
-
-        if ctype == 'project':
-            bidsify_flywheel.process_matching_templates(context, template)
-            # Validate meta information
-            # TODO: Improve the validator to understand what is valid for dataset_description file...
-            # validate_meta_info(context['project'])
-
-        elif ctype == 'session':
-            bidsify_flywheel.process_matching_templates(context, template)
-
-            # Add run_counter
-            context['run_counters'] = utils.RunCounterMap()
-
-        elif ctype == 'acquisition':
-            bidsify_flywheel.process_matching_templates(context, template)
-
-        elif ctype == 'file':
-            if parent_ctype == 'project' and PROJECT_TEMPLATE_FILE_NAME_REGEX.search(context['file']['name']):
-                # Don't BIDSIFY project template
-                continue
-
-            # Process matching
-            context['file'] = bidsify_flywheel.process_matching_templates(context, template)
-            # Validate meta information
-            validate_meta_info(context['file'], template)
+    sessions = [child for child in project.children if child.type == 'session']
+
+    # Skip the sessions that did not change since they were last curated
+    watermarks = None
+    if incremental:
+        watermarks = CurationWatermarks(template_signature(template_file))
+        if not reset:
+            watermarks = CurationWatermarks.load(project, watermarks.template)
+        unchanged = set(id(session) for session in sessions if watermarks.is_current(session))
+        logger.info('Curating {0} of {1} session(s) that changed since the last curation'.format(
+            len(sessions) - len(unchanged), len(sessions)))
+        if unchanged:
+            full_project = project
+            project = project_tree.TreeNode(full_project.type, full_project.data)
+            project.children = [child for child in full_project.children if id(child) not in unchanged]
+            sessions = [session for session in sessions if id(session) not in unchanged]
+
+    # Sessions are independent, so passes 1 and 2 can run per session in worker processes
+    parallel = processes and processes > 1 and len(sessions) > 1
+    if parallel and not is_session_local(template):
+        logger.warning('Template resolvers look beyond a session, curating sessions serially')
+        parallel = False
+    if parallel:
+        try:
+            pool = start_session_pool(min(processes, len(sessions)), template_file)
+        except OSError as err:
+            logger.warning('Could not start worker processes ({0}), curating sessions serially'.format(err))
+            parallel = False
 
+    # 1. Do initial template matching and updating
     # 2. Perform any path resolutions
-    session = None
-    for context in project.context_iter():
-        # Resolution
-        bidsify_flywheel.process_resolvers(context, template)
+    if parallel:
+        curate_sessions_parallel(project, template, pool, reset)
+    else:
+        curate_node(project, template, reset)
 
     # 3. Send updates to server
     if update:
+        # A reset replaces whole info objects
+        dispatcher = update_dispatcher.UpdateDispatcher(fw, max_workers=max_workers, replace=reset)
         for context in project.context_iter():
             ctype = context['container_type']
             node = context[ctype]
             if node.is_dirty():
-                update_meta_info(fw, context)
+                dispatcher.add(context)
+
+        # Every container is attempted before failures are reported
+        failures = dispatcher.run()
+        if watermarks is not None:
+            # Sessions are only current once all of their updates went through
+            for session in sessions:
+                containers = set((node.type, node['id']) for node in iter_nodes(session) if node.type != 'file')
+                if not containers.intersection(failures):
+                    watermarks.update(session)
+            watermarks.save(fw, project)
+        if failures:
+            raise BIDSCurationError('Failed to update {0} container(s)'.format(len(failures)),
+                    errors={'{0}/{1}'.format(*container): [str(err) for target, err in errors]
+                        for container, errors in failures.items()})
 
 def main_with_args(api_key, session_id, reset, session_only):
 
@@ -230,11 +370,32 @@ def main_with_args(api_key, session_id, reset, session_only):
     curate_bids_dir(fw, project_id, session_id, reset=reset, session_only=session_only)
 
 
+def curate_snapshot(snapshot_file, reset=False, template_file=None, processes=None, output_file=None):
+    """ Curate a project tree snapshot offline, without sending any updates
+
+    snapshot_file: The snapshot to curate (see project_tree.save_snapshot)
+    reset: Whether or not to reset bids info before curation
+    template_file: The template file to use
+    processes: Number of processes to curate sessions in, or None to curate serially
+    output_file: Optional file to write the curated project tree to, as json
+
+    """
+    project = project_tree.load_snapshot(snapshot_file)
+    curate_bids_tree(None, project, reset, template_file, False, processes=processes)
+
+    dirty = [node for node in iter_nodes(project) if node.is_dirty()]
+    logger.info('Curation would update {0} of {1} node(s)'.format(
+        len(dirty), sum(1 for node in iter_nodes(project))))
+    if output_file:
+        with open(output_file, 'w') as f:
+            json.dump(project.to_json(), f, indent=2)
+    return project
+
 def main():
     ### Read in arguments
     parser = argparse.ArgumentParser(description='BIDS Curation')
     parser.add_argument('--api-key', dest='api_key', action='store',
-            required=True, help='API key')
+            required=False, default=None, help='API key (required unless curating a --snapshot)')
     parser.add_argument('-p', dest='project_label', action='store',
             required=False, default=None, help='Project Label on Flywheel instance')
     parser.add_argument('--session', dest='session_id', action='store',
@@ -245,8 +406,31 @@ def main():
             default=False, help='Only curate the session identified by --session')
     parser.add_argument('--template-file', dest='template_file', action='store',
             default=None, help='Template file to use')
+    parser.add_argument('--workers', dest='max_workers', action='store', type=int,
+            default=update_dispatcher.DEFAULT_MAX_WORKERS, help='Number of containers to update concurrently')
+    parser.add_argument('--processes', dest='processes', action='store', type=int,
+            default=None, help='Number of processes to curate sessions in (defaults to curating serially)')
+    parser.add_argument('--incremental', dest='incremental', action='store_true',
+            default=False, help='Only curate sessions that changed since they were last curated')
+    parser.add_argument('--save-snapshot', dest='save_snapshot', action='store',
+            default=None, help='Save a snapshot of the project tree to this file before curating it')
+    parser.add_argument('--snapshot', dest='snapshot', action='store',
+            default=None, help='Curate a project tree snapshot offline, instead of a project on Flywheel')
+    parser.add_argument('--output', dest='output_file', action='store',
+            default=None, help='Write the curated project tree to this json file (with --snapshot)')
     args = parser.parse_args()
 
+    if args.snapshot:
+        try:
+            curate_snapshot(args.snapshot, reset=args.reset, template_file=args.template_file,
+                    processes=args.processes, output_file=args.output_file)
+        except BIDSCurationError as err:
+            logger.error(err)
+            sys.exit(err.status_code)
+        return
+    if not args.api_key:
+        parser.error('--api-key is required')
+
     ### Prep
     # Check API key - raises Error if key is invalid
     fw = flywheel.Flywheel(args.api_key)
@@ -260,7 +444,9 @@ def main():
         sys.exit(1)
 
     ### Curate BIDS project
-    curate_bids_dir(fw, project_id, args.session_id, reset=args.reset, template_file=args.template_file, session_only=args.session_only)
+    curate_bids_dir(fw, project_id, args.session_id, reset=args.reset, template_file=args.template_file, session_only=args.session_only,
+            max_workers=args.max_workers, processes=args.processes, incremental=args.incremental,
+            snapshot_file=args.save_snapshot)
 
 if __name__ == '__main__':
     main()
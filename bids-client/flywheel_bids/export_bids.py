@@ -5,17 +5,18 @@ import json
 import os
 import re
 import sys
-import zipfile
 
 import flywheel
 
-from .supporting_files import utils
+from .supporting_files import archives, dir_snapshot, download_cache, downloader, export_plan, hierarchy, manifest, readiness, utils
+from .supporting_files import sidecars as sidecars_module
 from .supporting_files.errors import BIDSExportError
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('bids-exporter')
 
 EPOCH = dateutil.parser.parse('1970-01-01 00:00:0Z')
+CONTAINER_TYPES = ('project', 'session', 'acquisition')
 
 def validate_dirname(dirname):
     """
@@ -59,8 +60,15 @@ def get_metadata(ctx, namespace):
 
     return ctx['info'][namespace]
 
-def is_file_excluded_options(namespace, src_data, replace):
-    def is_file_excluded(f, fpath):
+def is_file_excluded_options(namespace, src_data, replace, export_manifest=None, snapshot=None):
+    # Existing files are looked up in the directory snapshot, if there is one
+    fs = snapshot if snapshot is not None else os.path
+
+    def is_file_excluded(f, fpath, check_existing=True):
+        # A previous export of a file that is filtered out below still exists upstream
+        if export_manifest is not None and fpath:
+            export_manifest.mark_listed(fpath)
+
         metadata = get_metadata(f, namespace)
         if not metadata:
             return True
@@ -73,13 +81,34 @@ def is_file_excluded_options(namespace, src_data, replace):
             if path and path.startswith('sourcedata'):
                 return True
 
+        if not check_existing:
+            return False
+
+        # Files recorded by a previous export are compared with the manifest, and only
+        # checked to still be on disk with the recorded size
+        if export_manifest is not None and fpath in export_manifest:
+            entry = export_manifest.get(fpath)
+            if entry.get('extracted_dir'):
+                # Archives are removed once extracted
+                present = fs.isdir(os.path.join(export_manifest.bids_dir, entry['extracted_dir']))
+            else:
+                present = fs.isfile(fpath) and (entry.get('size') is None or fs.getsize(fpath) == entry['size'])
+            if present and (not replace or export_manifest.is_current(fpath, f)):
+                export_manifest.keep(fpath)
+                return True
+            return False
+
         # Check if file already exists
-        if os.path.isfile(fpath):
+        if fs.isfile(fpath):
             if not replace:
                 return True
             # Check if the file already exists and whether it is up to date
             time_since_epoch = timestamp_to_int(f.get('modified'))
-            if time_since_epoch == int(os.path.getmtime(fpath)):
+            if time_since_epoch == int(fs.getmtime(fpath)):
+                # Adopt the file into the manifest, so it isn't checked on disk again
+                if export_manifest is not None:
+                    export_manifest.record(fpath, file_id=f.get('file_id') or f.get('id'), modified=f.get('modified'),
+                            size=fs.getsize(fpath), file_hash=f.get('hash'))
                 return True
 
         return False
@@ -126,11 +155,12 @@ def get_folder(f, namespace):
 
     return metadata.get('Folder')
 
-def create_json(meta_info, path, namespace):
+def sidecar_contents(meta_info, path, namespace):
     """
     Given a dictionary of the meta info
-        and the path, creates a JSON file
-        with the bids info
+        and the path, returns a tuple of
+        the sidecar path and its contents,
+        or None if there is nothing to write
 
     namespace in the template namespace,
         in this case it is 'BIDS'
@@ -163,116 +193,320 @@ def create_json(meta_info, path, namespace):
     ext = utils.get_extension(path)
     new_path = re.sub(ext, '.json', path)
 
-    # Write out contents to JSON file
-    with open(new_path, 'w') as outfile:
-        json.dump(meta_info, outfile,
+    return new_path, meta_info
+
+def write_json(path, data):
+    with open(path, 'w') as outfile:
+        json.dump(data, outfile,
                 sort_keys=True, indent=4)
 
-def download_bids_files(fw, filepath_downloads, dry_run):
+def create_json(meta_info, path, namespace):
     """
-    filepath_downloads: {container_type: {filepath: {'args': (tuple of args for sdk download function), 'modified': file modified attr}}}
+    Given a dictionary of the meta info
+        and the path, creates a JSON file
+        with the bids info
+
+    namespace in the template namespace,
+        in this case it is 'BIDS'
+
+    Returns the path of the JSON file, or None
     """
-    # Download all project files
-    logger.info('Downloading project files')
-    for f in filepath_downloads['project']:
-        args = filepath_downloads['project'][f]['args']
-        modified = filepath_downloads['project'][f]['modified']
-        logger.info('Downloading project file: {0}'.format(args[1]))
-        # For dry run, don't actually download
-        if dry_run:
-            logger.info('  to {0}'.format(args[2]))
-            continue
-        fw.download_file_from_project(*args)
-        # Set the mtime of the downloaded file to the 'modified' timestamp in seconds
-        modified_time = float(timestamp_to_int(modified))
-        os.utime(f,(modified_time, modified_time))
+    result = sidecar_contents(meta_info, path, namespace)
+    if result is None:
+        return None
+
+    # Write out contents to JSON file
+    new_path, meta_info = result
+    write_json(new_path, meta_info)
+    return new_path
+
+def finalize_download(job):
+    """
+    Post-process a downloaded file: stamp its mtime and unpack project zip attachments
+    """
+    # Set the mtime of the downloaded file to the 'modified' timestamp in seconds
+    modified_time = float(timestamp_to_int(job.modified))
+    os.utime(job.path, (modified_time, modified_time))
 
-        # If zipfile is attached to project, unzip...
-        path = args[2]
+    # If zipfile is attached to project, unzip...
+    if job.container_type == 'project':
+        path = job.path
         zip_pattern = re.compile('[a-zA-Z0-9]+(.zip)')
         zip_dirname = path[:-4]
         if zip_pattern.search(path):
-            zip_ref = zipfile.ZipFile(path, 'r')
-            zip_ref.extractall(zip_dirname)
-            zip_ref.close()
+            archives.extract_zip(path, zip_dirname)
             # Remove the zipfile
             os.remove(path)
+            job.extracted_dir = zip_dirname
 
-    # Download all session files
-    logger.info('Downloading session files')
-    for f in filepath_downloads['session']:
-        args = filepath_downloads['session'][f]['args']
-        modified = filepath_downloads['session'][f]['modified']
-        logger.info('Downloading session file: {0}'.format(args[1]))
-        # For dry run, don't actually download
-        if dry_run:
-            logger.info('  to {0}'.format(args[2]))
-            continue
-        fw.download_file_from_session(*args)
-        # Set the mtime of the downloaded file to the 'modified' timestamp in seconds
-        modified_time = float(timestamp_to_int(modified))
-        os.utime(f,(modified_time, modified_time))
-
-
-    # Download all acquisition files
-    logger.info('Downloading acquisition files')
-    for f in filepath_downloads['acquisition']:
-        args = filepath_downloads['acquisition'][f]['args']
-        modified = filepath_downloads['acquisition'][f]['modified']
-        # Download the file
-        logger.info('Downloading acquisition file: {0}'.format(args[1]))
-
-        # For dry run, don't actually download
-        if dry_run:
-            logger.info('  to {0}'.format(args[2]))
-            continue
+def start_download_engine(fw, dry_run, max_workers, cache=None, export_manifest=None, tracker=None,
+        sidecars_pending=True, max_per_host=downloader.DEFAULT_MAX_PER_HOST):
+    """
+    Start a download engine, or return None for a dry run.
+    Completed downloads are recorded in export_manifest, and partial downloads are kept
+    in its directory, out of the BIDS tree. Completed downloads are reported to the
+    ReadinessTracker tracker, if given. With sidecars_pending, the sidecars of
+    acquisition files are only created once every download is done. At most max_per_host
+    files are downloaded from the Flywheel host at once.
+    """
+    if dry_run:
+        return None
+
+    def on_complete(job):
+        finalize_download(job)
+        if export_manifest is not None:
+            export_manifest.record_job(job, sidecar_pending=(sidecars_pending and job.container_type == 'acquisition'))
+        if tracker is not None:
+            tracker.complete(job.path)
 
-        fw.download_file_from_acquisition(*args)
-        # Set the mtime of the downloaded file to the 'modified' timestamp in seconds
-        modified_time = float(timestamp_to_int(modified))
-        os.utime(f,(modified_time, modified_time))
+    part_dir = export_manifest.partial_dir if export_manifest is not None else None
+    engine = downloader.DownloadEngine(fw, max_workers=max_workers, max_per_host=max_per_host,
+            on_complete=on_complete, cache=cache, part_dir=part_dir)
+    engine.start()
+    return engine
+
+def submit_download(engine, job):
+    """
+    Queue job on the engine, or just log it for a dry run (engine is None)
+    """
+    logger.info('Downloading {0} file: {1}'.format(job.container_type, job.file_name))
+    # For dry run, don't actually download
+    if engine is None:
+        logger.info('  to {0}'.format(job.path))
+        return
+    engine.submit(job)
+
+def create_sidecars(sidecars, dry_run, export_manifest=None, compact_outdir=None):
+    """
+    sidecars: list of (meta_info, path, namespace) argument tuples for create_json
+    export_manifest: Optional ExportManifest to record the sidecar of each file in
+    compact_outdir: If given, hoist shared metadata into inherited sidecars in this directory
+    """
+    if compact_outdir is not None:
+        create_compact_sidecars(sidecars, dry_run, compact_outdir, export_manifest=export_manifest)
+        return
 
     # Creating all JSON sidecar files
     logger.info('Creating sidecar files')
-    for f in filepath_downloads['sidecars']:
-        args = filepath_downloads['sidecars'][f]['args']
-        # Download the file
-        logger.info('Creating sidecar file: {0}'.format(args[1]))
-
-        # For dry run, don't actually download
-        if dry_run:
-            logger.info('  to {0}'.format(args[1]))
-            continue
+    for args in sidecars:
+        create_sidecar(args, dry_run, export_manifest=export_manifest)
+
+def create_sidecar(args, dry_run, export_manifest=None):
+    """
+    args: (meta_info, path, namespace) argument tuple for create_json
+    export_manifest: Optional ExportManifest to record the sidecar of the file in
+    """
+    logger.info('Creating sidecar file: {0}'.format(args[1]))
 
-        create_json(*args)
+    # For dry run, don't actually create the file
+    if dry_run:
+        logger.info('  to {0}'.format(args[1]))
+        return
 
-def download_bids_dir(fw, container_id, container_type, outdir, src_data=False,
-        dry_run=False, replace=False, subjects=[], sessions=[], folders=[]):
+    sidecar_path = create_json(*args)
+    if export_manifest is not None:
+        export_manifest.record_sidecar(args[1], sidecar_path)
+
+def create_compact_sidecars(sidecars, dry_run, outdir, export_manifest=None):
     """
+    Create sidecar files, with the metadata shared across files with the same entities
+    moved into top-level sidecars under the BIDS inheritance principle.
 
-    fw: Flywheel client
-    project_id: Label of the project to download
-    outdir: path to directory to download files to, string
-    src_data: Option to include sourcedata when downloading
+    sidecars: iterable of (meta_info, path, namespace) argument tuples for create_json,
+        such as a SidecarSpool
+    outdir: The BIDS directory to write the top-level sidecars to
 
+    The sidecar contents are spooled, so memory use does not grow with the number of files.
     """
+    logger.info('Creating compacted sidecar files')
+    contents = sidecars_module.SidecarSpool()
+    # The position of the latest contents of each sidecar, and the file it belongs to
+    latest = {}
+    data_paths = {}
+    for args in sidecars:
+        result = sidecar_contents(*args)
+        if result is None:
+            if export_manifest is not None and not dry_run:
+                export_manifest.record_sidecar(args[1])
+            continue
+        # Later sidecars for the same path win, as when each is written in turn
+        latest[result[0]] = len(contents)
+        contents.append(result)
+        data_paths[result[0]] = args[1]
+
+    def items():
+        for i, (path, data) in enumerate(contents):
+            if latest[path] == i:
+                yield path, data
 
+    paths = sorted(latest, key=latest.get)
+    try:
+        for path, data in sidecars_module.iter_compacted(paths, items, outdir):
+            logger.info('Creating sidecar file: {0}'.format(path))
+            if dry_run:
+                continue
+
+            if data:
+                write_json(path, data)
+            elif os.path.isfile(path):
+                # Every key is inherited, so a sidecar from an earlier export would override them
+                os.remove(path)
+            if export_manifest is not None and path in data_paths:
+                export_manifest.record_sidecar(data_paths[path], path if data else None)
+    finally:
+        contents.close()
+
+def download_bids_files(fw, filepath_downloads, dry_run, max_workers=downloader.DEFAULT_MAX_WORKERS, cache=None,
+        max_per_host=downloader.DEFAULT_MAX_PER_HOST):
+    """
+    filepath_downloads: {container_type: {filepath: {'args': (tuple of args for sdk download function), 'modified': file modified attr}}}
+    cache: Optional DownloadCache, only used for entries that also carry 'file_id' or 'hash'
+
+    Project, session and acquisition files are downloaded concurrently by a bounded pool of
+    max_workers threads, at most max_per_host of them against the Flywheel host at once.
+    Sidecar files are created once every download has finished.
+    """
+    engine = start_download_engine(fw, dry_run, max_workers, cache=cache, max_per_host=max_per_host)
+    for container_type in ['project', 'session', 'acquisition']:
+        logger.info('Downloading {0} files'.format(container_type))
+        for f in filepath_downloads[container_type]:
+            entry = filepath_downloads[container_type][f]
+            args = entry['args']
+            submit_download(engine, downloader.DownloadJob(container_type, args[0], args[1], f, entry['modified'],
+                file_id=entry.get('file_id'), file_hash=entry.get('hash')))
+
+    # Wait for all downloads to finish before writing sidecars
+    if engine:
+        engine.close()
+
+    create_sidecars([x['args'] for x in filepath_downloads['sidecars'].values()], dry_run)
+
+def iter_bids_files(fw, container_id, container_type, outdir, src_data=False,
+        replace=False, subjects=[], sessions=[], folders=[], fetcher=None, export_manifest=None, create_dirs=True,
+        snapshot=None, tracker=None):
+    """
+    Walk the Flywheel hierarchy below a container, yielding files as soon as they are mapped.
+
+    Containers are retrieved through a HierarchyFetcher (a new one unless given), so files and
+    their info are fetched in bulk rather than with one request per acquisition. If an
+    ExportManifest is given, files it records are checked against it instead of the disk.
+    Destination directories are created as files are mapped, unless create_dirs is False.
+    Existing files and directories are read from a DirectorySnapshot of outdir (a new one
+    unless given), taken with one pass over the tree, so no target path is stat'd.
+
+    Yields (job, sidecar) tuples, where job is a DownloadJob (or None) and sidecar is a
+    tuple of create_json arguments (or None). Each session's acquisitions are resolved right
+    after its session files, so downloads can start before the walk is complete. Sessions
+    are walked subject by subject, and the anat files of each session come first.
+
+    If a ReadinessTracker is given, every mapped path is registered with it. Unless a mapping
+    error occurred, its anat folders are sealed once the walk is past the anat files of the
+    subject, and the rest once the walk moves on to the next subject.
+
+    Raises:
+        BIDSExportError: Once the walk is complete, if files could not be mapped to BIDS.
+            No further files are yielded after the first mapping error.
+    """
     # Define namespace
     namespace = 'BIDS'
-    is_file_excluded = is_file_excluded_options(namespace, src_data, replace)
-
-    # Files and the corresponding download arguments separated by parent container
-    filepath_downloads = {
+    if snapshot is None:
+        snapshot = dir_snapshot.DirectorySnapshot(outdir)
+    is_file_excluded = is_file_excluded_options(namespace, src_data, replace, export_manifest=export_manifest,
+            snapshot=snapshot)
+    if fetcher is None:
+        fetcher = hierarchy.HierarchyFetcher(fw)
+
+    # Mapped paths and the corresponding file names, separated by parent container
+    mapped_paths = {
         'project':{},
         'session':{},
-        'acquisition':{},
-        'sidecars':{}
+        'acquisition':{}
     }
-    valid = True
+    mapped_any = set()
+    state = {'valid': True}
+
+    def mark_listed(f):
+        """ Record that a file skipped by the walk still exists in Flywheel """
+        if export_manifest is not None:
+            path = define_path(outdir, f, namespace)
+            if path:
+                export_manifest.mark_listed(path)
+
+    def map_file(parent_type, parent_id, f):
+        """ Map a file to its BIDS path, returning the download job or None """
+        # Define path - ensure that the folder exists...
+        path = define_path(outdir, f, namespace)
+        # If path is not defined (an empty string) move onto next file
+        if not path:
+            return None
+        if tracker is not None:
+            tracker.register(path)
+
+        # Don't exclude any files that specify exclusion. Files mapped earlier in this
+        # walk may already be downloaded, so they don't count as existing files.
+        if is_file_excluded(f, path, check_existing=(path not in mapped_any)):
+            return None
+
+        # Each distinct directory is created once
+        if create_dirs:
+            snapshot.makedirs(os.path.dirname(path))
+
+        warn_if_bids_invalid(f, namespace)
+
+        if path in mapped_paths[parent_type]:
+            logger.error('Multiple files with path {0}:\n\t{1} and\n\t{2}'.format(path, f['name'], mapped_paths[parent_type][path]))
+            state['valid'] = False
+
+        mapped_paths[parent_type][path] = f['name']
+        mapped_any.add(path)
+        if not state['valid']:
+            return None
+
+        return downloader.DownloadJob(parent_type, parent_id, f['name'], path, f.get('modified'),
+                file_id=f.get('file_id') or f.get('id'), file_hash=f.get('hash'), size=f.get('size'))
+
+    def map_acquisitions(acqs):
+        # Anatomical processing can start as soon as the anat files are in place
+        results = list(iter_acquisitions(acqs))
+        if not state['valid']:
+            # Don't start downloads of a session that failed to map
+            return []
+        results.sort(key=lambda result: get_result_folder(result) != readiness.EARLY_FOLDER)
+        return results
+
+    def iter_acquisitions(acqs):
+        for acq in acqs:
+            # Skip if BIDS.Ignore is True
+            if is_container_excluded(acq, namespace):
+                for f in acq.get('files', []):
+                    mark_listed(f)
+                continue
+
+            # Iterate over acquistion files
+            for f in acq.get('files', []):
+
+                # Skip any folders not in the skip-list (if there is a skip list)
+                if folders:
+                    folder = get_folder(f, namespace)
+                    if folder not in folders:
+                        mark_listed(f)
+                        continue
+
+                job = map_file('acquisition', acq['_id'], f)
+                if job:
+                    # Create the sidecar JSON alongside the file
+                    yield job, (f['info'], job.path, namespace)
+                elif export_manifest is not None:
+                    # Create the sidecars an interrupted export downloaded the file for, but never wrote
+                    path = define_path(outdir, f, namespace)
+                    if path and export_manifest.is_sidecar_pending(path):
+                        yield None, (f['info'], path, namespace)
+
+    found_acqs = False
 
     if container_type == 'project':
         # Get project
-        project = fw.get_project(container_id)
+        project = fetcher.get_project(container_id)
 
         # Check that project is curated
         if not project['info'].get(namespace):
@@ -281,43 +515,29 @@ def download_bids_dir(fw, container_id, container_type, outdir, src_data=False,
         logger.info('Processing project files')
         # Iterate over any project files
         for f in project.get('files', []):
+            job = map_file('project', project['_id'], f)
+            if job:
+                yield job, None
 
-            # Define path - ensure that the folder exists...
-            path = define_path(outdir, f, namespace)
-            # If path is not defined (an empty string) move onto next file
-            if not path:
-                continue
-
-            # Don't exclude any files that specify exclusion
-            if is_file_excluded(f, path):
-                continue
-
-            if not os.path.exists(os.path.dirname(path)):
-                os.makedirs(os.path.dirname(path))
-
-            warn_if_bids_invalid(f, namespace)
-
-
-            # For dry run, don't actually download
-            if path in filepath_downloads['project']:
-                logger.error('Multiple files with path {0}:\n\t{1} and\n\t{2}'.format(path, f['name'], filepath_downloads['project'][path]['args'][1]))
-                valid = False
-
-            filepath_downloads['project'][path] = {'args': (project['_id'], f['name'], path), 'modified': f.get('modified')}
-
-        ## Create dataset_description.json filepath_download
+        ## Create dataset_description.json sidecar
         path = os.path.join(outdir, 'dataset_description.json')
-        filepath_downloads['sidecars'][path] = {'args': (project['info'][namespace], path, namespace)}
-        # Get project sessions
-        project_sessions = fw.get_project_sessions(container_id)
+        yield None, (project['info'][namespace], path, namespace)
+        # Get project sessions, sessions are completed below only if they are exported
+        project_sessions = fetcher.get_project_sessions(container_id, complete=False)
+        # Walk each subject's sessions together, so subjects are complete one after another
+        project_sessions = sorted(project_sessions, key=get_subject_code)
+        # Without filters, every acquisition is needed, so get them all in one call
+        if not sessions and not subjects:
+            fetcher.prefetch_project_acquisitions(container_id)
     elif container_type == 'session':
-        project_sessions = [fw.get_session(container_id)]
+        project_sessions = [fetcher.get_session(container_id)]
     else:
         project_sessions = []
 
     if project_sessions:
         logger.info('Processing session files')
-        all_acqs = []
+        selected_sessions = []
+        ignored_sessions = []
         for proj_ses in project_sessions:
             # Skip session if we're filtering to the list of sessions
             if sessions and proj_ses.get('label') not in sessions:
@@ -325,6 +545,7 @@ def download_bids_dir(fw, container_id, container_type, outdir, src_data=False,
 
             # Skip session if BIDS.Ignore is True
             if is_container_excluded(proj_ses, namespace):
+                ignored_sessions.append(proj_ses)
                 continue
 
             # Skip subject if we're filtering subjects
@@ -333,94 +554,313 @@ def download_bids_dir(fw, container_id, container_type, outdir, src_data=False,
                 if subj_code not in subjects:
                     continue
 
+            selected_sessions.append(proj_ses)
+
+        for i, proj_ses in enumerate(selected_sessions):
+            subject_code = get_subject_code(proj_ses)
+            # Every file of the previous subject (and the project) is mapped and valid
+            if tracker is not None and state['valid'] and i and get_subject_code(selected_sessions[i - 1]) != subject_code:
+                tracker.seal()
+
             # Get true session if files aren't already retrieved, in order to access file info
-            if proj_ses.get('files'):
-                session = proj_ses
-            else:
-                session = fw.get_session(proj_ses['_id'])
-            # Check if session contains files
+            session = fetcher.get_session(proj_ses['_id'], listed=proj_ses)
             # Iterate over any session files
             for f in session.get('files', []):
+                job = map_file('session', session['_id'], f)
+                if job:
+                    yield job, None
 
-                # Define path - ensure that the folder exists...
-                path = define_path(outdir, f, namespace)
-                # If path is not defined (an empty string) move onto next file
-                if not path:
-                    continue
-
-                # Don't exclude any files that specify exclusion
-                if is_file_excluded(f, path):
-                    continue
-
-                if not os.path.exists(os.path.dirname(path)):
-                    os.makedirs(os.path.dirname(path))
+            logger.info('Processing acquisition files')
+            # Get acquisitions
+            session_acqs = fetcher.get_session_acquisitions(proj_ses['_id'])
+            if session_acqs:
+                found_acqs = True
+            results = map_acquisitions(session_acqs)
+            early = [result for result in results if get_result_folder(result) == readiness.EARLY_FOLDER]
+            for result in early:
+                yield result
+
+            # After the anat files of the subject's last session, its anat folders are complete
+            last_session = i + 1 == len(selected_sessions) or get_subject_code(selected_sessions[i + 1]) != subject_code
+            if tracker is not None and state['valid'] and last_session:
+                tracker.seal(readiness.EARLY_FOLDER)
+            for result in results[len(early):]:
+                yield result
+
+        # Files of ignored sessions are not exported, but are not gone from Flywheel either
+        if export_manifest is not None and export_manifest.entries:
+            for proj_ses in ignored_sessions:
+                session = fetcher.get_session(proj_ses['_id'], listed=proj_ses)
+                for f in session.get('files', []):
+                    mark_listed(f)
+                for acq in fetcher.get_session_acquisitions(proj_ses['_id']):
+                    for f in acq.get('files', []):
+                        mark_listed(f)
+    elif container_type == 'acquisition':
+        found_acqs = True
+        for result in map_acquisitions([fetcher.get_acquisition(container_id)]):
+            yield result
 
-                warn_if_bids_invalid(f, namespace)
+    if not found_acqs:
+        logger.error('{} is not a valid containertype'.format(container_type))
+        state['valid'] = False
 
+    if not state['valid']:
+        raise BIDSExportError('Error mapping files from Flywheel to BIDS')
 
-                if path in filepath_downloads['session']:
-                    logger.error('Multiple files with path {0}:\n\t{1} and\n\t{2}'.format(path, f['name'], filepath_downloads['session'][path]['args'][1]))
-                    valid = False
+def get_subject_code(session):
+    """
+    Get the subject code of a session, for ordering sessions by subject
+    """
+    return (session.get('subject') or {}).get('code') or ''
 
-                filepath_downloads['session'][path] = {'args': (session['_id'], f['name'], path), 'modified': f.get('modified')}
+def get_result_folder(result):
+    """
+    Get the BIDS folder of an iter_bids_files (job, sidecar) result
+    """
+    job, sidecar = result
+    path = job.path if job else sidecar[1]
+    return os.path.basename(os.path.dirname(path))
 
-            logger.info('Processing acquisition files')
-            # Get acquisitions
-            session_acqs = fw.get_session_acquisitions(proj_ses['_id'])
-            all_acqs += session_acqs
-    elif container_type == 'acquisition':
-        all_acqs = [fw.get_acquisition(container_id)]
-    else:
-        all_acqs = []
+def download_bids_dir(fw, container_id, container_type, outdir, src_data=False,
+        dry_run=False, replace=False, subjects=[], sessions=[], folders=[],
+        max_workers=downloader.DEFAULT_MAX_WORKERS, cache=None, compact_sidecars=False, on_ready=None,
+        fetcher=None, max_per_host=downloader.DEFAULT_MAX_PER_HOST):
+    """
 
-    if all_acqs:
-        for ses_acq in all_acqs:
-            # Skip if BIDS.Ignore is True
-            if is_container_excluded(ses_acq, namespace):
-                continue
-            # Get true acquisition if files aren't already retrieved, in order to access file info
+    fw: Flywheel client
+    project_id: Label of the project to download
+    outdir: path to directory to download files to, string
+    src_data: Option to include sourcedata when downloading
+    max_workers: Number of files to download concurrently
+    max_per_host: Maximum number of files to download concurrently from the Flywheel host
+    cache: Optional DownloadCache to serve unchanged files from instead of downloading them
+    compact_sidecars: Hoist metadata shared across files into inherited top-level sidecars
+    on_ready: Optional function called with (subject, folder) once a subject ('anat' folder),
+        or all of a subject (folder None), is in place
+    fetcher: Optional HierarchyFetcher, to share the fetched containers across exports
+
+    The hierarchy walk and the downloads are pipelined: files are queued for download as
+    soon as they are mapped, and the bounded download queue throttles the walk.
+
+    Every exported file is recorded in a manifest in outdir. With replace, files are
+    re-downloaded only if the manifest shows they changed upstream, or are missing or
+    truncated on disk. A full project export also removes previously exported files that no
+    longer exist upstream; files it filters out or ignores are left in place.
+
+    Files are downloaded to partial files under .bids_export and moved into place once
+    complete, and each completed file is journaled, so an interrupted export can be resumed
+    by running it again.
+
+    Sidecars are written as the walk maps their files, so their metadata is not held in
+    memory until the end. Each subject's files are signalled ready (see ReadinessTracker) as
+    soon as they are in place. Compacted sidecars depend on every file, so with
+    compact_sidecars they are spooled (to disk past a threshold), written once every download
+    is done, and nothing is ready until the end.
+    """
+    export_manifest = manifest.ExportManifest.load(outdir)
+    tracker = None
+    if not dry_run:
+        export_manifest.open_journal()
+        write_sidecars = None
+        if not compact_sidecars:
+            write_sidecars = lambda group: create_sidecars(group, False, export_manifest=export_manifest)
+        tracker = readiness.ReadinessTracker(outdir, write_sidecars=write_sidecars, on_ready=on_ready)
+        # Only an export of the whole project drops the markers of subjects it doesn't map
+        tracker.start(clear=(container_type == 'project' and not (subjects or sessions or folders)))
+    # Sidecars left for the end: compacted sidecars, or every sidecar of a dry run
+    sidecars = sidecars_module.SidecarSpool()
+    engine = start_download_engine(fw, dry_run, max_workers, cache=cache, export_manifest=export_manifest,
+            tracker=tracker, sidecars_pending=compact_sidecars, max_per_host=max_per_host)
+    try:
+        try:
+            for job, sidecar in iter_bids_files(fw, container_id, container_type, outdir,
+                    src_data=src_data, replace=replace, subjects=subjects, sessions=sessions, folders=folders,
+                    fetcher=fetcher, export_manifest=export_manifest, tracker=tracker):
+                if job:
+                    if tracker is not None:
+                        tracker.expect(job.path)
+                    submit_download(engine, job)
+                if sidecar:
+                    if tracker is not None and tracker.write_sidecars is not None:
+                        tracker.add_sidecar(sidecar)
+                    else:
+                        sidecars.append(sidecar)
+        except Exception:
+            # Drop any queued downloads before propagating the mapping error
+            if engine:
+                engine.abort()
+            raise
+
+        # Wait for all downloads to finish before writing the remaining sidecars
+        close_download_engine(engine, cache, export_manifest)
+
+        if len(sidecars):
+            create_sidecars(sidecars, dry_run, export_manifest=export_manifest,
+                    compact_outdir=outdir if compact_sidecars else None)
+        if tracker is not None:
+            tracker.finish()
+
+        # Only a complete project export knows which files vanished upstream
+        if is_complete_export(container_type, replace, subjects, sessions, folders):
+            export_manifest.prune(dry_run=dry_run)
+    finally:
+        sidecars.close()
+        # Record whatever was downloaded, even if the export failed
+        if not dry_run:
+            export_manifest.save()
+
+def download_bids_containers(fw, containers, outdir, fetcher=None, **kwargs):
+    """
+    Export several containers into outdir, one after another.
 
-            acq = fw.get_acquisition(ses_acq['_id'])
-            # Iterate over acquistion files
-            for f in acq.get('files', []):
+    The client, and a HierarchyFetcher with the containers fetched so far, are shared by
+    every export. A container that fails to export is logged and skipped, so one bad
+    container doesn't stop a batch.
 
-                # Skip any folders not in the skip-list (if there is a skip list)
-                if folders:
-                    folder = get_folder(f, namespace)
-                    if folder not in folders:
-                        continue
+    fw: Flywheel client
+    containers: list of (container_type, container_id) tuples
+    outdir: path to directory to download files to, string
+    kwargs: Any other download_bids_dir arguments
 
-                # Define path - ensure that the folder exists...
-                path = define_path(outdir, f, namespace)
-                # If path is not defined (an empty string) move onto next file
-                if not path:
-                    continue
+    Raises:
+        BIDSExportError: Once every container was processed, if any of them failed
+    """
+    if fetcher is None:
+        fetcher = hierarchy.HierarchyFetcher(fw)
+
+    failed = []
+    for i, (container_type, container_id) in enumerate(containers):
+        logger.info('Exporting {0} {1} ({2}/{3})'.format(container_type, container_id, i + 1, len(containers)))
+        try:
+            download_bids_dir(fw, container_id, container_type, outdir, fetcher=fetcher, **kwargs)
+        except (BIDSExportError, flywheel.ApiException) as err:
+            logger.error('Failed to export {0} {1}: {2}'.format(container_type, container_id, err))
+            failed.append((container_type, container_id))
+
+    if failed:
+        raise BIDSExportError('Failed to export {0} of {1} container(s): {2}'.format(len(failed), len(containers),
+            ', '.join('{0}:{1}'.format(*x) for x in failed)))
+
+def is_complete_export(container_type, replace, subjects, sessions, folders):
+    """
+    Check if an export replaces the whole project, so files it doesn't map can be removed
+    """
+    return bool(replace and container_type == 'project' and not (subjects or sessions or folders))
 
-                # Don't exclude any files that specify exclusion
-                if is_file_excluded(f, path):
-                    continue
+def close_download_engine(engine, cache, export_manifest):
+    """
+    Wait for the engine's downloads to finish, and record the measured throughput
+    """
+    if not engine:
+        return
+    try:
+        engine.close()
+    finally:
+        export_manifest.record_throughput(engine.bytes_downloaded, engine.elapsed)
+    if cache:
+        logger.info('Download cache: {0} hit(s), {1} miss(es)'.format(cache.hits, cache.misses))
+
+def plan_bids_dir(fw, container_id, container_type, outdir, src_data=False,
+        replace=False, subjects=[], sessions=[], folders=[]):
+    """
+    Plan an export without downloading anything or writing into outdir.
 
-                if not os.path.exists(os.path.dirname(path)):
-                    os.makedirs(os.path.dirname(path))
+    The plan lists the files download_bids_dir would download and the sidecars it would
+    create, along with the previously exported files it would remove.
 
-                warn_if_bids_invalid(f, namespace)
+    Returns:
+        ExportPlan: The plan
+    """
+    export_manifest = manifest.ExportManifest.load(outdir)
+    plan = export_plan.ExportPlan(throughput=export_manifest.throughput, options={
+        'container_type': container_type,
+        'container_id': container_id,
+        'source_data': src_data,
+        'replace': replace,
+        'subjects': subjects,
+        'sessions': sessions,
+        'folders': folders
+    })
+    for job, sidecar in iter_bids_files(fw, container_id, container_type, outdir,
+            src_data=src_data, replace=replace, subjects=subjects, sessions=sessions, folders=folders,
+            export_manifest=export_manifest, create_dirs=False):
+        if job:
+            plan.add_job(job, outdir)
+        if sidecar:
+            plan.add_sidecar(sidecar, outdir)
+
+    if is_complete_export(container_type, replace, subjects, sessions, folders):
+        plan.remove = export_manifest.stale()
+    return plan
+
+def execute_plan(fw, plan, outdir, dry_run=False, max_workers=downloader.DEFAULT_MAX_WORKERS,
+        cache=None, compact_sidecars=False, max_per_host=downloader.DEFAULT_MAX_PER_HOST):
+    """
+    Download the files and create the sidecars of an export plan into outdir.
 
-                if path in filepath_downloads['acquisition']:
-                    logger.error('Multiple files with path {0}:\n\t{1} and\n\t{2}'.format(path, f['name'], filepath_downloads['acquisition'][path]['args'][1]))
-                    valid = False
+    plan: ExportPlan, made by plan_bids_dir on this or any other machine
+    """
+    export_manifest = manifest.ExportManifest.load(outdir)
+    if not dry_run:
+        export_manifest.open_journal()
+    engine = start_download_engine(fw, dry_run, max_workers, cache=cache, export_manifest=export_manifest,
+            max_per_host=max_per_host)
+    try:
+        try:
+            snapshot = dir_snapshot.DirectorySnapshot(outdir)
+            for job in plan.jobs(outdir, dateutil.parser.parse):
+                if not dry_run:
+                    snapshot.makedirs(os.path.dirname(job.path))
+                submit_download(engine, job)
+        except Exception:
+            if engine:
+                engine.abort()
+            raise
+
+        close_download_engine(engine, cache, export_manifest)
+
+        create_sidecars(plan.sidecar_args(outdir), dry_run, export_manifest=export_manifest,
+                compact_outdir=outdir if compact_sidecars else None)
+
+        if plan.remove:
+            export_manifest.kept = set(export_manifest.entries) - set(plan.remove)
+            export_manifest.prune(dry_run=dry_run)
+    finally:
+        if not dry_run:
+            export_manifest.save()
+
+def parse_container(spec):
+    """
+    Parse a container given as type:id (e.g. session:5a1f0c3b9b5e4c001b2d3e4f)
 
-                filepath_downloads['acquisition'][path] = {'args': (acq['_id'], f['name'], path), 'modified': f.get('modified')}
+    Returns:
+        tuple: (container_type, container_id)
 
-                # Create the sidecar JSON filepath_download
-                filepath_downloads['sidecars'][path] = {'args': (f['info'], path, namespace)}
-    else:
-        logger.error('{} is not a valid containertype'.format(container_type))
-        valid = False
+    Raises:
+        BIDSExportError: If spec is not a valid container
+    """
+    container_type, sep, container_id = spec.strip().partition(':')
+    if not sep or container_type not in CONTAINER_TYPES or not container_id:
+        raise BIDSExportError('Invalid container {0}, expected type:id with type one of: {1}'.format(
+            spec, ', '.join(CONTAINER_TYPES)))
+    return container_type, container_id
 
-    if not valid:
-        raise BIDSExportError('Error mapping files from Flywheel to BIDS')
+def read_containers_file(path):
+    """
+    Read a file of containers, with one type:id per line.
+    Blank lines, and lines starting with #, are ignored.
 
-    download_bids_files(fw, filepath_downloads, dry_run)
+    Returns:
+        list: (container_type, container_id) tuples
+    """
+    containers = []
+    with open(path, 'r') as fp:
+        for line in fp:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                containers.append(parse_container(line))
+    return containers
 
 def determine_container(fw, project_label, container_type, container_id):
     """
@@ -444,19 +884,59 @@ def determine_container(fw, project_label, container_type, container_id):
     return ctype, cid
 
 def export_bids(fw, bids_dir, project_label, subjects=None, sessions=None, folders=None, replace=False,
-        dry_run=False, container_type=None, container_id=None, source_data=False, validate=True):
+        dry_run=False, container_type=None, container_id=None, source_data=False, validate=True,
+        max_workers=downloader.DEFAULT_MAX_WORKERS, cache_dir=None, cache_size=download_cache.DEFAULT_MAX_SIZE,
+        compact_sidecars=False, plan_out=None, plan=None, on_ready=None, containers=None,
+        max_per_host=downloader.DEFAULT_MAX_PER_HOST):
+    """
+    plan_out: If given, only plan the export and write the plan to this file
+    plan: If given, execute the plan in this file instead of walking the Flywheel hierarchy
+    on_ready: Optional function called with (subject, folder) as subjects are in place,
+        see download_bids_dir
+    containers: If given, export each of these (container_type, container_id) tuples in turn,
+        instead of a single project or container
+    """
 
     ### Prep
     # Check directory name - ensure it exists
     validate_dirname(bids_dir)
 
-    # Check that container args are valid
-    ctype, cid = determine_container(fw, project_label, container_type, container_id)
-
-    ### Download BIDS project
-    download_bids_dir(fw, cid, ctype, bids_dir,
-            src_data=source_data, dry_run=dry_run, replace=replace,
-            subjects=subjects, sessions=sessions, folders=folders)
+    # Use a download cache if one is configured
+    cache = download_cache.get_cache(cache_dir, max_size=cache_size)
+
+    if plan:
+        ### Download a planned export
+        planned = export_plan.ExportPlan.load(plan)
+        planned.log_summary()
+        execute_plan(fw, planned, bids_dir, dry_run=dry_run, max_workers=max_workers, cache=cache,
+                compact_sidecars=compact_sidecars, max_per_host=max_per_host)
+    elif containers:
+        if plan_out:
+            raise BIDSExportError('Cannot plan the export of multiple containers')
+        if project_label:
+            raise BIDSExportError('Cannot export a project label along with a list of containers')
+        ### Download each container, sharing the client and the fetched containers
+        download_bids_containers(fw, containers, bids_dir,
+                src_data=source_data, dry_run=dry_run, replace=replace,
+                subjects=subjects, sessions=sessions, folders=folders, max_workers=max_workers, cache=cache,
+                compact_sidecars=compact_sidecars, on_ready=on_ready, max_per_host=max_per_host)
+    else:
+        # Check that container args are valid
+        ctype, cid = determine_container(fw, project_label, container_type, container_id)
+
+        if plan_out:
+            ### Plan the export, without downloading anything
+            planned = plan_bids_dir(fw, cid, ctype, bids_dir, src_data=source_data, replace=replace,
+                    subjects=subjects, sessions=sessions, folders=folders)
+            planned.save(plan_out)
+            planned.log_summary()
+            return
+
+        ### Download BIDS project
+        download_bids_dir(fw, cid, ctype, bids_dir,
+                src_data=source_data, dry_run=dry_run, replace=replace,
+                subjects=subjects, sessions=sessions, folders=folders, max_workers=max_workers, cache=cache,
+                compact_sidecars=compact_sidecars, on_ready=on_ready, max_per_host=max_per_host)
 
     # Validate the downloaded directory
     #   Go one more step into the hierarchy to pass to the validator...
@@ -476,7 +956,7 @@ def main():
     parser.add_argument('--dry-run', dest='dry_run', action='store_true',
             default=False, required=False, help='Don\'t actually export any data, just print what would be exported')
     parser.add_argument('--replace', dest='replace', action='store_true',
-            default=False, required=False, help='Replace files if the modified timestamps do not match')
+            default=False, required=False, help='Replace files that changed in Flywheel, and remove files that were deleted')
     parser.add_argument('--subject', dest='subjects', action='append', help='Limit export to the given subject')
     parser.add_argument('--session', dest='sessions', action='append', help='Limit export to the given session name')
     parser.add_argument('--folder', dest='folders', action='append', help='Limit export to the given folder. (e.g. func)')
@@ -486,14 +966,43 @@ def main():
             help='Download single container (acquisition|session|project) in BIDS format. Must provide --container-id.')
     parser.add_argument('--container-id', dest='container_id', action='store', required=False, default=None,
             help='Download single container in BIDS format. Must provide --container-type.')
+    parser.add_argument('--container', dest='containers', action='append', required=False, default=None,
+            help='Download the given container, as type:id (e.g. session:<id>). May be given more than once.')
+    parser.add_argument('--containers-file', dest='containers_file', action='store', required=False, default=None,
+            help='Download every container listed in this file, one type:id per line')
+    parser.add_argument('--workers', dest='max_workers', action='store', type=int, required=False,
+            default=downloader.DEFAULT_MAX_WORKERS, help='Number of files to download concurrently')
+    parser.add_argument('--max-per-host', dest='max_per_host', action='store', type=int, required=False,
+            default=downloader.DEFAULT_MAX_PER_HOST, help='Maximum number of files to download concurrently from the Flywheel host')
+    parser.add_argument('--cache-dir', dest='cache_dir', action='store', required=False, default=None,
+            help='Directory of a download cache shared across exports (defaults to ${0})'.format(download_cache.CACHE_DIR_ENV))
+    parser.add_argument('--cache-size', dest='cache_size', action='store', type=float, required=False,
+            default=download_cache.DEFAULT_MAX_SIZE / 1024.0 ** 3, help='Maximum size of the download cache, in GiB')
+    parser.add_argument('--compact-sidecars', dest='compact_sidecars', action='store_true', default=False, required=False,
+            help='Move metadata shared by files with the same entities into inherited top-level sidecars')
+    parser.add_argument('--plan-out', dest='plan_out', action='store', required=False, default=None,
+            help='Only plan the export, and write the plan with size and time estimates to this file')
+    parser.add_argument('--plan', dest='plan', action='store', required=False, default=None,
+            help='Execute an export plan written by --plan-out')
     args = parser.parse_args()
+    if args.project_label and (args.containers or args.containers_file):
+        parser.error('-p cannot be combined with --container or --containers-file')
 
     # Check API key - raises Error if key is invalid
     fw = flywheel.Flywheel(args.api_key)
 
     try:
+        containers = [parse_container(x) for x in args.containers or []]
+        if args.containers_file:
+            containers += read_containers_file(args.containers_file)
+        if containers and args.container_type and args.container_id:
+            containers.insert(0, (args.container_type, args.container_id))
+
         export_bids(fw, args.bids_dir, args.project_label, subjects=args.subjects, sessions=args.sessions, folders=args.folders, replace=args.replace,
-                dry_run=args.dry_run, container_type=args.container_type, container_id=args.container_id, source_data=args.source_data)
+                dry_run=args.dry_run, container_type=args.container_type, container_id=args.container_id, source_data=args.source_data,
+                max_workers=args.max_workers, cache_dir=args.cache_dir, cache_size=int(args.cache_size * 1024 ** 3),
+                compact_sidecars=args.compact_sidecars, plan_out=args.plan_out, plan=args.plan, containers=containers,
+                max_per_host=args.max_per_host)
     except utils.BIDSException as bids_exception:
         logger.error(bids_exception)
         sys.exit(bids_exception.status_code)
@@ -0,0 +1,81 @@
+import logging
+import os
+import zipfile
+
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('bids-exporter')
+
+DEFAULT_MAX_WORKERS = 4
+# Archives smaller than this are not worth splitting across threads (64 MiB)
+MIN_PARALLEL_SIZE = 64 * 1024 ** 2
+
+def partition_members(members, count):
+    """
+    Split zip members into count groups of roughly equal uncompressed size,
+    assigning the largest members first.
+
+    Args:
+        members (list): ZipInfo objects
+        count (int): The number of groups
+
+    Returns:
+        list: Non-empty lists of ZipInfo objects
+    """
+    groups = [[] for _ in range(count)]
+    sizes = [0] * count
+    for member in sorted(members, key=lambda m: m.file_size, reverse=True):
+        i = sizes.index(min(sizes))
+        groups[i].append(member)
+        sizes[i] += member.file_size
+    return [group for group in groups if group]
+
+def member_path(dest_dir, member):
+    """
+    Get the path a zip member is extracted to, sanitized the same way as ZipFile.extract
+    """
+    arcname = member.filename.replace('/', os.path.sep)
+    if os.path.altsep:
+        arcname = arcname.replace(os.path.altsep, os.path.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    invalid = ('', os.path.curdir, os.path.pardir)
+    arcname = os.path.sep.join(x for x in arcname.split(os.path.sep) if x not in invalid)
+    return os.path.join(dest_dir, arcname)
+
+def _extract_members(path, dest_dir, members):
+    # ZipFile objects are not safe to share between threads, so each thread opens its own
+    with zipfile.ZipFile(path, 'r') as zip_ref:
+        for member in members:
+            zip_ref.extract(member, dest_dir)
+
+def extract_zip(path, dest_dir, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Extract a zip file into dest_dir, with the same layout as ZipFile.extractall.
+    Members of large archives are decompressed by several threads at once.
+
+    Args:
+        path (str): The zip file
+        dest_dir (str): The directory to extract to
+        max_workers (int): The maximum number of extraction threads
+    """
+    with zipfile.ZipFile(path, 'r') as zip_ref:
+        members = zip_ref.infolist()
+
+    files = [m for m in members if not m.filename.endswith('/')]
+    total_size = sum(m.file_size for m in files)
+    if max_workers <= 1 or len(files) < 2 or total_size < MIN_PARALLEL_SIZE:
+        _extract_members(path, dest_dir, members)
+        return
+
+    # Create directories up front, so threads don't race to create them
+    _extract_members(path, dest_dir, [m for m in members if m.filename.endswith('/')])
+    for dirname in set(os.path.dirname(member_path(dest_dir, m)) for m in files):
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+    groups = partition_members(files, min(max_workers, len(files)))
+    logger.info('Extracting {0} files from {1} with {2} threads'.format(len(files), os.path.basename(path), len(groups)))
+    with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+        futures = [executor.submit(_extract_members, path, dest_dir, group) for group in groups]
+        for future in futures:
+            future.result()
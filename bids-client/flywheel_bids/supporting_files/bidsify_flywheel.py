@@ -106,11 +106,8 @@ def process_matching_templates(context, template=templates.DEFAULT_TEMPLATE, upl
     if initial:
         # Do initial rule matching
         match = False
-        rules = template.rules
         # If matching on upload, test against upload_rules as well
-        if upload:
-            rules = rules + template.upload_rules
-        for rule in rules:
+        for rule in template.candidate_rules(context, upload=upload):
             if rule.test(context):
                 print('matches template={0}'.format(rule.template))
                 match = True
@@ -144,7 +141,7 @@ def process_matching_templates(context, template=templates.DEFAULT_TEMPLATE, upl
 
     return container
 
-def process_resolvers(context, template=templates.DEFAULT_TEMPLATE):
+def process_resolvers(context, template=templates.DEFAULT_TEMPLATE, index=None):
     """
     Perform second stage path resolution based on template rules
 
@@ -152,6 +149,8 @@ def process_resolvers(context, template=templates.DEFAULT_TEMPLATE):
         session (TreeNode): The session node to search within
         context (dict): The context to perform path resolution on
         template (Template): The template
+        index (ResolutionIndex): The optional index of contexts to resolve from, shared
+            by every context of the resolution pass
     """
     namespace = template.namespace
 
@@ -168,7 +167,7 @@ def process_resolvers(context, template=templates.DEFAULT_TEMPLATE):
 
     # Apply each resolver
     for resolver in resolvers:
-        resolver.resolve(context)
+        resolver.resolve(context, index)
 
 
 def ensure_info_exists(context, template=templates.DEFAULT_TEMPLATE):
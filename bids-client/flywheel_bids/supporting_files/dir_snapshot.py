@@ -0,0 +1,130 @@
+import errno
+import os
+import threading
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+class DirectorySnapshot(object):
+    """
+    The files and directories below a root directory, read with a single scandir pass.
+
+    Export consults the snapshot instead of stat'ing every target path, and creates each
+    distinct directory once. The tree is scanned lazily, on first use. Hidden directories
+    (such as the export manifest) are not scanned. The scan only reads names; files are
+    stat'd when their size or mtime is first asked for.
+
+    Args:
+        root (str): The root directory
+
+    Attributes:
+        scans (int): The number of directories listed
+        created (int): The number of directories created
+    """
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.scans = 0
+        self.created = 0
+        self._files = None
+        self._stats = {}
+        self._dirs = None
+        self._lock = threading.Lock()
+
+    def _scan(self):
+        files = set()
+        dirs = set()
+        if os.path.isdir(self.root):
+            dirs.add(self.root)
+            pending = [self.root]
+            while pending:
+                dirname = pending.pop()
+                self.scans += 1
+                for entry in scandir(dirname):
+                    if entry.is_dir(follow_symlinks=False):
+                        if not entry.name.startswith('.'):
+                            dirs.add(entry.path)
+                            pending.append(entry.path)
+                    elif entry.is_file():
+                        files.add(entry.path)
+        self._files = files
+        self._dirs = dirs
+
+    def _ensure_scanned(self):
+        if self._files is None:
+            with self._lock:
+                if self._files is None:
+                    self._scan()
+
+    def _key(self, path):
+        return os.path.abspath(path)
+
+    def isfile(self, path):
+        """
+        Check if path was a file when the snapshot was taken
+        """
+        self._ensure_scanned()
+        return self._key(path) in self._files
+
+    def getsize(self, path):
+        """
+        Get the size of a file in the snapshot
+
+        Raises:
+            OSError: If the file is not in the snapshot
+        """
+        return self._stat(path)[0]
+
+    def getmtime(self, path):
+        """
+        Get the mtime of a file in the snapshot
+
+        Raises:
+            OSError: If the file is not in the snapshot
+        """
+        return self._stat(path)[1]
+
+    def _stat(self, path):
+        self._ensure_scanned()
+        key = self._key(path)
+        if key not in self._files:
+            raise OSError(errno.ENOENT, 'No such file in snapshot', path)
+        if key not in self._stats:
+            stat = os.stat(key)
+            self._stats[key] = (stat.st_size, stat.st_mtime)
+        return self._stats[key]
+
+    def isdir(self, path):
+        """
+        Check if path is a directory, either found by the scan or created since
+        """
+        self._ensure_scanned()
+        return self._key(path) in self._dirs
+
+    def makedirs(self, path):
+        """
+        Create a directory and its parents, unless the snapshot already knows them.
+        Each distinct directory is created at most once.
+
+        Args:
+            path (str): The directory
+        """
+        key = self._key(path)
+        if self.isdir(key):
+            return
+
+        with self._lock:
+            # Find the missing ancestors, then create them top down
+            missing = []
+            while key not in self._dirs and key != os.path.dirname(key):
+                missing.append(key)
+                key = os.path.dirname(key)
+            for dirname in reversed(missing):
+                try:
+                    os.mkdir(dirname)
+                    self.created += 1
+                except OSError as err:
+                    if err.errno != errno.EEXIST:
+                        raise
+                self._dirs.add(dirname)
@@ -0,0 +1,300 @@
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+logger = logging.getLogger('bids-download-cache')
+
+# The default maximum size of the cache, in bytes (100 GiB)
+DEFAULT_MAX_SIZE = 100 * 1024 ** 3
+# Environment variable naming a cache directory to use when none is given explicitly
+CACHE_DIR_ENV = 'FLYWHEEL_BIDS_CACHE_DIR'
+# Linux ioctl to clone a file's extents (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+USED_SUFFIX = '.used'
+TMP_PREFIX = '.tmp-'
+
+def cache_key(file_id=None, modified=None, file_hash=None):
+    """
+    Build the cache key of a Flywheel file.
+
+    The server hash identifies the file content, so it is preferred. Otherwise the file id
+    together with the modified timestamp identifies a version of the file.
+
+    Args:
+        file_id (str): The file id
+        modified (datetime): The file modified timestamp
+        file_hash (str): The file hash reported by the server
+
+    Returns:
+        str: The key, or None if the file cannot be identified
+    """
+    if file_hash:
+        source = 'hash:{0}'.format(file_hash)
+    elif file_id and modified:
+        source = 'id:{0}:{1}'.format(file_id, modified.isoformat() if hasattr(modified, 'isoformat') else modified)
+    else:
+        return None
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+def reflink(src, dest):
+    """
+    Create dest as a copy-on-write clone of src.
+
+    Raises:
+        OSError: If the platform or filesystem does not support reflinks
+    """
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported on this platform')
+
+    with open(src, 'rb') as src_fp:
+        with open(dest, 'wb') as dest_fp:
+            try:
+                fcntl.ioctl(dest_fp.fileno(), FICLONE, src_fp.fileno())
+            except (IOError, OSError):
+                dest_fp.close()
+                os.remove(dest)
+                raise
+
+def materialize(src, dest):
+    """
+    Place the cached file src at dest without copying data where possible: by hardlink,
+    then by reflink, falling back to a plain copy.
+
+    Args:
+        src (str): The cached file
+        dest (str): The destination path, replaced if it exists
+
+    Returns:
+        str: The method used (link|reflink|copy)
+    """
+    # Never write through an existing link into the cache
+    if os.path.lexists(dest):
+        os.remove(dest)
+
+    try:
+        os.link(src, dest)
+        return 'link'
+    except (OSError, AttributeError):
+        pass
+
+    try:
+        reflink(src, dest)
+        return 'reflink'
+    except (IOError, OSError):
+        pass
+
+    shutil.copyfile(src, dest)
+    return 'copy'
+
+class DownloadCache(object):
+    """
+    Content-addressed on-disk cache of downloaded Flywheel files, shared across runs.
+
+    Files are stored under their cache key and placed into the destination directory with
+    materialize. When the cache grows past max_size, the least recently used files are evicted.
+    Several processes may share a cache directory: files enter the cache by atomic rename,
+    and a file evicted while in use stays valid for any hardlinks made to it.
+
+    Args:
+        cache_dir (str): The cache directory, created if it does not exist
+        max_size (int): The maximum size of the cache, in bytes
+
+    Attributes:
+        hits (int): The number of files served from the cache
+        misses (int): The number of files downloaded into the cache
+    """
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = threading.Lock()
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                if not os.path.isdir(self.cache_dir):
+                    raise
+
+    def path_for(self, key):
+        """
+        Get the path of the cached file for key
+        """
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def touch(self, key):
+        """
+        Mark the cached file for key as used now.
+
+        Usage is tracked on a separate stamp file, since the mtime of the cached file itself
+        is shared with its hardlinks and set to the Flywheel modified timestamp.
+        """
+        with open(self.path_for(key) + USED_SUFFIX, 'a'):
+            pass
+        os.utime(self.path_for(key) + USED_SUFFIX, None)
+
+    def get(self, key, dest):
+        """
+        Place the cached file for key at dest, if it is cached.
+
+        Args:
+            key (str): The cache key
+            dest (str): The destination path
+
+        Returns:
+            bool: True if the file was cached
+        """
+        path = self.path_for(key)
+        if not os.path.isfile(path):
+            return False
+        try:
+            method = materialize(path, dest)
+        except (IOError, OSError) as err:
+            # The file was evicted by another process in the meantime
+            if err.errno != errno.ENOENT or os.path.isfile(path):
+                raise
+            return False
+
+        self.touch(key)
+        with self._lock:
+            self.hits += 1
+        logger.debug('Cache hit for {0} ({1})'.format(dest, method))
+        return True
+
+    def fetch(self, key, dest, download_fn):
+        """
+        Place the file for key at dest, downloading it into the cache first if it is not cached.
+
+        Args:
+            key (str): The cache key
+            dest (str): The destination path
+            download_fn (function): Called with a path to download the file to
+
+        Returns:
+            bool: True if the file was served from the cache
+        """
+        if self.get(key, dest):
+            return True
+
+        self.download(key, dest, download_fn)
+        return False
+
+    def download(self, key, dest, download_fn):
+        """
+        Download a file into the cache under key, and place it at dest.
+
+        Args:
+            key (str): The cache key
+            dest (str): The destination path
+            download_fn (function): Called with a path to download the file to
+        """
+        path = self.path_for(key)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname):
+                    raise
+
+        fd, tmp_path = tempfile.mkstemp(prefix=TMP_PREFIX, dir=dirname)
+        os.close(fd)
+        try:
+            download_fn(tmp_path)
+            os.rename(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        self.touch(key)
+        materialize(path, dest)
+
+        with self._lock:
+            self.misses += 1
+            if self._size is None:
+                self._size = self.size()
+            else:
+                self._size += os.path.getsize(path)
+            if self.max_size is not None and self._size > self.max_size:
+                self.evict()
+
+    def entries(self):
+        """
+        List the cached files.
+
+        Returns:
+            list: (last_used, size, path) tuples
+        """
+        results = []
+        for shard in os.listdir(self.cache_dir):
+            shard_dir = os.path.join(self.cache_dir, shard)
+            if not os.path.isdir(shard_dir):
+                continue
+            for name in os.listdir(shard_dir):
+                if name.endswith(USED_SUFFIX) or name.startswith(TMP_PREFIX):
+                    continue
+                path = os.path.join(shard_dir, name)
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    continue
+                try:
+                    last_used = os.path.getmtime(path + USED_SUFFIX)
+                except OSError:
+                    last_used = 0
+                results.append((last_used, size, path))
+        return results
+
+    def size(self):
+        """
+        Get the total size of the cached files, in bytes
+        """
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """
+        Remove the least recently used files until the cache fits in max_size.
+
+        Returns:
+            int: The number of bytes freed
+        """
+        if self.max_size is None:
+            return 0
+
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        freed = 0
+        for last_used, size, path in sorted(entries):
+            if total - freed <= self.max_size:
+                break
+            for p in (path, path + USED_SUFFIX):
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+            freed += size
+            logger.debug('Evicted {0} ({1} bytes) from the cache'.format(path, size))
+        self._size = total - freed
+        return freed
+
+def get_cache(cache_dir=None, max_size=DEFAULT_MAX_SIZE):
+    """
+    Get a download cache for cache_dir, falling back to the directory named by the
+    FLYWHEEL_BIDS_CACHE_DIR environment variable.
+
+    Returns:
+        DownloadCache: The cache, or None if no cache directory is configured
+    """
+    cache_dir = cache_dir or os.environ.get(CACHE_DIR_ENV)
+    if not cache_dir:
+        return None
+    return DownloadCache(cache_dir, max_size=max_size)
@@ -0,0 +1,487 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from six.moves import queue
+
+from . import download_cache
+from .errors import BIDSExportError
+
+logger = logging.getLogger('bids-exporter')
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_MAX_PER_HOST = 4
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_DELAY = 1.0
+CHUNK_SIZE = 1024 ** 2
+PART_SUFFIX = '.part'
+# Flywheel file hashes look like v0-sha384-<hex digest>
+HASH_VERSION = 'v0'
+DEFAULT_HASH_ALGORITHM = 'sha384'
+
+class DownloadJob(object):
+    """
+    Represents a single file to be downloaded from a Flywheel container.
+
+    Args:
+        container_type (str): The parent container type (project|session|acquisition)
+        container_id (str): The parent container id
+        file_name (str): The name of the file on the parent container
+        path (str): The destination path of the file
+        modified (datetime): The file modified timestamp
+        file_id (str): The file id, used to cache the download
+        file_hash (str): The file hash reported by the server, used to cache the download
+        size (int): The file size reported by the server
+
+    Attributes:
+        attempts (int): The number of download attempts made so far
+        cached (bool): True if the file was served from the download cache
+        resumed_from (int): The offset an interrupted download was resumed from, if any
+        verified_hash (str): The hash computed while downloading the file, if it was streamed
+    """
+    def __init__(self, container_type, container_id, file_name, path, modified=None,
+            file_id=None, file_hash=None, size=None):
+        self.container_type = container_type
+        self.container_id = container_id
+        self.file_name = file_name
+        self.path = path
+        self.modified = modified
+        self.file_id = file_id
+        self.file_hash = file_hash
+        self.size = size
+        self.attempts = 0
+        self.cached = False
+        self.resumed_from = None
+        self.verified_hash = None
+
+    @property
+    def cache_key(self):
+        return download_cache.cache_key(self.file_id, self.modified, self.file_hash)
+
+    @property
+    def part_path(self):
+        """
+        The path the file is downloaded to before it is moved into place. It names the
+        file version, so a partial download is only ever resumed for the same version.
+        """
+        key = self.cache_key
+        if key is None:
+            return self.path + PART_SUFFIX
+        return '{0}.{1}{2}'.format(self.path, key[:16], PART_SUFFIX)
+
+    @property
+    def part_name(self):
+        """
+        The name of the part file in a shared part directory, which also names the
+        destination path, so part files of different destinations never collide
+        """
+        name = '{0}.{1}'.format(os.path.basename(self.path), hashlib.sha1(self.path.encode('utf-8')).hexdigest()[:16])
+        key = self.cache_key
+        if key is None:
+            return name + PART_SUFFIX
+        return '{0}.{1}{2}'.format(name, key[:16], PART_SUFFIX)
+
+    def __repr__(self):
+        return 'DownloadJob({0}/{1}/{2} -> {3})'.format(self.container_type,
+                self.container_id, self.file_name, self.path)
+
+def get_client_host(fw):
+    """
+    Get the host that the given client talks to, used to cap concurrency per host.
+
+    Args:
+        fw: Flywheel client
+
+    Returns:
+        str: The api host, or 'default' if it cannot be determined
+    """
+    try:
+        return fw.api_client.configuration.host
+    except AttributeError:
+        return 'default'
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+def replace_file(src, dest):
+    """
+    Atomically move src to dest, replacing dest if it exists
+    """
+    if hasattr(os, 'replace'):
+        os.replace(src, dest)
+    else:
+        os.rename(src, dest)
+
+def new_hasher(file_hash=None):
+    """
+    Create a hash object for the algorithm of a Flywheel file hash.
+
+    Args:
+        file_hash (str): The file hash reported by the server, e.g. v0-sha384-<hex digest>
+
+    Returns:
+        The hash object, using the default algorithm if file_hash is missing or unsupported
+    """
+    parts = (file_hash or '').split('-')
+    if len(parts) == 3 and parts[0] == HASH_VERSION and parts[1] in hashlib.algorithms_available:
+        return hashlib.new(parts[1])
+    return hashlib.new(DEFAULT_HASH_ALGORITHM)
+
+def format_hash(hasher):
+    """
+    Format the digest of a hash object the way Flywheel reports file hashes
+    """
+    return '{0}-{1}-{2}'.format(HASH_VERSION, hasher.name, hasher.hexdigest())
+
+def hash_file(path, hasher):
+    """
+    Feed the contents of a file to a hash object
+    """
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+
+def stream_file(fw, job, path, offset=0, hasher=None):
+    """
+    Download a file with the streaming SDK call, writing it to path chunk by chunk. Each
+    chunk is fed to hasher as it is written, so the file is never read back to verify it.
+    With an offset, only the rest of a partially downloaded file is requested (with a
+    range request) and appended to path.
+
+    Args:
+        fw: Flywheel client
+        job (DownloadJob): The file to download
+        path (str): The file to write
+        offset (int): The number of bytes already downloaded to path
+        hasher: Optional hash object to update with the downloaded bytes
+
+    Returns:
+        bool: True if the file was downloaded, False if the client does not support
+            streaming, or the server does not support range requests
+    """
+    api = getattr(fw, '{0}s_api'.format(job.container_type), None)
+    download_fn = getattr(api, 'download_file_from_{0}_with_http_info'.format(job.container_type), None)
+    if download_fn is None:
+        return False
+
+    kwargs = {'view': True, '_preload_content': False, '_return_http_data_only': True}
+    if offset:
+        kwargs['range'] = 'bytes={0}-'.format(offset)
+    try:
+        resp = download_fn(job.container_id, job.file_name, **kwargs)
+    except TypeError:
+        # Older clients don't take these arguments
+        return False
+
+    try:
+        if offset:
+            content_range = resp.headers.get('content-range', '')
+            if resp.status_code != 206 or not content_range.startswith('bytes {0}-'.format(offset)):
+                return False
+        elif resp.status_code != 200:
+            return False
+        with open(path, 'ab' if offset else 'wb') as fp:
+            for chunk in resp.iter_content(CHUNK_SIZE):
+                fp.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+        return True
+    finally:
+        resp.close()
+
+def download_file(fw, job, path, offset=None):
+    """
+    Download a file to path and verify it against the size and hash reported by the server.
+
+    The file is hashed as it streams to disk. Resuming a partial download hashes the part
+    that is already there first. Clients that cannot stream only get the size checked.
+
+    Args:
+        fw: Flywheel client
+        job (DownloadJob): The file to download, its verified_hash is set if it was hashed
+        path (str): The file to write
+        offset (int): The size of a partial download at path to resume, if any
+
+    Raises:
+        BIDSExportError: If the downloaded file does not match, after removing it
+    """
+    hasher = new_hasher(job.file_hash)
+    job.resumed_from = None
+    if offset:
+        hash_file(path, hasher)
+        if offset == job.size or stream_file(fw, job, path, offset, hasher):
+            logger.info('Resumed download of {0} from byte {1}'.format(job.file_name, offset))
+            job.resumed_from = offset
+        else:
+            hasher = new_hasher(job.file_hash)
+    if not job.resumed_from and not stream_file(fw, job, path, hasher=hasher):
+        fetch_file(fw, job, path)
+        hasher = None
+
+    size = _file_size(path)
+    if job.size is not None and size != job.size:
+        # Start over on the next attempt
+        os.remove(path)
+        raise BIDSExportError('Downloaded {0} bytes of {1}, expected {2}'.format(size, job.file_name, job.size))
+
+    job.verified_hash = format_hash(hasher) if hasher is not None else None
+    if job.verified_hash and job.file_hash and job.verified_hash != job.file_hash:
+        os.remove(path)
+        raise BIDSExportError('Hash mismatch for {0}: expected {1}, got {2}'.format(job.file_name,
+            job.file_hash, job.verified_hash))
+
+def fetch_file(fw, job, path=None):
+    """
+    Download the file described by job using the SDK download function
+    for the job's container type.
+
+    Args:
+        fw: Flywheel client
+        job (DownloadJob): The file to download
+        path (str): The path to download to (defaults to job.path)
+    """
+    download_fn = getattr(fw, 'download_file_from_{0}'.format(job.container_type))
+    download_fn(job.container_id, job.file_name, path or job.path)
+
+class DownloadEngine(object):
+    """
+    Bounded worker pool that downloads files from Flywheel concurrently.
+
+    Jobs are pulled from a bounded queue by a fixed number of worker threads. Each job is
+    retried on its own, so one failing file does not stop the rest of the export. Failures
+    are collected and raised as a single BIDSExportError when the engine is closed.
+    on_complete runs once a file is downloaded, outside of the retries: its errors don't
+    download the file again, and are reported apart from download failures.
+
+    Downloads are verified against the size and hash reported by the server as they are
+    written (see download_file), and a file that does not match is downloaded again.
+
+    Args:
+        fw: Flywheel client
+        max_workers (int): The number of worker threads
+        max_per_host (int): The maximum number of concurrent downloads against one host
+        retries (int): The number of times to retry a failed download
+        retry_delay (float): The base delay (in seconds) between retries, doubled on every attempt
+        queue_size (int): The maximum number of queued jobs, submit blocks when full
+        on_complete (function): Optional callback invoked with each job once it is downloaded
+        cache (DownloadCache): Optional cache to serve files from, and to download files into
+        resume (bool): Resume interrupted downloads from their partial file where possible
+        part_dir (str): Optional directory for partial downloads, instead of next to their
+            destination. Part files left in it are removed once the engine is closed.
+
+    Attributes:
+        completed (int): The number of files downloaded
+        bytes_downloaded (int): The number of bytes downloaded, not counting files served from the cache
+        elapsed (float): The time in seconds from start to close
+        failures (list): A list of (job, exception) tuples for files that could not be downloaded
+        complete_failures (list): A list of (job, exception) tuples for files that were
+            downloaded, but that on_complete failed for
+    """
+    def __init__(self, fw, max_workers=DEFAULT_MAX_WORKERS, max_per_host=DEFAULT_MAX_PER_HOST,
+            retries=DEFAULT_RETRIES, retry_delay=DEFAULT_RETRY_DELAY, queue_size=None, on_complete=None, cache=None, resume=True,
+            part_dir=None):
+        self.fw = fw
+        self.max_workers = max(1, max_workers)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.on_complete = on_complete
+        self.cache = cache
+        self.resume = resume
+        self.part_dir = part_dir
+
+        self.host = get_client_host(fw)
+        self.host_limits = {self.host: threading.BoundedSemaphore(max(1, max_per_host))}
+
+        if queue_size is None:
+            queue_size = self.max_workers * 4
+        self.queue = queue.Queue(maxsize=queue_size)
+
+        self.completed = 0
+        self.bytes_downloaded = 0
+        self.elapsed = 0.0
+        self.failures = []
+        self.complete_failures = []
+        self._started = None
+        self._lock = threading.Lock()
+        self._workers = []
+        self._cancelled = threading.Event()
+
+    def start(self):
+        """
+        Start the worker threads
+        """
+        self._started = time.time()
+        for i in range(self.max_workers):
+            worker = threading.Thread(target=self._work, name='bids-download-{0}'.format(i))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, job):
+        """
+        Queue a job for download, blocking while the queue is full.
+
+        Args:
+            job (DownloadJob): The file to download
+        """
+        if not self._workers:
+            self.start()
+        self.queue.put(job)
+
+    def close(self):
+        """
+        Wait for all queued jobs to finish and stop the workers.
+
+        Raises:
+            BIDSExportError: If any file could not be downloaded
+        """
+        for _ in self._workers:
+            self.queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        if self._started is not None:
+            self.elapsed = time.time() - self._started
+        # Downloads that completed or failed leave no part file, the rest are orphans
+        # of earlier versions. Aborted exports keep theirs, to resume them.
+        if not self._cancelled.is_set():
+            self._remove_orphaned_parts()
+
+        for job, err in self.failures:
+            logger.error('Failed to download {0} after {1} attempts: {2}'.format(job.file_name, job.attempts, err))
+        for job, err in self.complete_failures:
+            logger.error('Failed to process downloaded file {0}: {1}'.format(job.path, err))
+        if self.failures and self.complete_failures:
+            raise BIDSExportError('Failed to download {0} file(s), and to process {1} downloaded file(s)'.format(
+                len(self.failures), len(self.complete_failures)))
+        if self.failures:
+            raise BIDSExportError('Failed to download {0} file(s)'.format(len(self.failures)))
+        if self.complete_failures:
+            raise BIDSExportError('Failed to process {0} downloaded file(s)'.format(len(self.complete_failures)))
+
+    def abort(self):
+        """
+        Drop any queued jobs, wait for in-flight downloads and stop the workers without raising.
+        """
+        self._cancelled.set()
+        try:
+            self.close()
+        except BIDSExportError:
+            pass
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Drain the workers without masking the original exception
+            self.abort()
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                if not self._cancelled.is_set():
+                    self._download(job)
+            finally:
+                self.queue.task_done()
+
+    def _download(self, job):
+        limit = self.host_limits[self.host]
+        while True:
+            job.attempts += 1
+            try:
+                self._fetch(job, limit)
+                break
+            except Exception as err:
+                if job.attempts > self.retries:
+                    with self._lock:
+                        self.failures.append((job, err))
+                    self._remove_part(job)
+                    return
+                delay = self.retry_delay * (2 ** (job.attempts - 1))
+                logger.warning('Download of {0} failed ({1}), retrying in {2}s'.format(job.file_name, err, delay))
+                time.sleep(delay)
+
+        size = None
+        if not job.cached:
+            size = job.size if job.size is not None else _file_size(job.path)
+            if size and job.resumed_from:
+                size -= job.resumed_from
+        with self._lock:
+            self.completed += 1
+            self.bytes_downloaded += size or 0
+
+        if self.on_complete:
+            try:
+                self.on_complete(job)
+            except Exception as err:
+                with self._lock:
+                    self.complete_failures.append((job, err))
+
+    def _fetch(self, job, limit):
+        key = job.cache_key if self.cache is not None else None
+        if key is None:
+            with limit:
+                self._fetch_part(job)
+            return
+
+        # Cache hits don't count against the host limit
+        if self.cache.get(key, job.path):
+            job.cached = True
+            return
+        with limit:
+            self.cache.download(key, job.path, lambda path: download_file(self.fw, job, path))
+
+    def part_path(self, job):
+        """
+        Get the path a job is downloaded to before it is moved into place
+        """
+        if self.part_dir is None:
+            return job.part_path
+        return os.path.join(self.part_dir, job.part_name)
+
+    def _remove_part(self, job):
+        try:
+            os.remove(self.part_path(job))
+        except OSError:
+            pass
+
+    def _remove_orphaned_parts(self):
+        if self.part_dir is None or not os.path.isdir(self.part_dir):
+            return
+        for name in os.listdir(self.part_dir):
+            if name.endswith(PART_SUFFIX):
+                path = os.path.join(self.part_dir, name)
+                logger.debug('Removing orphaned partial download {0}'.format(path))
+                os.remove(path)
+
+    def _fetch_part(self, job):
+        """
+        Download to the job's part file, resuming an earlier partial download if possible,
+        then move the verified file into place
+        """
+        part_path = self.part_path(job)
+        offset = _file_size(part_path) if self.resume and job.cache_key else None
+
+        if offset and job.size is not None and offset > job.size:
+            offset = None
+        if self.part_dir is not None and not os.path.isdir(self.part_dir):
+            try:
+                os.makedirs(self.part_dir)
+            except OSError:
+                # Another worker created it first
+                if not os.path.isdir(self.part_dir):
+                    raise
+        download_file(self.fw, job, part_path, offset=offset)
+        replace_file(part_path, job.path)
@@ -0,0 +1,200 @@
+import collections
+import json
+import logging
+import os
+
+from .downloader import DownloadJob
+from .errors import BIDSExportError
+from .manifest import format_timestamp
+
+logger = logging.getLogger('bids-exporter')
+
+PLAN_VERSION = 1
+# Throughput assumed when no export into the directory has been measured yet (20 MiB/s)
+DEFAULT_THROUGHPUT = 20 * 1024 ** 2
+
+def _relpath(path, outdir):
+    return os.path.relpath(path, outdir)
+
+def _path_group(relpath):
+    """
+    Get the (subject, folder) of a path relative to the BIDS directory
+    """
+    parts = relpath.split(os.sep)
+    subject = parts[0] if len(parts) > 1 and parts[0].startswith('sub-') else None
+    folder = parts[-2] if len(parts) > 1 else None
+    return subject, folder
+
+class ExportPlan(object):
+    """
+    The files and sidecars an export will write, computed without downloading anything.
+
+    Paths are stored relative to the BIDS directory, so a plan made on one machine can be
+    executed into a different directory on another.
+
+    Args:
+        entries (list): The files to download, as dicts
+        sidecars (list): The sidecars to create, as dicts with path, meta_info and namespace
+        remove (list): Previously exported files to remove, relative to the BIDS directory
+        throughput (float): The download throughput used for the estimate, in bytes per second
+        options (dict): The export options the plan was made with
+    """
+    def __init__(self, entries=None, sidecars=None, remove=None, throughput=None, options=None):
+        self.entries = entries or []
+        self.sidecars = sidecars or []
+        self.remove = remove or []
+        self.throughput = throughput
+        self.options = options or {}
+
+    def add_job(self, job, outdir):
+        """
+        Add a DownloadJob to the plan
+        """
+        self.entries.append({
+            'container_type': job.container_type,
+            'container_id': job.container_id,
+            'file_name': job.file_name,
+            'path': _relpath(job.path, outdir),
+            'modified': format_timestamp(job.modified),
+            'file_id': job.file_id,
+            'hash': job.file_hash,
+            'size': job.size
+        })
+
+    def add_sidecar(self, sidecar, outdir):
+        """
+        Add a sidecar, as a tuple of create_json arguments, to the plan
+        """
+        meta_info, path, namespace = sidecar
+        self.sidecars.append({
+            'meta_info': meta_info,
+            'path': _relpath(path, outdir),
+            'namespace': namespace
+        })
+
+    def jobs(self, outdir, parse_timestamp):
+        """
+        Create the DownloadJobs of the plan.
+
+        Args:
+            outdir (str): The BIDS directory to download to
+            parse_timestamp (function): Parses a recorded modified timestamp
+
+        Returns:
+            list: The DownloadJobs
+        """
+        results = []
+        for entry in self.entries:
+            modified = entry.get('modified')
+            results.append(DownloadJob(entry['container_type'], entry['container_id'], entry['file_name'],
+                os.path.join(outdir, entry['path']), parse_timestamp(modified) if modified else None,
+                file_id=entry.get('file_id'), file_hash=entry.get('hash'), size=entry.get('size')))
+        return results
+
+    def sidecar_args(self, outdir):
+        """
+        Get the sidecars of the plan as tuples of create_json arguments
+        """
+        return [(dict(x['meta_info']), os.path.join(outdir, x['path']), x['namespace']) for x in self.sidecars]
+
+    def totals(self):
+        """
+        Sum up the planned files and bytes, overall and per subject and folder.
+
+        Returns:
+            dict: The totals, with bytes counting only files of known size
+        """
+        def new_total():
+            return {'files': 0, 'bytes': 0, 'unknown_size': 0}
+
+        overall = new_total()
+        subjects = collections.defaultdict(new_total)
+        folders = collections.defaultdict(new_total)
+        for entry in self.entries:
+            subject, folder = _path_group(entry['path'])
+            for total in (overall, subjects[subject or ''], folders[folder or '']):
+                total['files'] += 1
+                if entry.get('size') is None:
+                    total['unknown_size'] += 1
+                else:
+                    total['bytes'] += entry['size']
+
+        overall['sidecars'] = len(self.sidecars)
+        overall['remove'] = len(self.remove)
+        return {
+            'total': overall,
+            'subjects': dict(subjects),
+            'folders': dict(folders)
+        }
+
+    def estimate(self):
+        """
+        Estimate the download time of the plan.
+
+        Returns:
+            dict: The estimated seconds, and the throughput it is based on
+        """
+        throughput = self.throughput or DEFAULT_THROUGHPUT
+        num_bytes = self.totals()['total']['bytes']
+        return {
+            'seconds': num_bytes / float(throughput),
+            'bytes_per_second': throughput,
+            'measured': bool(self.throughput)
+        }
+
+    def to_dict(self):
+        return {
+            'version': PLAN_VERSION,
+            'options': self.options,
+            'files': self.entries,
+            'sidecars': self.sidecars,
+            'remove': self.remove,
+            'throughput': self.throughput,
+            'totals': self.totals(),
+            'estimate': self.estimate()
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        if data.get('version') != PLAN_VERSION:
+            raise BIDSExportError('Unsupported export plan version: {0}'.format(data.get('version')))
+        return cls(entries=data.get('files'), sidecars=data.get('sidecars'), remove=data.get('remove'),
+                throughput=data.get('throughput'), options=data.get('options'))
+
+    def save(self, path):
+        """
+        Write the plan to a JSON file
+        """
+        with open(path, 'w') as fp:
+            json.dump(self.to_dict(), fp, indent=2, sort_keys=True, default=str)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a plan from a JSON file
+
+        Raises:
+            BIDSExportError: If the file is not a valid plan
+        """
+        try:
+            with open(path, 'r') as fp:
+                data = json.load(fp)
+        except (IOError, ValueError) as err:
+            raise BIDSExportError('Could not read export plan {0}: {1}'.format(path, err))
+        return cls.from_dict(data)
+
+    def log_summary(self):
+        """
+        Log the totals and the estimated duration of the plan
+        """
+        totals = self.totals()
+        estimate = self.estimate()
+        total = totals['total']
+        logger.info('Export plan: {0} file(s), {1:.1f} MiB, {2} sidecar(s), {3} file(s) to remove'.format(
+            total['files'], total['bytes'] / 1024.0 ** 2, total['sidecars'], total['remove']))
+        for name in ('subjects', 'folders'):
+            for key, value in sorted(totals[name].items()):
+                logger.info('  {0} {1}: {2} file(s), {3:.1f} MiB'.format(name[:-1], key or '(top level)',
+                    value['files'], value['bytes'] / 1024.0 ** 2))
+        logger.info('Estimated download time: {0:.0f}s at {1:.1f} MiB/s ({2})'.format(estimate['seconds'],
+            estimate['bytes_per_second'] / 1024.0 ** 2, 'measured' if estimate['measured'] else 'default'))
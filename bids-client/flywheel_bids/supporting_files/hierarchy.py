@@ -0,0 +1,205 @@
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('bids-hierarchy')
+
+DEFAULT_MAX_WORKERS = 8
+
+def is_complete(container):
+    """
+    Check if a container returned by a listing call carries everything a full fetch would:
+    its own info, and the info of every file.
+
+    Args:
+        container: The container (dict or SDK model)
+
+    Returns:
+        bool: True if the container does not need to be fetched again
+    """
+    if container.get('info') is None:
+        return False
+    files = container.get('files')
+    if files is None:
+        return False
+    for f in files:
+        if f.get('info') is None:
+            return False
+    return True
+
+class HierarchyFetcher(object):
+    """
+    Fetches sessions and acquisitions, including their files and file info, in as few calls
+    as possible.
+
+    Listing calls are used wherever they return complete containers. Project acquisitions are
+    listed with a single call and grouped by session. Only containers that come back
+    incomplete are fetched one by one, a session at a time when that session's acquisitions
+    are first asked for, and those fetches run concurrently. Results are cached,
+    so export, curation and the gear scripts can share one fetcher per client.
+
+    Args:
+        fw: Flywheel client
+        max_workers (int): The number of concurrent fetches for incomplete containers
+
+    Attributes:
+        calls (int): The number of API calls made by this fetcher
+    """
+    def __init__(self, fw, max_workers=DEFAULT_MAX_WORKERS):
+        self.fw = fw
+        self.max_workers = max(1, max_workers)
+        self.calls = 0
+        self._projects = {}
+        self._project_session_ids = {}
+        self._sessions = {}
+        self._session_acquisitions = {}
+        self._listed_acquisitions = {}
+        self._acquisitions = {}
+        self._lock = threading.Lock()
+
+    def _call(self, name, *args):
+        with self._lock:
+            self.calls += 1
+        return getattr(self.fw, name)(*args)
+
+    def _complete(self, containers, getter):
+        """
+        Replace any incomplete container in the list with a full fetch, preserving order
+        """
+        missing = [i for i, c in enumerate(containers) if not is_complete(c)]
+        if not missing:
+            return list(containers)
+
+        results = list(containers)
+        ids = [containers[i]['_id'] for i in missing]
+        if len(ids) == 1:
+            fetched = [self._call(getter, ids[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(ids))) as executor:
+                fetched = list(executor.map(lambda cid: self._call(getter, cid), ids))
+        for i, container in zip(missing, fetched):
+            results[i] = container
+        return results
+
+    def get_project(self, project_id):
+        """
+        Get a project.
+
+        Args:
+            project_id (str): The project id
+
+        Returns:
+            The project, with files and info
+        """
+        if project_id not in self._projects:
+            self._projects[project_id] = self._call('get_project', project_id)
+        return self._projects[project_id]
+
+    def get_project_sessions(self, project_id, complete=True):
+        """
+        Get the sessions of a project.
+
+        Args:
+            project_id (str): The project id
+            complete (bool): If False, return the listing as is, and leave it to the caller
+                to complete only the sessions it needs with get_session
+
+        Returns:
+            list: The sessions
+        """
+        sessions = self._call('get_project_sessions', project_id)
+        if complete:
+            sessions = self._complete(sessions, 'get_session')
+        self._project_session_ids[project_id] = [x['_id'] for x in sessions]
+        for session in sessions:
+            if is_complete(session):
+                self._sessions[session['_id']] = session
+        return sessions
+
+    def get_session(self, session_id, listed=None):
+        """
+        Get a complete session.
+
+        Args:
+            session_id (str): The session id
+            listed: The session as returned by a listing call, used if it is complete
+
+        Returns:
+            The session, with files and info
+        """
+        if session_id not in self._sessions:
+            if listed is not None and is_complete(listed):
+                self._sessions[session_id] = listed
+            else:
+                self._sessions[session_id] = self._call('get_session', session_id)
+        return self._sessions[session_id]
+
+    def prefetch_project_acquisitions(self, project_id):
+        """
+        List every acquisition in a project with a single call, grouped by session.
+
+        Incomplete acquisitions are not fetched here, but by get_session_acquisitions, so that
+        walking the first sessions does not wait on fetches for the whole project.
+
+        Args:
+            project_id (str): The project id
+
+        Returns:
+            bool: False if the client does not support listing project acquisitions
+        """
+        if not hasattr(self.fw, 'get_project_acquisitions'):
+            return False
+
+        listed = {}
+        for acq in self._call('get_project_acquisitions', project_id):
+            listed.setdefault(acq.get('session'), []).append(acq)
+
+        # Listed sessions without acquisitions are known to be empty
+        for session_id in self._project_session_ids.get(project_id, []):
+            listed.setdefault(session_id, [])
+
+        for session_id, acquisitions in listed.items():
+            if session_id in self._session_acquisitions:
+                continue
+            if all(is_complete(acq) for acq in acquisitions):
+                self._cache_session_acquisitions(session_id, acquisitions)
+            else:
+                self._listed_acquisitions[session_id] = acquisitions
+        return True
+
+    def _cache_session_acquisitions(self, session_id, acquisitions):
+        for acq in acquisitions:
+            self._acquisitions[acq['_id']] = acq
+        self._session_acquisitions[session_id] = acquisitions
+
+    def get_session_acquisitions(self, session_id):
+        """
+        Get the complete acquisitions of a session.
+
+        Args:
+            session_id (str): The session id
+
+        Returns:
+            list: The acquisitions, with files and info
+        """
+        if session_id not in self._session_acquisitions:
+            listed = self._listed_acquisitions.pop(session_id, None)
+            if listed is None:
+                listed = self._call('get_session_acquisitions', session_id)
+            self._cache_session_acquisitions(session_id, self._complete(listed, 'get_acquisition'))
+        return self._session_acquisitions[session_id]
+
+    def get_acquisition(self, acquisition_id):
+        """
+        Get a complete acquisition.
+
+        Args:
+            acquisition_id (str): The acquisition id
+
+        Returns:
+            The acquisition, with files and info
+        """
+        if acquisition_id not in self._acquisitions:
+            self._acquisitions[acquisition_id] = self._call('get_acquisition', acquisition_id)
+        return self._acquisitions[acquisition_id]
@@ -0,0 +1,348 @@
+import json
+import logging
+import os
+import shutil
+import threading
+
+logger = logging.getLogger('bids-exporter')
+
+# The manifest is kept in a hidden directory, which BIDS tools ignore
+MANIFEST_DIR = '.bids_export'
+MANIFEST_FILE = 'manifest.json'
+JOURNAL_FILE = 'journal.jsonl'
+# Partial downloads are kept out of the BIDS tree
+PARTIAL_DIR = 'partial'
+MANIFEST_VERSION = 1
+
+def format_timestamp(timestamp):
+    """
+    Format a modified timestamp (datetime or string) for the manifest
+    """
+    if timestamp is None:
+        return None
+    if hasattr(timestamp, 'isoformat'):
+        return timestamp.isoformat()
+    return str(timestamp)
+
+class ExportManifest(object):
+    """
+    Record of the files written by previous exports into a BIDS directory.
+
+    Each exported file is recorded under its path relative to the BIDS directory, with its
+    Flywheel file id, modified timestamp, size and hash. Comparing these with the server
+    listing tells which files changed without looking at the files on disk, and which
+    exported files no longer exist upstream.
+
+    The manifest also keeps the download throughput measured by the last export, used to
+    estimate the duration of the next one.
+
+    While the journal is open, every recorded file is also appended to a journal file, so
+    files completed by an export that is interrupted before it saves the manifest are
+    known to the next export. The journal is replayed on load and cleared on save.
+
+    Args:
+        bids_dir (str): The BIDS directory
+        entries (dict): The recorded files, by relative path
+        stats (dict): Statistics of the last export
+    """
+    def __init__(self, bids_dir, entries=None, stats=None):
+        self.bids_dir = bids_dir
+        self.entries = entries or {}
+        self.stats = stats or {}
+        self.kept = set()
+        self.listed = set()
+        self._sidecars = {}
+        self._journal = None
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        return os.path.join(self.bids_dir, MANIFEST_DIR, MANIFEST_FILE)
+
+    @property
+    def journal_path(self):
+        return os.path.join(self.bids_dir, MANIFEST_DIR, JOURNAL_FILE)
+
+    @property
+    def partial_dir(self):
+        return os.path.join(self.bids_dir, MANIFEST_DIR, PARTIAL_DIR)
+
+    @classmethod
+    def load(cls, bids_dir):
+        """
+        Load the manifest of a BIDS directory.
+
+        Args:
+            bids_dir (str): The BIDS directory
+
+        Returns:
+            ExportManifest: The manifest, empty if none exists or it cannot be read
+        """
+        manifest = cls(bids_dir)
+        if os.path.isfile(manifest.path):
+            try:
+                with open(manifest.path, 'r') as fp:
+                    data = json.load(fp)
+                if data.get('version') == MANIFEST_VERSION:
+                    manifest.entries = data.get('files', {})
+                    manifest.stats = data.get('stats', {})
+                else:
+                    logger.warning('Ignoring manifest with unknown version: {0}'.format(data.get('version')))
+            except (IOError, ValueError) as err:
+                logger.warning('Ignoring unreadable manifest {0}: {1}'.format(manifest.path, err))
+        manifest._replay_journal()
+        return manifest
+
+    def _replay_journal(self):
+        if not os.path.isfile(self.journal_path):
+            return
+        count = 0
+        with open(self.journal_path, 'r') as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line may be cut short by the interruption
+                    break
+                self.entries[record['path']] = record['entry']
+                count += 1
+        logger.info('Recovered {0} file(s) from an interrupted export'.format(count))
+
+    def open_journal(self):
+        """
+        Start journaling recorded files, until the manifest is saved
+        """
+        dirname = os.path.dirname(self.journal_path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self._journal = open(self.journal_path, 'a')
+
+    def save(self):
+        """
+        Write the manifest, replacing the previous one atomically
+        """
+        dirname = os.path.dirname(self.path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        tmp_path = self.path + '.tmp'
+        with self._lock:
+            data = {'version': MANIFEST_VERSION, 'files': self.entries, 'stats': self.stats}
+            with open(tmp_path, 'w') as fp:
+                json.dump(data, fp, sort_keys=True, indent=2)
+            os.rename(tmp_path, self.path)
+
+            # Everything journaled is in the manifest now
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            if os.path.isfile(self.journal_path):
+                os.remove(self.journal_path)
+
+    def relpath(self, path):
+        return os.path.relpath(path, self.bids_dir)
+
+    def __contains__(self, path):
+        return self.relpath(path) in self.entries
+
+    def get(self, path):
+        """
+        Get the entry of the file at path, or None if it was not exported
+        """
+        return self.entries.get(self.relpath(path))
+
+    def is_current(self, path, f):
+        """
+        Check if the file at path was exported from the current version of the Flywheel file f.
+
+        Args:
+            path (str): The destination path
+            f (dict): The Flywheel file
+
+        Returns:
+            bool: True if the recorded file is up to date
+        """
+        entry = self.get(path)
+        if entry is None:
+            return False
+        if entry.get('hash') and f.get('hash'):
+            return entry['hash'] == f.get('hash')
+        file_id = f.get('file_id') or f.get('id')
+        if entry.get('file_id') and file_id and entry['file_id'] != file_id:
+            return False
+        return entry.get('modified') == format_timestamp(f.get('modified'))
+
+    def keep(self, path):
+        """
+        Mark the recorded file at path as part of the current export
+        """
+        with self._lock:
+            self.kept.add(self.relpath(path))
+
+    def mark_listed(self, path):
+        """
+        Mark the file at path as still listed in Flywheel, even if the current export filters
+        it out, so that it is not pruned
+        """
+        with self._lock:
+            self.listed.add(self.relpath(path))
+
+    def record(self, path, file_id=None, modified=None, size=None, file_hash=None, **kwargs):
+        """
+        Record a file written by the current export.
+
+        Args:
+            path (str): The destination path
+            file_id (str): The Flywheel file id
+            modified (datetime): The file modified timestamp
+            size (int): The file size, in bytes
+            file_hash (str): The file hash reported by the server
+            kwargs: Any other attributes to store on the entry
+        """
+        relpath = self.relpath(path)
+        entry = {
+            'file_id': file_id,
+            'modified': format_timestamp(modified),
+            'size': size,
+            'hash': file_hash
+        }
+        entry.update(kwargs)
+        with self._lock:
+            previous = self.entries.get(relpath, {})
+            # A skipped download keeps its previously written sidecar
+            if 'sidecar' in previous and 'sidecar' not in entry:
+                entry['sidecar'] = previous['sidecar']
+            # The sidecar may be written before the file is downloaded
+            if relpath in self._sidecars:
+                sidecar = self._sidecars.pop(relpath)
+                entry.pop('sidecar_pending', None)
+                if sidecar:
+                    entry['sidecar'] = sidecar
+            self.entries[relpath] = entry
+            self.kept.add(relpath)
+            if self._journal is not None:
+                self._journal.write(json.dumps({'path': relpath, 'entry': entry}) + '\n')
+                self._journal.flush()
+
+    def record_sidecar(self, path, sidecar_path=None):
+        """
+        Record that the sidecar of the file at path was created. If the file is not
+        recorded yet, the sidecar is recorded along with it.
+
+        Args:
+            path (str): The file path
+            sidecar_path (str): The sidecar path, or None if the file has no sidecar
+        """
+        relpath = self.relpath(path)
+        sidecar = self.relpath(sidecar_path) if sidecar_path else None
+        with self._lock:
+            entry = self.entries.get(relpath)
+            if entry is None or relpath not in self.kept:
+                self._sidecars[relpath] = sidecar
+            if entry is not None:
+                entry.pop('sidecar_pending', None)
+                if sidecar:
+                    entry['sidecar'] = sidecar
+
+    def is_sidecar_pending(self, path):
+        """
+        Check if the file at path was downloaded, but its sidecar was never created
+        (because the export was interrupted)
+        """
+        entry = self.get(path)
+        return bool(entry and entry.get('sidecar_pending'))
+
+    def record_job(self, job, sidecar_pending=False):
+        """
+        Record a completed DownloadJob. The hash computed while downloading the file is
+        recorded if the server did not report one.
+
+        Args:
+            job (DownloadJob): The downloaded file
+            sidecar_pending (bool): True if a sidecar will be created for the file
+        """
+        size = getattr(job, 'size', None)
+        if size is None and os.path.isfile(job.path):
+            size = os.path.getsize(job.path)
+        verified_hash = getattr(job, 'verified_hash', None)
+        extra = {}
+        if verified_hash:
+            extra['verified'] = True
+        if getattr(job, 'extracted_dir', None):
+            extra['extracted_dir'] = self.relpath(job.extracted_dir)
+        if sidecar_pending:
+            extra['sidecar_pending'] = True
+        self.record(job.path, file_id=job.file_id, modified=job.modified, size=size,
+                file_hash=job.file_hash or verified_hash, **extra)
+
+    def record_throughput(self, num_bytes, seconds):
+        """
+        Record the download throughput of the current export.
+
+        Args:
+            num_bytes (int): The number of bytes downloaded
+            seconds (float): The time spent downloading
+        """
+        if num_bytes <= 0 or seconds <= 0:
+            return
+        self.stats['throughput'] = {
+            'bytes': num_bytes,
+            'seconds': seconds,
+            'bytes_per_second': num_bytes / float(seconds)
+        }
+
+    @property
+    def throughput(self):
+        """
+        The download throughput of the last export in bytes per second, or None
+        """
+        return self.stats.get('throughput', {}).get('bytes_per_second')
+
+    def stale(self):
+        """
+        Get the recorded files that were neither part of the current export, nor listed in
+        Flywheel by it
+        """
+        return sorted(set(self.entries) - self.kept - self.listed)
+
+    def prune(self, dry_run=False):
+        """
+        Delete the recorded files that the current export did not find in Flywheel (see
+        stale), along with their sidecars and extracted archives, and drop them from the
+        manifest.
+
+        Args:
+            dry_run (bool): If True, only log what would be deleted
+
+        Returns:
+            list: The relative paths of the removed files
+        """
+        removed = self.stale()
+        for relpath in removed:
+            entry = self.entries[relpath]
+            logger.info('Removing {0}, which no longer exists in Flywheel'.format(relpath))
+            if dry_run:
+                continue
+
+            for key in ('sidecar', 'extracted_dir'):
+                if entry.get(key):
+                    entry_path = os.path.join(self.bids_dir, entry[key])
+                    if os.path.isdir(entry_path):
+                        shutil.rmtree(entry_path)
+                    elif os.path.isfile(entry_path):
+                        os.remove(entry_path)
+
+            path = os.path.join(self.bids_dir, relpath)
+            if os.path.isfile(path):
+                os.remove(path)
+            self._remove_empty_dirs(os.path.dirname(path))
+            with self._lock:
+                del self.entries[relpath]
+        return removed
+
+    def _remove_empty_dirs(self, dirname):
+        root = os.path.abspath(self.bids_dir)
+        dirname = os.path.abspath(dirname)
+        while dirname != root and dirname.startswith(root) and os.path.isdir(dirname) and not os.listdir(dirname):
+            os.rmdir(dirname)
+            dirname = os.path.dirname(dirname)
@@ -0,0 +1,404 @@
+import re
+import six
+
+from . import utils
+
+class Accessor(object):
+    """
+    Looks up a dotted path (i.e. "file.classification.Intent") in a context, with the path
+    split once up front.
+
+    Args:
+        path (str): The dotted path to look up
+    """
+    __slots__ = ('path', 'parts')
+
+    def __init__(self, path):
+        self.path = path
+        self.parts = path.split('.')
+
+    def __call__(self, obj, default=None):
+        return utils.lookup_parts(obj, self.parts, default)
+
+class EqualsMatch(object):
+    """ Matches a value equal to match, or a list containing it """
+    __slots__ = ('match',)
+
+    def __init__(self, match):
+        self.match = match
+
+    def __call__(self, value):
+        if isinstance(value, list):
+            for item in value:
+                if item == self.match:
+                    return True
+            return False
+        return value == self.match
+
+class InMatch(object):
+    """
+    Matches a value in values, a list with any item in values, or a string containing any
+    of values
+    """
+    __slots__ = ('values',)
+
+    def __init__(self, values):
+        self.values = values
+
+    def __call__(self, value):
+        if isinstance(value, list):
+            for item in value:
+                if item in self.values:
+                    return True
+            return False
+        elif isinstance(value, six.string_types):
+            for item in self.values:
+                if item in value:
+                    return True
+            return False
+        return value in self.values
+
+class NotMatch(object):
+    """ Negates a nested match """
+    __slots__ = ('match',)
+
+    def __init__(self, match):
+        self.match = match
+
+    def __call__(self, value):
+        return not self.match(value)
+
+class RegexMatch(object):
+    """ Matches a string, or a list with any item, that the regular expression matches """
+    __slots__ = ('regex',)
+
+    def __init__(self, pattern):
+        self.regex = re.compile(pattern)
+
+    def __call__(self, value):
+        if isinstance(value, list):
+            for item in value:
+                if self.regex.search(item) is not None:
+                    return True
+            return False
+        if value is None:
+            return False
+        return self.regex.search(value) is not None
+
+class NeverMatch(object):
+    """ A match object without a known operator, which matches nothing """
+    __slots__ = ()
+
+    def __call__(self, value):
+        return False
+
+def compile_match(match):
+    """
+    Compile a value match specification into a callable that tests values.
+
+    Args:
+        match: The match spec: a value to compare to, or a dict with one of the
+            "$in", "$not" or "$regex" operators.
+
+    Returns:
+        function: A callable taking the value to test, and returning a bool
+    """
+    if isinstance(match, dict):
+        if '$in' in match:
+            return InMatch(match['$in'])
+        elif '$not' in match:
+            return NotMatch(compile_match(match['$not']))
+        elif '$regex' in match:
+            return RegexMatch(match['$regex'])
+        return NeverMatch()
+    return EqualsMatch(match)
+
+class FieldCondition(object):
+    """ Tests the value at the path of a context field """
+    __slots__ = ('accessor', 'match')
+
+    def __init__(self, field, match):
+        self.accessor = Accessor(field)
+        self.match = compile_match(match)
+
+    def __call__(self, context):
+        return self.match(self.accessor(context))
+
+class AnyCondition(object):
+    """ Tests that any of the nested conditions is true ($or) """
+    __slots__ = ('conditions',)
+
+    def __init__(self, conditions):
+        self.conditions = conditions
+
+    def __call__(self, context):
+        for condition in self.conditions:
+            if condition(context):
+                return True
+        return False
+
+class AllCondition(object):
+    """ Tests that all of the nested conditions are true ($and) """
+    __slots__ = ('conditions',)
+
+    def __init__(self, conditions):
+        self.conditions = conditions
+
+    def __call__(self, context):
+        for condition in self.conditions:
+            if not condition(context):
+                return False
+        return True
+
+class WhereClause(AllCondition):
+    """
+    A compiled where clause: a set of conditions that must all be true for a context to
+    match. Paths are split and regular expressions compiled once, when the clause is
+    created, rather than every time a context is tested.
+
+    Top-level "$or" and "$and" conditions take either a dict of field conditions, or a list
+    of where clauses, which are tested in order.
+
+    Args:
+        conditions (dict): The where clause, a map of context fields to match specs
+
+    Attributes:
+        conditions (list): The compiled conditions, in order
+    """
+    __slots__ = ()
+
+    def __init__(self, conditions):
+        AllCondition.__init__(self, [compile_condition(field, match) for field, match in conditions.items()])
+
+    def test(self, context):
+        return self(context)
+
+def compile_condition(field, match):
+    """
+    Compile one condition of a where clause
+    """
+    if field == '$or' or field == '$and':
+        if isinstance(match, dict):
+            nested = [FieldCondition(key, value) for key, value in match.items()]
+        else:
+            nested = [WhereClause(clause) for clause in match]
+        if field == '$or':
+            return AnyCondition(nested)
+        return AllCondition(nested)
+    return FieldCondition(field, match)
+
+class ValueInitializer(object):
+    """
+    Initializes a property from a context field: the "value" group of the first of its
+    "$regex" patterns that matches, or the value itself with "$take", optionally formatted
+    with "$format".
+    """
+    __slots__ = ('accessor', 'regexes', 'take', 'has_format', 'format')
+
+    def __init__(self, key, spec):
+        self.accessor = Accessor(key)
+        if not isinstance(spec, dict):
+            spec = {}
+        self.regexes = None
+        if '$regex' in spec:
+            regex_list = spec['$regex']
+            if not isinstance(regex_list, list):
+                regex_list = [regex_list]
+            self.regexes = [re.compile(regex) for regex in regex_list]
+        self.take = bool('$take' in spec and spec['$take'])
+        self.has_format = '$format' in spec
+        self.format = spec.get('$format')
+
+class SwitchInitializer(object):
+    """
+    Initializes a property with the "$value" of the first "$cases" entry that is equal to
+    the context field "$on", or that is the "$default"
+    """
+    __slots__ = ('accessor', 'cases')
+
+    def __init__(self, switch):
+        self.accessor = Accessor(switch['$on'])
+        self.cases = []
+        for case in switch['$cases']:
+            comp_value = case.get('$eq')
+            if isinstance(comp_value, list):
+                comp_value = set(comp_value)
+            self.cases.append(('$default' in case, comp_value, case.get('$value')))
+
+    def __call__(self, context):
+        value = self.accessor(context)
+        if isinstance(value, list):
+            value = set(value)
+
+        for is_default, comp_value, result in self.cases:
+            if is_default or value == comp_value:
+                return result
+        return None
+
+class Initializers(object):
+    """
+    A compiled set of property initializers (see templates.apply_initializers)
+
+    Args:
+        initializers (dict): The initializer specifications, by property name
+    """
+    __slots__ = ('properties',)
+
+    def __init__(self, initializers):
+        self.properties = []
+        for name, definition in initializers.items():
+            if isinstance(definition, dict):
+                if '$switch' in definition:
+                    self.properties.append((name, SwitchInitializer(definition['$switch'])))
+                else:
+                    self.properties.append((name, [ValueInitializer(key, spec)
+                        for key, spec in definition.items()]))
+            else:
+                self.properties.append((name, definition))
+
+    def apply(self, info, context):
+        """
+        Set the properties that resolve from context on info.
+
+        Args:
+            info (dict): The BIDS data to update
+            context (dict): The full context object
+        """
+        for name, definition in self.properties:
+            resolved = None
+
+            if isinstance(definition, SwitchInitializer):
+                resolved = definition(context)
+            elif isinstance(definition, list):
+                for spec in definition:
+                    value = spec.accessor(context)
+                    if value is None:
+                        continue
+
+                    if spec.regexes is not None:
+                        # Regex matching must provide a 'value' group
+                        for regex in spec.regexes:
+                            m = regex.search(value)
+                            if m is not None:
+                                resolved = m.group('value')
+                                break
+                    elif spec.take:
+                        resolved = value
+
+                    if spec.has_format and resolved:
+                        resolved = utils.format_value(spec.format, resolved)
+
+                    if resolved:
+                        break
+            else:
+                resolved = definition
+
+            if resolved:
+                info[name] = resolved
+
+# The context fields rules are indexed on (see RuleIndex)
+INDEX_FIELDS = ('container_type', 'parent_container_type', 'file.type', 'ext')
+
+class FieldIndex(object):
+    """
+    The conditions of a set of rules on one context field, grouped so each distinct
+    condition is tested once per context.
+
+    Args:
+        field (str): The context field
+    """
+    __slots__ = ('accessor', 'constrained', 'equals', 'equals_mask', 'matches')
+
+    def __init__(self, field):
+        self.accessor = Accessor(field)
+        # Bitmask of the rules with a condition on this field
+        self.constrained = 0
+        # Rules by the (hashable) value they are equal to, and their combined bitmask
+        self.equals = {}
+        self.equals_mask = 0
+        # Other distinct matches, keyed by their spec, as [match, bitmask]
+        self.matches = {}
+
+    def add(self, bit, match):
+        self.constrained |= bit
+        if not isinstance(match, (dict, list)):
+            try:
+                self.equals[match] = self.equals.get(match, 0) | bit
+                self.equals_mask |= bit
+                return
+            except TypeError:
+                pass
+        key = repr(match)
+        if key not in self.matches:
+            self.matches[key] = [compile_match(match), 0]
+        self.matches[key][1] |= bit
+
+    def excluded(self, context):
+        """
+        Get the bitmask of the rules whose condition on this field does not match context
+        """
+        value = self.accessor(context)
+        excluded = 0
+        if self.equals_mask:
+            try:
+                if isinstance(value, list):
+                    raise TypeError()
+                excluded |= self.equals_mask & ~self.equals.get(value, 0)
+            except TypeError:
+                # Lists (and unhashable values) are compared one by one
+                for match, bit in self.equals.items():
+                    if not EqualsMatch(match)(value):
+                        excluded |= bit
+        for match, bit in self.matches.values():
+            if not match(value):
+                excluded |= bit
+        return excluded
+
+class RuleIndex(object):
+    """
+    Selects the rules that may match a context, without testing every rule.
+
+    The top-level conditions of the rules on a few discriminating fields (such as
+    container_type and file.type) are grouped, so that each distinct condition is tested
+    once per context and rules with a failing condition are skipped. Equality conditions are
+    looked up by value. The remaining rules are returned in their original order, and still
+    need to be tested: the index only rules out rules that cannot match.
+
+    Args:
+        rules (list): The rules, in priority order
+        fields (list): The context fields to index on
+    """
+    __slots__ = ('rules', 'fields', 'all')
+
+    def __init__(self, rules, fields=INDEX_FIELDS):
+        self.rules = list(rules)
+        self.all = (1 << len(self.rules)) - 1
+        indexes = dict((field, FieldIndex(field)) for field in fields)
+        for i, rule in enumerate(self.rules):
+            for field, match in rule.conditions.items():
+                if field in indexes:
+                    indexes[field].add(1 << i, match)
+        self.fields = [index for index in indexes.values() if index.constrained]
+
+    def candidates(self, context):
+        """
+        Get the rules that may match context.
+
+        Args:
+            context (dict): The context to match
+
+        Returns:
+            list: The candidate rules, in priority order
+        """
+        mask = self.all
+        for index in self.fields:
+            mask &= ~index.excluded(context)
+            if not mask:
+                return []
+
+        result = []
+        while mask:
+            low = mask & -mask
+            result.append(self.rules[low.bit_length() - 1])
+            mask ^= low
+        return result
@@ -1,15 +1,24 @@
 import collections
 import logging
-import copy
+import mmap
+import pickle
 import sys
 
 if __name__ == '__main__':
     import utils
+    from hierarchy import HierarchyFetcher
+    from tracking import TrackedDict
 else:
     from . import utils
+    from .hierarchy import HierarchyFetcher
+    from .tracking import TrackedDict
 
 logger = logging.getLogger('curate-bids')
 
+# Leading bytes of project tree snapshot files
+SNAPSHOT_MAGIC = b'FWBIDS-TREE\n'
+SNAPSHOT_VERSION = 1
+
 class TreeNode(collections.MutableMapping):
     """
     Represents a single node (Project, Session, Acquisition or File) in
@@ -29,10 +38,30 @@ class TreeNode(collections.MutableMapping):
         self.type = node_type
         self.data = data
         self.children = []
-   
-        # save a copy of original info object so we know when
-        # we need to do an update
-        self.original_info = copy.deepcopy(self.data.get('info'))
+
+        # track changes to the info object so we know when we
+        # need to do an update, without copying it
+        info = self.data.get('info')
+        if type(info) is dict or (isinstance(info, TrackedDict) and not info.is_root):
+            info = self.data['info'] = TrackedDict(info)
+        self._info = info
+        self._ext = None
+
+    @property
+    def extension(self):
+        """
+        The extension of the node name (see utils.get_extension), computed once per name
+        """
+        name = self.data['name']
+        if self._ext is None or self._ext[0] != name:
+            self._ext = (name, utils.get_extension(name))
+        return self._ext[1]
+
+    @property
+    def original_info(self):
+        if isinstance(self._info, TrackedDict):
+            return self._info.original()
+        return self._info
 
     def is_dirty(self):
         """
@@ -42,7 +71,38 @@ class TreeNode(collections.MutableMapping):
             bool: True if info has been modified, False if it is unchanged
         """
         info = self.data.get('info')
-        return info != self.original_info
+        if isinstance(self._info, TrackedDict):
+            if info is self._info:
+                return self._info.is_changed()
+            return info != self._info.original()
+        return info != self._info
+
+    def info_changes(self):
+        """
+        Get the changes made to 'info', as top-level keys to set and to delete.
+
+        Returns:
+            dict: The changes, with 'set' (dict) and 'delete' (list) entries, each only
+                present if not empty. None if info is not a dict.
+        """
+        info = self.data.get('info')
+        if not isinstance(info, dict):
+            return None
+        if isinstance(self._info, TrackedDict) and info is self._info:
+            keys = info.changed_keys()
+        else:
+            original = self.original_info if isinstance(self.original_info, dict) else {}
+            keys = [key for key in set(info) | set(original)
+                    if key not in info or key not in original or info[key] != original[key]]
+
+        changes = {}
+        values = dict((key, info[key]) for key in keys if key in info)
+        if values:
+            changes['set'] = values
+        deleted = sorted(key for key in keys if key not in info)
+        if deleted:
+            changes['delete'] = deleted
+        return changes
 
     def to_json(self):
         return {
@@ -51,11 +111,11 @@ class TreeNode(collections.MutableMapping):
             'children': [ x.to_json() for x in self.children ]
         }
 
-    @staticmethod
+    @classmethod
     def from_json(cls, data):
-        node = TreeNode(data['type'], data['data'])
+        node = cls(data['type'], data['data'])
         for child in data.get('children', []):
-            node.children.append(TreeNode.from_json(child))
+            node.children.append(cls.from_json(child))
         return node
 
     def context_iter(self, context=None):
@@ -81,7 +141,7 @@ class TreeNode(collections.MutableMapping):
 
         # Additionally bring ext up if file
         if self.type == 'file':
-            context['ext'] = utils.get_extension(self.data['name'])
+            context['ext'] = self.extension
 
         # Yield the current context before processing children
         yield context
@@ -113,6 +173,82 @@ class TreeNode(collections.MutableMapping):
     def __repr__(self):
         return repr(self.data)
 
+def save_snapshot(node, path):
+    """
+    Save a tree to a snapshot file, which load_snapshot reads back.
+
+    Snapshots are a stream of pickled (depth, type, data) records, one for each node
+    depth-first, so they can be written and read without building an intermediate copy
+    of the tree. Objects shared between nodes (such as file entries, which are both in
+    their parent's files and in their own node) stay shared.
+
+    Args:
+        node (TreeNode): The root node of the tree
+        path (str): The snapshot file to write
+    """
+    with open(path, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+        pickler.dump(SNAPSHOT_VERSION)
+        stack = [(0, node)]
+        while stack:
+            depth, current = stack.pop()
+            pickler.dump((depth, current.type, current.data))
+            stack.extend((depth + 1, child) for child in reversed(current.children))
+
+def iter_snapshot(path):
+    """
+    Read the records of a snapshot file, memory-mapped.
+
+    Snapshots are pickles: only load snapshots you created.
+
+    Args:
+        path (str): The snapshot file
+
+    Yields:
+        tuple: The (depth, type, data) of each node, depth-first
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise ValueError('Not a project tree snapshot: {0}'.format(path))
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        data.seek(len(SNAPSHOT_MAGIC))
+        unpickler = pickle.Unpickler(data)
+        version = unpickler.load()
+        if version != SNAPSHOT_VERSION:
+            raise ValueError('Unsupported project tree snapshot version: {0}'.format(version))
+        while data.tell() < data.size():
+            yield unpickler.load()
+    finally:
+        data.close()
+
+def load_snapshot(path):
+    """
+    Load a tree from a snapshot file (see save_snapshot).
+
+    Args:
+        path (str): The snapshot file
+
+    Returns:
+        TreeNode: The root node of the tree
+    """
+    root = None
+    parents = []
+    for depth, node_type, data in iter_snapshot(path):
+        node = TreeNode(node_type, data)
+        del parents[depth:]
+        if parents:
+            parents[-1].children.append(node)
+        elif root is None:
+            root = node
+        else:
+            raise ValueError('Project tree snapshot has more than one root: {0}'.format(path))
+        parents.append(node)
+    if root is None:
+        raise ValueError('Project tree snapshot is empty: {0}'.format(path))
+    return root
+
 def add_file_nodes(parent):
     """
     Add file nodes as children to parent.
@@ -123,7 +259,7 @@ def add_file_nodes(parent):
     for f in parent.get('files', []):
         parent.children.append(TreeNode('file', f))
 
-def get_project_tree(fw, project_id, session_id=None, session_only=False):
+def get_project_tree(fw, project_id, session_id=None, session_only=False, fetcher=None):
     """
     Construct a project tree from the given project_id.
 
@@ -132,6 +268,7 @@ def get_project_tree(fw, project_id, session_id=None, session_only=False):
         project_id (str): project id of project to curate
         session_id (str): Optional session_id if session_only
         session_only (bool): Set to true to only get session identified by session_id
+        fetcher (HierarchyFetcher): Optional fetcher to share with other consumers
 
     Returns:
         TreeNode: The project (root) tree node
@@ -144,30 +281,36 @@ def get_project_tree(fw, project_id, session_id=None, session_only=False):
     else:
         session_id = None
 
+    if fetcher is None:
+        fetcher = HierarchyFetcher(fw)
+
     # Get project
     logger.info('Getting project...')
-    project_data = to_dict(fw, fw.get_project(project_id))
+    project_data = to_dict(fw, fetcher.get_project(project_id))
     project_node = TreeNode('project', project_data)
     add_file_nodes(project_node)
 
     # Get project sessions
-    project_sessions = fw.get_project_sessions(project_id)
+    project_sessions = fetcher.get_project_sessions(project_id, complete=False)
+    # Get every acquisition in the project at once, unless only one session is needed
+    if not session_id:
+        fetcher.prefetch_project_acquisitions(project_id)
+
     for proj_ses in project_sessions:
         if session_id and session_id != proj_ses['_id']:
             continue
 
-        session_data = to_dict(fw, fw.get_session(proj_ses['_id']))
+        session_data = to_dict(fw, fetcher.get_session(proj_ses['_id'], listed=proj_ses))
         session_node = TreeNode('session', session_data)
         add_file_nodes(session_node)
 
         project_node.children.append(session_node)
 
-        # Get acquisitions within session
-        session_acqs = fw.get_session_acquisitions(proj_ses['_id'])
+        # Get acquisitions within session, with their files and file info
+        session_acqs = fetcher.get_session_acquisitions(proj_ses['_id'])
 
         for ses_acq in sorted(session_acqs, key=AcquisitionSortKey):
-            # Get true acquisition, in order to access file info
-            acquisition_data = to_dict(fw, fw.get_acquisition(ses_acq['_id']))
+            acquisition_data = to_dict(fw, ses_acq)
             acquisition_node = TreeNode('acquisition', acquisition_data)
             add_file_nodes(acquisition_node)
 
@@ -198,18 +341,22 @@ class AcquisitionSortKey(object):
         return int((self.acq['created'] - other.acq['created']).total_seconds())
 
 def to_dict(fw, obj):
-    return fw.api_client.sanitize_for_serialization(obj.to_dict())
+    if hasattr(obj, 'to_dict'):
+        obj = obj.to_dict()
+    return fw.api_client.sanitize_for_serialization(obj)
 
 if __name__ == '__main__':
     import argparse
     import flywheel
     import json
 
-    parser = argparse.ArgumentParser(description='Dump project tree to json')
+    parser = argparse.ArgumentParser(description='Dump project tree to json, or to a snapshot')
     parser.add_argument('--api-key', dest='api_key', action='store',
             required=True, help='API key')
     parser.add_argument('-p', dest='project_label', action='store',
             required=False, default=None, help='Project Label on Flywheel instance')
+    parser.add_argument('--snapshot', dest='snapshot', action='store_true',
+            default=False, help='Write a binary snapshot (for curate_bids --snapshot) instead of json')
     parser.add_argument('output_file', help='The output file destination')
 
     args = parser.parse_args()
@@ -219,6 +366,9 @@ if __name__ == '__main__':
 
     project_tree = get_project_tree(fw, project_id)
 
-    with open(args.output_file, 'w') as f:
-        json.dump(project_tree.to_json(), f, indent=2)
+    if args.snapshot:
+        save_snapshot(project_tree, args.output_file)
+    else:
+        with open(args.output_file, 'w') as f:
+            json.dump(project_tree.to_json(), f, indent=2)
 
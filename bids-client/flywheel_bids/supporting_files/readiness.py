@@ -0,0 +1,227 @@
+import logging
+import os
+import threading
+
+from .manifest import MANIFEST_DIR
+
+logger = logging.getLogger('bids-exporter')
+
+READY_DIR = 'ready'
+READY_SUFFIX = '.ready'
+# The folder a subject can be processed from before the rest of its files are in place
+EARLY_FOLDER = 'anat'
+
+def path_group(bids_dir, path):
+    """
+    Get the (subject, folder) group of a path in the BIDS directory.
+    Files outside of a subject directory are in the (None, None) group.
+    """
+    parts = os.path.relpath(path, bids_dir).split(os.sep)
+    if len(parts) < 2 or not parts[0].startswith('sub-'):
+        return None, None
+    return parts[0], parts[-2] if len(parts) > 2 else None
+
+class _Group(object):
+    def __init__(self):
+        self.pending = set()
+        self.sidecars = []
+        self.sealed = False
+        self.done = False
+
+class ReadinessTracker(object):
+    """
+    Signals when all files of a subject, or of its anat folders, are in place, so processing
+    can start before the rest of the export finishes.
+
+    Files are grouped by subject and folder. The walk registers every path it maps, and
+    expects the paths it downloads. A group is done once the walk is past it (it is sealed)
+    and every expected download in it completed. A subject's anat folders are ready when
+    their groups and the top-level files (such as dataset_description.json) are done, and
+    the subject is ready when all of its groups are.
+
+    Sidecars are written as the walk adds them, except for top-level sidecars, which are
+    held until the top-level group is sealed. The walk only seals groups once everything
+    it mapped so far is valid, so a failed export doesn't leave a dataset_description.json.
+
+    Readiness is signalled with an empty marker file per subject (sub-01.ready) and anat
+    folder (sub-01_anat.ready) in the ready directory of the export manifest, and with the
+    on_ready callback. The markers of a subject are removed as soon as the walk maps a file
+    into it, so the markers of subjects that this export does not rewrite (such as those of
+    containers exported earlier in the same batch) are left alone.
+
+    Args:
+        bids_dir (str): The BIDS directory
+        write_sidecars (function): Creates a list of sidecars (create_json argument tuples).
+            If None, sidecars are created by the caller and nothing is signalled until finish.
+            It is called from the thread that adds sidecars and seals groups.
+        on_ready (function): Called with (subject, folder) once ready, where folder is 'anat'
+            or None for the whole subject. It is called from download threads.
+
+    Attributes:
+        ready (list): The (subject, folder) tuples signalled so far, in order
+    """
+    def __init__(self, bids_dir, write_sidecars=None, on_ready=None):
+        self.bids_dir = bids_dir
+        self.write_sidecars = write_sidecars
+        self.on_ready = on_ready
+        self.ready = []
+        self._groups = {}
+        self._signalled = set()
+        self._lock = threading.Lock()
+
+    @property
+    def ready_dir(self):
+        return os.path.join(self.bids_dir, MANIFEST_DIR, READY_DIR)
+
+    def marker_path(self, subject, folder=None):
+        """
+        Get the path of the readiness marker of a subject, or of its folder
+        """
+        name = subject if folder is None else '{0}_{1}'.format(subject, folder)
+        return os.path.join(self.ready_dir, name + READY_SUFFIX)
+
+    def start(self, clear=False):
+        """
+        Create the ready directory.
+
+        Args:
+            clear (bool): Remove the markers of every subject, for an export that rewrites
+                the whole directory
+        """
+        if not os.path.isdir(self.ready_dir):
+            os.makedirs(self.ready_dir)
+            return
+        if clear:
+            for name in os.listdir(self.ready_dir):
+                os.remove(os.path.join(self.ready_dir, name))
+
+    def _clear_markers(self, subject):
+        for folder in (None, EARLY_FOLDER):
+            path = self.marker_path(subject, folder)
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def _group(self, path):
+        key = path_group(self.bids_dir, path)
+        group = self._groups.get(key)
+        if group is None:
+            if key[0] is not None and not any(subject == key[0] for subject, folder in self._groups):
+                # The subject is rewritten, so it isn't ready until signalled again
+                self._clear_markers(key[0])
+            group = self._groups[key] = _Group()
+        elif group.sealed and key[0] in self._signalled_subjects():
+            logger.warning('{0} was mapped after {1} was signalled ready'.format(path, key[0]))
+        return group
+
+    def _signalled_subjects(self):
+        return set(subject for subject, folder in self._signalled)
+
+    def register(self, path):
+        """
+        Register a path mapped by the walk, whether or not it is downloaded
+        """
+        with self._lock:
+            self._group(path)
+
+    def expect(self, path):
+        """
+        Register a path that is being downloaded
+        """
+        with self._lock:
+            self._group(path).pending.add(path)
+
+    def add_sidecar(self, sidecar):
+        """
+        Write a sidecar, given as a tuple of create_json arguments. Top-level sidecars are
+        held until the top-level group is sealed.
+        """
+        key = path_group(self.bids_dir, sidecar[1])
+        with self._lock:
+            group = self._group(sidecar[1])
+            if key == (None, None) and not group.sealed:
+                group.sidecars.append(sidecar)
+                return
+        self.write_sidecars([sidecar])
+
+    def complete(self, path):
+        """
+        Mark an expected download as complete
+        """
+        with self._lock:
+            key = path_group(self.bids_dir, path)
+            group = self._groups.get(key)
+            if group is None:
+                return
+            group.pending.discard(path)
+        self._release()
+
+    def seal(self, folder=None):
+        """
+        Mark the groups registered so far as complete, meaning the walk will not map
+        more files into them.
+
+        Args:
+            folder (str): If given, only seal the groups of this folder, and the top-level files
+        """
+        self._seal(lambda subject, group_folder: folder is None or subject is None or group_folder == folder)
+        self._release()
+
+    def finish(self):
+        """
+        Seal every group and signal whatever is ready, once every download has finished
+        """
+        self._seal(lambda subject, group_folder: True)
+        self._release(final=True)
+
+    def _seal(self, matches):
+        held = []
+        with self._lock:
+            for (subject, group_folder), group in self._groups.items():
+                if matches(subject, group_folder):
+                    group.sealed = True
+                    held.extend(group.sidecars)
+                    group.sidecars = []
+        if held and self.write_sidecars is not None:
+            self.write_sidecars(held)
+
+    def _release(self, final=False):
+        if self.write_sidecars is None and not final:
+            return
+
+        with self._lock:
+            released = False
+            for group in self._groups.values():
+                if group.sealed and not group.pending and not group.done:
+                    group.done = True
+                    released = True
+
+        if released:
+            self._signal()
+
+    def _signal(self):
+        with self._lock:
+            top_level = self._groups.get((None, None))
+            if top_level is not None and not top_level.done:
+                return
+
+            subjects = {}
+            for (subject, folder), group in self._groups.items():
+                if subject is not None:
+                    subjects.setdefault(subject, []).append((folder, group))
+
+            signals = []
+            for subject, groups in sorted(subjects.items()):
+                early = [group for folder, group in groups if folder == EARLY_FOLDER]
+                if early and all(group.done for group in early) and (subject, EARLY_FOLDER) not in self._signalled:
+                    signals.append((subject, EARLY_FOLDER))
+                if all(group.done for folder, group in groups) and (subject, None) not in self._signalled:
+                    signals.append((subject, None))
+            self._signalled.update(signals)
+
+        for subject, folder in signals:
+            logger.info('{0} is ready'.format(subject if folder is None else '{0}/{1}'.format(subject, folder)))
+            with open(self.marker_path(subject, folder), 'w'):
+                pass
+            self.ready.append((subject, folder))
+            if self.on_ready:
+                self.on_ready(subject, folder)
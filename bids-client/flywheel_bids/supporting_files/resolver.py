@@ -1,6 +1,10 @@
+import itertools
 import re
 from . import utils
 
+# Filters expanding to more value combinations than this are tested against every context
+MAX_FILTER_COMBINATIONS = 64
+
 class Filter:
     """
     Simple wrapper for a matching filter that can be applied to a context.
@@ -33,6 +37,124 @@ class Filter:
         return True
 
 
+class ContextIndex(object):
+    """
+    The contexts of a node and its children (i.e. a session), indexed by the values of the
+    fields that resolver filters test, so that resolving does not walk the whole node for
+    every context it resolves.
+
+    Contexts are captured as they are produced by context_iter. Values are indexed the first
+    time a set of fields is filtered on, and reindexed after a resolver updates one of them.
+
+    Args:
+        node (TreeNode): The node to index
+    """
+    def __init__(self, node):
+        self.node = node
+        self.contexts = [dict(ctx) for ctx in node.context_iter()]
+        self._maps = {}
+
+    def _map(self, fields):
+        """
+        Get the positions of contexts by their values of fields, and the positions of the
+        contexts with unhashable values
+        """
+        result = self._maps.get(fields)
+        if result is None:
+            by_value = {}
+            unhashable = []
+            for i, ctx in enumerate(self.contexts):
+                key = tuple(utils.dict_lookup(ctx, field) for field in fields)
+                try:
+                    by_value.setdefault(key, []).append(i)
+                except TypeError:
+                    unhashable.append(i)
+            result = self._maps[fields] = (by_value, unhashable)
+        return result
+
+    def positions(self, filt):
+        """
+        Get the positions of the contexts that may pass a filter, in order. Every context
+        that passes is included.
+        """
+        fields = tuple(sorted(filt.fields))
+        options = []
+        count = 1
+        for field in fields:
+            value = filt.fields[field]
+            values = value if isinstance(value, list) else [value]
+            options.append(values)
+            count *= len(values)
+        if count > MAX_FILTER_COMBINATIONS:
+            return range(len(self.contexts))
+
+        by_value, unhashable = self._map(fields)
+        result = list(unhashable)
+        for key in itertools.product(*options):
+            try:
+                result.extend(by_value.get(key, ()))
+            except TypeError:
+                # Unhashable filter values are compared with every context
+                return range(len(self.contexts))
+        return sorted(set(result))
+
+    def matches(self, filters):
+        """
+        Get the contexts that pass filters, in order, once for each filter they pass.
+
+        Args:
+            filters (list(Filter)): The filters to apply
+
+        Returns:
+            list(dict): The matching contexts
+        """
+        positions = set()
+        for filt in filters:
+            positions.update(self.positions(filt))
+
+        results = []
+        for i in sorted(positions):
+            ctx = self.contexts[i]
+            for filt in filters:
+                if filt.test(ctx):
+                    results.append(ctx)
+        return results
+
+    def invalidate(self, path):
+        """
+        Drop the indexes on fields at or below a changed path, or above it
+        """
+        for fields in list(self._maps):
+            for field in fields:
+                if field == path or field.startswith(path + '.') or path.startswith(field + '.'):
+                    del self._maps[fields]
+                    break
+
+class ResolutionIndex(object):
+    """
+    The context indexes shared by the resolvers of a resolution pass (see ContextIndex),
+    one for each node that is resolved for.
+    """
+    def __init__(self):
+        self._indexes = {}
+
+    def get(self, node):
+        """
+        Get the index of a node, building it the first time
+        """
+        index = self._indexes.get(id(node))
+        if index is None or index.node is not node:
+            index = self._indexes[id(node)] = ContextIndex(node)
+        return index
+
+    def invalidate(self, path):
+        """
+        Drop indexes on a path that was updated, in every node
+        """
+        for index in self._indexes.values():
+            index.invalidate(path)
+
+
 class Resolver:
     """
     Compiled resolver rule
@@ -66,12 +188,14 @@ class Resolver:
         if self.format and self.value:
             print('WARNING: Because "format" is specified, "value" will be ignored for resolver: {}'.format(self.id))
 
-    def resolve(self, context):
+    def resolve(self, context, index=None):
         """
         Resolve update_field for context by matching and formatting children of session.
 
         Args:
             context (dict): The context to update
+            index (ResolutionIndex): The index of contexts to resolve from, shared by the
+                resolvers of a resolution pass. If not given, one is built for this call.
         """
         results = []
 
@@ -93,19 +217,21 @@ class Resolver:
                 fields[key] = v
             filters.append(Filter(fields))
 
+        if index is None:
+            index = ResolutionIndex()
+
         # Iterate through the contexts in the session, collecting matches
-        for ctx in parent.context_iter():
-            for filt in filters:
-                if filt.test(ctx):
-                    if self.format:
-                        results.append(utils.process_string_template(self.format, ctx))
-                    elif self.value:
-                        value = utils.dict_lookup(ctx, self.value, None)
-                        if value:
-                            if results and results != value:
-                                print('WARNING: multiple different matches when resolving results, will take last match!')
-                            results = value
-        
+        for ctx in index.get(parent).matches(filters):
+            if self.format:
+                results.append(utils.process_string_template(self.format, ctx))
+            elif self.value:
+                value = utils.dict_lookup(ctx, self.value, None)
+                if value:
+                    if results and results != value:
+                        print('WARNING: multiple different matches when resolving results, will take last match!')
+                    results = value
+
         # Finally update the field specified
         utils.dict_set(context, self.update_field, results)
+        index.invalidate(self.update_field)
     
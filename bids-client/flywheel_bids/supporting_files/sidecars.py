@@ -0,0 +1,262 @@
+import collections
+import json
+import os
+import tempfile
+
+from . import utils
+
+# Entities that vary between the files sharing an inherited sidecar
+INHERITED_ENTITIES = ('sub', 'ses', 'run')
+# The size of spooled sidecar contents kept in memory before spilling to disk (16 MiB)
+DEFAULT_SPOOL_SIZE = 16 * 1024 ** 2
+
+def parse_filename(path):
+    """
+    Split a BIDS file name into its entities and suffix.
+
+    Args:
+        path (str): The file path, e.g. sub-01/func/sub-01_task-rest_run-1_bold.nii.gz
+
+    Returns:
+        tuple: (entities, suffix), where entities is a list of (key, value) tuples in
+            file name order, or None if the name does not follow the BIDS pattern
+    """
+    name = os.path.basename(path)
+    ext = utils.get_extension(name)
+    if ext:
+        name = name[:-len(ext)]
+
+    parts = name.split('_')
+    suffix = parts[-1]
+    if not suffix or '-' in suffix:
+        return None
+
+    entities = []
+    for part in parts[:-1]:
+        key, sep, value = part.partition('-')
+        if not sep or not key or not value:
+            return None
+        entities.append((key, value))
+    return entities, suffix
+
+def inherited_name(entities, suffix):
+    """
+    Get the name of the top-level sidecar shared by files with the given entities and suffix
+    """
+    parts = ['{0}-{1}'.format(key, value) for key, value in entities if key not in INHERITED_ENTITIES]
+    parts.append(suffix)
+    return '_'.join(parts) + '.json'
+
+def _canonical(value):
+    return json.dumps(value, sort_keys=True)
+
+def iter_data_files(outdir):
+    """
+    Find the data files in a BIDS directory, which inherited sidecars apply to.
+
+    Args:
+        outdir (str): The BIDS directory
+
+    Yields:
+        tuple: (path, entities, suffix) of each data file with a BIDS file name, where path
+            is the path of its per-file sidecar
+    """
+    for dirname, dirnames, filenames in os.walk(outdir):
+        # Skip hidden directories, such as the export manifest
+        dirnames[:] = [x for x in dirnames if not x.startswith('.')]
+        for name in filenames:
+            ext = utils.get_extension(name)
+            if ext == '.json':
+                continue
+            path = os.path.join(dirname, name[:-len(ext)] if ext else name) + '.json'
+            result = parse_filename(path)
+            if result and result[0] and result[0][0][0] == 'sub':
+                yield os.path.normpath(path), result[0], result[1]
+
+def hoist_shared(paths, items, outdir):
+    """
+    Find the metadata shared by sidecars, to hoist into top-level sidecars following the
+    BIDS inheritance principle.
+
+    Sidecars are grouped by their entities other than sub, ses and run. Every group gets
+    a candidate top-level sidecar (e.g. task-rest_bold.json). Under the inheritance principle
+    that file applies to every file with the same suffix and at least its entities, so only
+    keys with the same value in all of those files are hoisted into it. A candidate is dropped
+    if it would also apply to a data file in outdir that has no sidecar among paths (such as
+    a file exported earlier, or filtered out of this export), since that file would inherit
+    metadata that isn't its own.
+
+    The contents are read in one pass, and only the shared keys of each candidate are kept.
+
+    Args:
+        paths (list): The sidecar paths, in order
+        items (function): Returns an iterator over the (path, data) sidecar contents, in order
+        outdir (str): The BIDS directory
+
+    Returns:
+        tuple: (top_level, hoisted), an OrderedDict of top-level sidecar contents by path,
+            and the set of hoisted keys by per-file sidecar path
+    """
+    parsed = collections.OrderedDict()
+    for path in paths:
+        result = parse_filename(path)
+        if result and result[0] and result[0][0][0] == 'sub':
+            parsed[path] = result
+
+    groups = collections.OrderedDict()
+    for path, (entities, suffix) in parsed.items():
+        name = inherited_name(entities, suffix)
+        if name not in groups:
+            groups[name] = (frozenset(x for x in entities if x[0] not in INHERITED_ENTITIES), suffix)
+
+    path_set = set(paths)
+    sidecar_paths = set(os.path.normpath(path) for path in parsed)
+    outside = [(frozenset(entities), suffix) for path, entities, suffix in iter_data_files(outdir)
+            if path not in sidecar_paths] if groups else []
+    members = collections.OrderedDict()
+    member_of = collections.defaultdict(list)
+    for name, (group_entities, group_suffix) in groups.items():
+        group_members = [path for path, (entities, suffix) in parsed.items()
+                if suffix == group_suffix and group_entities <= frozenset(entities)]
+        if len(group_members) < 2:
+            continue
+
+        # Never replace a top-level sidecar that was exported or already exists
+        top_path = os.path.join(outdir, name)
+        if top_path in path_set or os.path.exists(top_path):
+            continue
+        if any(suffix == group_suffix and group_entities <= entities for entities, suffix in outside):
+            continue
+
+        members[name] = group_members
+        for path in group_members:
+            member_of[path].append(name)
+
+    # Start from the first member of each group, and drop the keys any other member differs in
+    shared = {}
+    for path, data in items():
+        for name in member_of.get(path, ()):
+            if name not in shared:
+                shared[name] = dict(data)
+                continue
+            current = shared[name]
+            for key in list(current):
+                if key not in data or _canonical(data[key]) != _canonical(current[key]):
+                    del current[key]
+
+    top_level = collections.OrderedDict()
+    hoisted = collections.defaultdict(set)
+    for name, group_members in members.items():
+        if not shared.get(name):
+            continue
+        top_level[os.path.join(outdir, name)] = shared[name]
+        for path in group_members:
+            hoisted[path].update(shared[name])
+    return top_level, hoisted
+
+def iter_compacted(paths, items, outdir):
+    """
+    Compact sidecars (see hoist_shared) without holding their contents in memory.
+
+    Args:
+        paths (list): The sidecar paths, in order
+        items (function): Returns an iterator over the (path, data) sidecar contents, in order.
+            It is called twice.
+        outdir (str): The BIDS directory
+
+    Yields:
+        tuple: (path, data) of the top-level sidecars, then of every per-file sidecar.
+            Per-file contents may be empty, if every key was hoisted.
+    """
+    top_level, hoisted = hoist_shared(paths, items, outdir)
+    for path, data in top_level.items():
+        yield path, data
+    for path, data in items():
+        keys = hoisted.get(path, ())
+        yield path, dict((k, v) for k, v in data.items() if k not in keys)
+
+def compact_sidecars(contents, outdir):
+    """
+    Hoist the metadata shared by sidecars into top-level sidecars, following the BIDS
+    inheritance principle (see hoist_shared). Each file keeps the keys that differ, so
+    its effective metadata is unchanged.
+
+    Args:
+        contents (OrderedDict): The sidecar contents, by sidecar path
+        outdir (str): The BIDS directory
+
+    Returns:
+        tuple: (top_level, per_file), OrderedDicts of sidecar contents by path. Per-file
+            contents may be empty, if every key was hoisted.
+    """
+    top_level, hoisted = hoist_shared(list(contents), contents.items, outdir)
+    per_file = collections.OrderedDict()
+    for path, data in contents.items():
+        keys = hoisted.get(path, ())
+        per_file[path] = dict((k, v) for k, v in data.items() if k not in keys)
+    return top_level, per_file
+
+class SidecarSpool(object):
+    """
+    An ordered list of JSON records, such as sidecar contents, that is kept in memory up to
+    max_bytes of JSON and spilled to a temporary file beyond that. Memory use stays flat
+    however many records are added.
+
+    Args:
+        max_bytes (int): The size of the records kept in memory before spilling
+        dirname (str): The directory of the temporary file (defaults to the system temp directory)
+    """
+    def __init__(self, max_bytes=DEFAULT_SPOOL_SIZE, dirname=None):
+        self.max_bytes = max_bytes
+        self.dirname = dirname
+        self._lines = []
+        self._size = 0
+        self._count = 0
+        self._file = None
+
+    @property
+    def spilled(self):
+        return self._file is not None
+
+    def append(self, record):
+        """
+        Add a record to the end of the spool
+        """
+        line = json.dumps(record)
+        self._count += 1
+        if self._file is not None:
+            self._file.write(line + '\n')
+            return
+
+        self._lines.append(line)
+        self._size += len(line)
+        if self._size > self.max_bytes:
+            self._file = tempfile.TemporaryFile(mode='w+', dir=self.dirname)
+            for line in self._lines:
+                self._file.write(line + '\n')
+            self._lines = []
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        if self._file is None:
+            for line in list(self._lines):
+                yield json.loads(line)
+            return
+
+        self._file.flush()
+        self._file.seek(0)
+        for line in self._file:
+            yield json.loads(line)
+        self._file.seek(0, os.SEEK_END)
+
+    def close(self):
+        """
+        Remove the temporary file, if the spool was spilled
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._lines = []
+        self._count = 0
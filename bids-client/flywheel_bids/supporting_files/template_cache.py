@@ -0,0 +1,167 @@
+import hashlib
+import logging
+import os
+import pickle
+import sys
+import tempfile
+import threading
+
+from . import templates
+from .download_cache import cache_key
+from .errors import BIDSCurationError
+from .watermarks import template_signature
+
+logger = logging.getLogger('curate-bids')
+
+# Environment variable naming the directory of compiled project templates
+CACHE_DIR_ENV = 'FLYWHEEL_BIDS_TEMPLATE_CACHE_DIR'
+# Compiled templates are pickles, so they are kept in a directory only the user can write to
+DEFAULT_CACHE_DIR = os.path.join('~', '.cache', 'flywheel-bids', 'templates')
+# Bump when the Template classes change, so older pickles are not loaded
+CACHE_VERSION = 3
+
+class TemplateCache(object):
+    """
+    Cache of project templates, keyed by file id and modified timestamp.
+
+    Both the downloaded template file and the compiled Template are kept: in memory for the
+    life of the process, and on disk, so other processes (such as curations triggered by
+    uploads) neither download nor compile a template that did not change. Compiled templates
+    are pickled, keyed also by the cache version, the Python version and the default
+    templates they may extend.
+
+    Args:
+        cache_dir (str): The cache directory (defaults to $FLYWHEEL_BIDS_TEMPLATE_CACHE_DIR,
+            or ~/.cache/flywheel-bids/templates)
+
+    Attributes:
+        hits (int): The number of templates served from memory or disk
+        misses (int): The number of templates downloaded and compiled
+    """
+    def __init__(self, cache_dir=None):
+        self.cache_dir = os.path.expanduser(cache_dir or os.environ.get(CACHE_DIR_ENV) or DEFAULT_CACHE_DIR)
+        self.hits = 0
+        self.misses = 0
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def key(self, f):
+        """
+        Get the cache key of a project template file, or None if it cannot be identified
+        """
+        key = cache_key(f.get('file_id') or f.get('id'), f.get('modified'), f.get('hash'))
+        if key is None:
+            return None
+        source = '{0}:{1}:{2}:{3}'.format(key, CACHE_VERSION, sys.version_info[0], template_signature())
+        return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        """
+        The path of the cached template file
+        """
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def _compiled_path(self, key):
+        return os.path.join(self.cache_dir, key + '.pickle')
+
+    def get(self, key):
+        """
+        Get a compiled template from memory, or from disk.
+
+        Returns:
+            Template: The template, or None if it is not cached
+        """
+        with self._lock:
+            template = self._templates.get(key)
+        if template is not None:
+            return template
+
+        if not os.path.isfile(self.path(key)):
+            return None
+        try:
+            with open(self._compiled_path(key), 'rb') as fp:
+                template = pickle.load(fp)
+        except Exception as err:
+            # Recompile from the cached file
+            logger.debug('Could not load compiled template {0}: {1}'.format(key, err))
+            template = templates.loadTemplate(self.path(key))
+            self._write(self._compiled_path(key), lambda fp: pickle.dump(template, fp, pickle.HIGHEST_PROTOCOL))
+        with self._lock:
+            self._templates[key] = template
+        return template
+
+    def _write(self, path, write):
+        """
+        Write a cache file atomically, ignoring errors (the cache is optional)
+        """
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir, 0o700)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp-')
+            try:
+                with os.fdopen(fd, 'wb') as fp:
+                    write(fp)
+                os.rename(tmp_path, path)
+            except:
+                os.remove(tmp_path)
+                raise
+        except Exception as err:
+            logger.warning('Could not write template cache file {0}: {1}'.format(path, err))
+            return False
+        return True
+
+    def load_project_template(self, fw, project, f):
+        """
+        Get the compiled template of a project template file, downloading and compiling it
+        only if it is not cached.
+
+        Args:
+            fw: Flywheel client, or None when curating offline
+            project: The project
+            f (dict): The template file
+
+        Returns:
+            tuple: The Template, and the path of the template file
+
+        Raises:
+            BIDSCurationError: If the template is not cached, and there is no client to
+                download it with
+        """
+        key = self.key(f)
+        if key is not None:
+            template = self.get(key)
+            if template is not None:
+                self.hits += 1
+                return template, self.path(key)
+
+        self.misses += 1
+        if fw is None:
+            raise BIDSCurationError('Project template {0} is not cached, and cannot be downloaded offline. '
+                    'Pass it with --template-file'.format(f['name']))
+        fd, path = tempfile.mkstemp('.json')
+        os.close(fd)
+        fw.download_file_from_project(project['id'], f['name'], path)
+        template = templates.loadTemplate(path)
+        if key is None:
+            return template, path
+
+        with open(path, 'rb') as src:
+            data = src.read()
+        if self._write(self.path(key), lambda fp: fp.write(data)):
+            os.remove(path)
+            path = self.path(key)
+            self._write(self._compiled_path(key), lambda fp: pickle.dump(template, fp, pickle.HIGHEST_PROTOCOL))
+        with self._lock:
+            self._templates[key] = template
+        return template, path
+
+_default_cache = None
+
+def get_default_cache():
+    """
+    Get the template cache shared by curations in this process
+    """
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = TemplateCache()
+    return _default_cache
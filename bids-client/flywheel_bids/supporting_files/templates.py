@@ -1,9 +1,9 @@
-import os, os.path, json, re
+import os, os.path, json
 import jsonschema
-import six
 
 from . import utils
 from . import resolver
+from .matching import Initializers, RuleIndex, WhereClause, SwitchInitializer, compile_match
 
 DEFAULT_TEMPLATE_NAME = 'bids-v1'
 BIDS_TEMPLATE_NAME = 'bids-v1'
@@ -24,6 +24,7 @@ class Template:
         rules (list): The list of if rules for applying templates.
         extends (string): The optional name of the template to extend.
         exclude_rules (list): The optional list of rules to exclude from a parent template.
+        rule_index (RuleIndex): The index of rules, used to skip rules that cannot match.
     """
     def __init__(self, data, templates=None):
         if data:
@@ -85,7 +86,8 @@ class Template:
 
     def compile_rules(self):
         """
-        Converts the rule dictionaries on this object to Rule class objects.
+        Converts the rule dictionaries on this object to Rule class objects, and indexes them
+        (see candidate_rules). Call again after changing the rules.
         """
         for i in range(0, len(self.rules)):
             rule = self.rules[i]
@@ -97,6 +99,23 @@ class Template:
             if not isinstance(upload_rule, Rule):
                 self.upload_rules[i] = Rule(upload_rule)
 
+        self.rule_index = RuleIndex(self.rules)
+        self.upload_rule_index = RuleIndex(self.rules + self.upload_rules)
+
+    def candidate_rules(self, context, upload=False):
+        """
+        Get the rules that may match the given context, in priority order.
+
+        Args:
+            context (dict): The current context
+            upload (bool): Whether to include upload_rules
+
+        Returns:
+            list(Rule): The rules to test, which excludes rules that cannot match
+        """
+        index = self.upload_rule_index if upload else self.rule_index
+        return index.candidates(context)
+
     def compile_resolvers(self):
         """
         Walk through the definitions
@@ -115,7 +134,7 @@ class Template:
 
     def compile_custom_initializers(self):
         """
-        Map custom initializers by rule id
+        Map custom initializers by rule id, compiling their where clauses and initializers
         """
         self.initializer_map = {}
         for init in self.custom_initializers:
@@ -125,7 +144,8 @@ class Template:
             del init['rule']
             if rule not in self.initializer_map:
                 self.initializer_map[rule] = []
-            self.initializer_map[rule].append(init)
+            where = WhereClause(init['where']) if 'where' in init else None
+            self.initializer_map[rule].append((where, Initializers(init['initialize'])))
 
     def apply_custom_initialization(self, rule_id, info, context):
         """
@@ -137,12 +157,11 @@ class Template:
             context (dict): The current context
         """
         if rule_id in self.initializer_map:
-            for init in self.initializer_map[rule_id]:
-                if 'where' in init:
-                    if not test_where_clause(init['where'], context):
-                        continue
+            for where, initializers in self.initializer_map[rule_id]:
+                if where is not None and not where(context):
+                    continue
 
-                apply_initializers(init['initialize'], info, context)
+                initializers.apply(info, context)
 
     def validate(self, templateDef, info):
         """
@@ -160,6 +179,16 @@ class Template:
 
         return list(sorted(templateDef['_validator'].iter_errors(info), key=str))
 
+    def __getstate__(self):
+        """
+        Pickle the template without the validators cached on its definitions
+        """
+        state = self.__dict__.copy()
+        state['definitions'] = dict((name, dict((k, v) for k, v in definition.items() if k != '_validator'))
+                if isinstance(definition, dict) else definition
+                for name, definition in self.definitions.items())
+        return state
+
     def resolve_refs(self, resolver, obj, parent=None, key=None):
         """
         Resolve all references found in the definitions tree.
@@ -193,6 +222,7 @@ class Rule:
         template (str): The name of the template id to apply when this rule matches.
         initialize (dict): The optional set of initialization rules when this rule matches.
         conditions (dict): The set of conditions that must be true for this rule to match.
+        where (WhereClause): The compiled conditions.
     """
     def __init__(self, data):
         self.id = data.get('id', '')
@@ -203,6 +233,8 @@ class Rule:
         self.conditions = data.get('where')
         if not self.conditions:
             raise Exception('"where" field is required!')
+        self.where = WhereClause(self.conditions)
+        self.initializers = Initializers(self.initialize)
 
     def test(self, context):
         """
@@ -214,7 +246,7 @@ class Rule:
         Returns:
             bool: True if the rule matches the given context.
         """
-        return test_where_clause(self.conditions, context)
+        return self.where(context)
 
     def initializeProperties(self, info, context):
         """
@@ -230,7 +262,7 @@ class Rule:
             context (dict): The full context object
             info (dict): The BIDS data to update, if matched
         """
-        apply_initializers(self.initialize, info, context)
+        self.initializers.apply(info, context)
         handle_run_counter_initializer(self.initialize, info, context)
 
 def apply_initializers(initializers, info, context):
@@ -242,58 +274,10 @@ def apply_initializers(initializers, info, context):
         context (dict): The full context object
         info (dict): The BIDS data to update, if matched
     """
-    for propName, propDef in initializers.items():
-        resolvedValue = None
-
-        if isinstance(propDef, dict):
-            if '$switch' in propDef:
-                resolvedValue = handle_switch_initializer(propDef['$switch'], context)
-            else:
-                for key, valueSpec in propDef.items():
-                    # Lookup the value of the key
-                    value = utils.dict_lookup(context, key)
-                    if value is not None:
-                        # Regex matching must provide a 'value' group
-                        if '$regex' in valueSpec:
-                            regex_list = valueSpec['$regex']
-                            if not isinstance(regex_list, list):
-                                regex_list = [regex_list]
-
-                            for regex in regex_list:
-                                m = re.search(regex, value)
-                                if m is not None:
-                                    resolvedValue = m.group('value')
-                                    break
-                        # 'take' will just copy the value
-                        elif '$take' in valueSpec and valueSpec['$take']:
-                            resolvedValue = value
-
-                        if '$format' in valueSpec and resolvedValue:
-                            resolvedValue = utils.format_value(valueSpec['$format'], resolvedValue)
-
-                        if resolvedValue:
-                            break
-        else:
-            resolvedValue = propDef
-
-        if resolvedValue:
-            info[propName] = resolvedValue
-
+    Initializers(initializers).apply(info, context)
 
 def handle_switch_initializer(switchDef, context):
-    value = utils.dict_lookup(context, switchDef['$on'])
-    if isinstance(value, list):
-        value = set(value)
-
-    for caseDef in switchDef['$cases']:
-        compValue = caseDef.get('$eq')
-        if isinstance(compValue, list):
-            compValue = set(compValue)
-
-        if '$default' in caseDef or value == compValue:
-            return caseDef.get('$value')
-
-    return None
+    return SwitchInitializer(switchDef)(context)
 
 def handle_run_counter_initializer(initializers, info, context):
     counter = context.get('run_counters')
@@ -317,21 +301,18 @@ def test_where_clause(conditions, context):
     """
     Test if the given context matches this rule.
 
+    Rules compile their conditions once (see matching.WhereClause); this compiles them on
+    every call.
+
     Args:
         context (dict): The context, which includes the hierarchy and current container
 
     Returns:
         bool: True if the rule matches the given context.
     """
+    return WhereClause(conditions)(context)
 
-    for field, match in conditions.items():
-        value = utils.dict_lookup(context, field)
-        if not processValueMatch(value, match, field):
-            return False
-
-    return True
-
-def processValueMatch(value, match, condition=None):
+def processValueMatch(value, match):
     """
     Helper function that recursively performs value matching.
     Args:
@@ -340,66 +321,7 @@ def processValueMatch(value, match, condition=None):
     Returns:
         bool: The result of matching the value against the match spec.
     """
-    if condition:
-        # Handle $or clauses at top-level
-        if condition == "$or":
-            for field, deeper_match in match:
-                value = utils.dict_lookup(context, field)
-                if processValueMatch(value, deeper_match):
-                    return True
-            return False
-
-        # Otherwise AND clauses
-        if condition == "$and":
-            for field, deeper_match in match:
-                value = utils.dict_lookup(context, field)
-                if not processValueMatch(value, deeper_match):
-                    return False
-            return True
-
-    if isinstance(match, dict):
-        # Deeper processing
-        if '$in' in match:
-            # Check if value is in list
-            if isinstance(value, list):
-                for item in value:
-                    if item in match['$in']:
-                        return True
-                return False
-            elif isinstance(value, six.string_types):
-                for item in match['$in']:
-                    if item in value:
-                        return True
-                return False
-
-            return value in match['$in']
-
-        elif '$not' in match:
-            # Negate result of nested match
-            return not processValueMatch(value, match['$not'])
-
-        elif '$regex' in match:
-            regex = re.compile(match['$regex'])
-
-            if isinstance(value, list):
-                for item in value:
-                    if regex.search(item) is not None:
-                        return True
-
-                return False
-            if value is None:
-                return False
-            return regex.search(value) is not None
-
-    else:
-        # Direct match
-        if isinstance(value, list):
-            for item in value:
-                if item == match:
-                    return True
-            return False
-
-        return value == match
+    return compile_match(match)(value)
 
 
 def loadTemplates(templates_dir=None):
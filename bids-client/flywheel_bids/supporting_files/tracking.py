@@ -0,0 +1,264 @@
+import copy
+
+import six
+
+# Marks a key that did not exist before it was changed
+_MISSING = object()
+
+class _Tracked(object):
+    """
+    Common parts of TrackedDict and TrackedList. Nested dicts and lists are wrapped as they
+    are read. Each wrapped object knows its root, and the top-level key of the root it is
+    stored under, which is where its changes are recorded.
+    """
+    __slots__ = ()
+
+    def _top(self, key):
+        return key if self._root is self else self._key
+
+    def _wrap(self, key, value):
+        top = self._top(key)
+        if type(value) is dict:
+            wrapped = TrackedDict.__new__(TrackedDict)
+            dict.update(wrapped, value)
+        elif type(value) is list:
+            wrapped = TrackedList.__new__(TrackedList)
+            list.extend(wrapped, value)
+        elif isinstance(value, _Tracked) and (value._root is not self._root or value._key != top):
+            # Moved from another tracked object
+            wrapped = value
+        else:
+            return value
+        wrapped._adopt(self._root, top)
+        return wrapped
+
+    def _adopt(self, root, key):
+        self._root = root
+        self._key = key
+        for value in self._raw_values():
+            if isinstance(value, _Tracked):
+                value._adopt(root, key)
+
+    def _touch(self, key=None):
+        """
+        Save the original value of the top-level key about to change, the first time it does
+        """
+        root = self._root
+        top = self._top(key)
+        if top not in root._originals:
+            value = dict.get(root, top, _MISSING)
+            root._originals[top] = value if value is _MISSING else copy.deepcopy(value)
+
+class TrackedDict(_Tracked, dict):
+    """
+    A dict that records which of its top-level keys change, including through nested dicts
+    and lists. The value of a top-level key is copied the first time anything below it
+    changes; nothing is copied up front. Checking for changes only compares the saved
+    values, so it costs in proportion to what changed rather than to the size of the dict.
+
+    Copies and pickles of a TrackedDict are plain dicts.
+
+    Args:
+        data (dict): The initial contents (copied shallowly)
+    """
+    __slots__ = ('_root', '_key', '_originals')
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._root = self
+        self._key = None
+        self._originals = {}
+
+    @property
+    def is_root(self):
+        return self._root is self
+
+    def _raw_values(self):
+        return list(dict.values(self))
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        wrapped = self._wrap(key, value)
+        if wrapped is not value:
+            dict.__setitem__(self, key, wrapped)
+        return wrapped
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def items(self):
+        return [(key, self[key]) for key in dict.keys(self)]
+
+    def values(self):
+        return [self[key] for key in dict.keys(self)]
+
+    if six.PY2:
+        # Python 2 dicts have their own iterators and views, which would skip the wrapping
+        def iteritems(self):
+            for key in dict.keys(self):
+                yield key, self[key]
+
+        def itervalues(self):
+            for key in dict.keys(self):
+                yield self[key]
+
+        def viewitems(self):
+            return self.items()
+
+        def viewvalues(self):
+            return self.values()
+
+    def __setitem__(self, key, value):
+        self._touch(key)
+        dict.__setitem__(self, key, self._wrap(key, value))
+
+    def __delitem__(self, key):
+        self._touch(key)
+        dict.__delitem__(self, key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        if key in self:
+            self._touch(key)
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        if not self:
+            raise KeyError('popitem(): dictionary is empty')
+        key = next(iter(self))
+        return key, self.pop(key)
+
+    def clear(self):
+        for key in list(dict.keys(self)):
+            self._touch(key)
+        dict.clear(self)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def copy(self):
+        return dict(dict.items(self))
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        return dict((copy.deepcopy(key, memo), copy.deepcopy(value, memo)) for key, value in dict.items(self))
+
+    def __reduce__(self):
+        return (dict, (dict(dict.items(self)),))
+
+    def changed_keys(self):
+        """
+        Get the top-level keys of the root whose value differs from the original.
+
+        Returns:
+            list: The changed keys
+        """
+        root = self._root
+        return [key for key, original in root._originals.items()
+                if dict.get(root, key, _MISSING) != original]
+
+    def is_changed(self):
+        """
+        Check if the root differs from its original contents
+        """
+        return bool(self.changed_keys())
+
+    def original(self):
+        """
+        Get the original contents of the root. Unchanged values are shared with the root.
+
+        Returns:
+            dict: The original contents
+        """
+        root = self._root
+        result = dict(dict.items(root))
+        for key, original in root._originals.items():
+            if original is _MISSING:
+                result.pop(key, None)
+            else:
+                result[key] = original
+        return result
+
+class TrackedList(_Tracked, list):
+    """
+    A list stored in a TrackedDict, which records its changes in the root of the dict
+    """
+    __slots__ = ('_root', '_key')
+
+    def _raw_values(self):
+        return list(list.__iter__(self))
+
+    def __getitem__(self, index):
+        value = list.__getitem__(self, index)
+        if isinstance(index, slice):
+            return value
+        wrapped = self._wrap(None, value)
+        if wrapped is not value:
+            list.__setitem__(self, index, wrapped)
+        return wrapped
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __setitem__(self, index, value):
+        self._touch()
+        list.__setitem__(self, index, value)
+
+    def __delitem__(self, index):
+        self._touch()
+        list.__delitem__(self, index)
+
+    def __iadd__(self, values):
+        self._touch()
+        return list.__iadd__(self, values)
+
+    def __imul__(self, count):
+        self._touch()
+        return list.__imul__(self, count)
+
+    def append(self, value):
+        self._touch()
+        list.append(self, value)
+
+    def extend(self, values):
+        self._touch()
+        list.extend(self, values)
+
+    def insert(self, index, value):
+        self._touch()
+        list.insert(self, index, value)
+
+    def pop(self, *args):
+        self._touch()
+        return list.pop(self, *args)
+
+    def remove(self, value):
+        self._touch()
+        list.remove(self, value)
+
+    def sort(self, *args, **kwargs):
+        self._touch()
+        list.sort(self, *args, **kwargs)
+
+    def reverse(self):
+        self._touch()
+        list.reverse(self)
+
+    def __copy__(self):
+        return list(list.__iter__(self))
+
+    def __deepcopy__(self, memo):
+        return [copy.deepcopy(value, memo) for value in list.__iter__(self)]
+
+    def __reduce__(self):
+        return (list, (list(list.__iter__(self)),))
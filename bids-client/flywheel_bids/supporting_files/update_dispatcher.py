@@ -0,0 +1,213 @@
+import collections
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('curate-bids')
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_RETRIES = 2
+DEFAULT_RETRY_DELAY = 1.0
+# Log progress every this many updates
+PROGRESS_INTERVAL = 500
+
+def get_update(context, replace=False):
+    """
+    Get the server update for the node of a curation context.
+
+    Unless replace is set, only the top-level info keys that changed are sent, as a
+    modify_*_info call with set and delete operations. Nodes that do not track their
+    changes (or replace) send their whole info with set_*_file_info or replace_*_info.
+
+    Args:
+        context (dict): The context of a dirty node
+        replace (bool): Send the whole info, replacing it on containers
+
+    Returns:
+        tuple: (container, target, method, args), where container is the (type, id) of the
+            container the update is sent to, target identifies the updated node (its file
+            name, or None for the container itself) and method is the client method to call
+            with args. None if the node cannot be updated, or has no changes.
+    """
+    ctype = context['container_type']
+    node = context.get(ctype)
+    changes = None
+    if not replace and hasattr(node, 'info_changes'):
+        changes = node.info_changes()
+        if changes == {}:
+            return None
+
+    if ctype == 'file':
+        parent_ctype = context['parent_container_type']
+        if parent_ctype not in ('project', 'session', 'acquisition'):
+            logger.info('Cannot determine file parent container type: {0}'.format(parent_ctype))
+            return None
+        parent_id = context[parent_ctype]['id']
+        file_name = context['file']['name']
+        if changes is not None:
+            return ((parent_ctype, parent_id), file_name, 'modify_{0}_file_info'.format(parent_ctype),
+                    (parent_id, file_name, changes))
+        return ((parent_ctype, parent_id), file_name, 'set_{0}_file_info'.format(parent_ctype),
+                (parent_id, file_name, context['file']['info']))
+
+    if ctype not in ('project', 'session', 'acquisition'):
+        logger.info('Cannot determine container type: {0}'.format(ctype))
+        return None
+    container_id = context[ctype]['id']
+    if changes is not None:
+        return ((ctype, container_id), None, 'modify_{0}_info'.format(ctype), (container_id, changes))
+    return ((ctype, container_id), None, 'replace_{0}_info'.format(ctype),
+            (container_id, context[ctype]['info']))
+
+class UpdateDispatcher(object):
+    """
+    Sends curation updates to the server concurrently.
+
+    Updates are coalesced per container: a node updated more than once only sends its last
+    update, and all updates to one container (its info and the info of its files) are sent
+    in order by the same worker, so concurrent requests never touch the same container.
+    Containers are dispatched through a bounded thread pool. Each update is retried on its
+    own, and an update that keeps failing is recorded against its container without stopping
+    the others.
+
+    Args:
+        fw: Flywheel client
+        max_workers (int): The number of containers updated concurrently
+        retries (int): The number of times to retry a failed update
+        retry_delay (float): The base delay (in seconds) between retries, doubled on every attempt
+        on_progress (function): Optional callback invoked with (done, total) after each update
+        replace (bool): Send whole info objects instead of the changed keys (see get_update)
+
+    Attributes:
+        submitted (int): The number of updates added
+        coalesced (int): The number of updates replaced by a later update of the same node
+        completed (int): The number of updates sent
+        failed (int): The number of updates that could not be sent
+        elapsed (float): The time in seconds spent sending updates
+        failures (dict): The (target, exception) tuples of failed updates, by container (type, id)
+    """
+    def __init__(self, fw, max_workers=DEFAULT_MAX_WORKERS, retries=DEFAULT_RETRIES,
+            retry_delay=DEFAULT_RETRY_DELAY, on_progress=None, replace=False):
+        self.fw = fw
+        self.max_workers = max(1, max_workers)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.on_progress = on_progress
+        self.replace = replace
+
+        self.submitted = 0
+        self.coalesced = 0
+        self.completed = 0
+        self.failed = 0
+        self.elapsed = 0.0
+        self.failures = collections.OrderedDict()
+        self._batches = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self):
+        """
+        The number of updates waiting to be sent
+        """
+        return sum(len(batch) for batch in self._batches.values())
+
+    @property
+    def total(self):
+        """
+        The number of distinct updates to send, including those already sent
+        """
+        return self.submitted - self.coalesced
+
+    @property
+    def throughput(self):
+        """
+        The updates sent per second, or None before anything was sent
+        """
+        if not self.elapsed:
+            return None
+        return self.completed / self.elapsed
+
+    def add(self, context):
+        """
+        Queue the update of the node of a curation context.
+
+        Args:
+            context (dict): The context of a dirty node
+
+        Returns:
+            bool: True if the update was queued
+        """
+        update = get_update(context, replace=self.replace)
+        if update is None:
+            return False
+        container, target, method, args = update
+        batch = self._batches.setdefault(container, collections.OrderedDict())
+        self.submitted += 1
+        if target in batch:
+            self.coalesced += 1
+            del batch[target]
+        batch[target] = (method, args)
+        return True
+
+    def run(self):
+        """
+        Send the queued updates, and wait for them to finish.
+
+        Returns:
+            dict: The failures of this run, by container (see failures)
+        """
+        batches = list(self._batches.items())
+        self._batches = collections.OrderedDict()
+        if not batches:
+            return {}
+
+        started = time.time()
+        failures = collections.OrderedDict()
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(batches))) as executor:
+            results = executor.map(lambda item: self._send_batch(*item), batches)
+            for (container, batch), errors in zip(batches, results):
+                if errors:
+                    failures[container] = errors
+        self.elapsed += time.time() - started
+        self.failures.update(failures)
+
+        throughput = self.throughput
+        logger.info('Sent {0} update(s) to {1} container(s) in {2:.1f}s{3}'.format(self.completed,
+            len(batches), self.elapsed, ' ({0:.1f}/s)'.format(throughput) if throughput else ''))
+        return failures
+
+    def _send_batch(self, container, batch):
+        errors = []
+        for target, (method, args) in batch.items():
+            err = self._send(method, args)
+            with self._lock:
+                if err is None:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+                    errors.append((target, err))
+                done = self.completed + self.failed
+            if err is not None:
+                logger.error('Failed to update {0} {1}{2}: {3}'.format(container[0], container[1],
+                    ' file ' + target if target else '', err))
+            if self.on_progress:
+                self.on_progress(done, self.total)
+            if done % PROGRESS_INTERVAL == 0:
+                logger.info('Sent {0}/{1} update(s)'.format(done, self.total))
+        return errors
+
+    def _send(self, method, args):
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                getattr(self.fw, method)(*args)
+                return None
+            except Exception as err:
+                if attempts > self.retries:
+                    return err
+                delay = self.retry_delay * (2 ** (attempts - 1))
+                logger.warning('{0} failed ({1}), retrying in {2}s'.format(method, err, delay))
+                time.sleep(delay)
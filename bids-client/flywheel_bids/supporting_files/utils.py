@@ -44,6 +44,8 @@ def get_project_id_from_session_id(fw, session_id):
     return session['project']
 
 
+EXTENSION_REGEX = re.compile('\.[a-zA-Z]*[\.]?[A-Za-z0-9]+$')
+
 def get_extension(fname):
     """ Get extension
 
@@ -51,17 +53,33 @@ def get_extension(fname):
     else, ext is None
 
     """
-    ext = re.search('\.[a-zA-Z]*[\.]?[A-Za-z0-9]+$',fname)
+    ext = EXTENSION_REGEX.search(fname)
     if ext:
         ext = ext.group()
     return ext
 
 def dict_lookup(obj, value, default=None):
     # For now, we don't support escaping of dots
-    parts = value.split('.')
+    return lookup_parts(obj, value.split('.'), default)
+
+# Whether each type looked up in is a mapping, to skip the abstract base class check
+_mapping_types = {dict: True}
+
+def is_mapping(obj):
+    """ Check if obj is a dict or other Mapping, such as a TreeNode or a context """
+    result = _mapping_types.get(type(obj))
+    if result is None:
+        result = _mapping_types[type(obj)] = isinstance(obj, (dict, collections.Mapping))
+    return result
+
+def lookup_parts(obj, parts, default=None):
+    """ Lookup a value by the parts of an already split dotted path (see dict_lookup) """
     curr = obj
     for part in parts:
-        if isinstance(curr, (dict, collections.Mapping)) and part in curr:
+        mapping = _mapping_types.get(type(curr))
+        if mapping is None:
+            mapping = is_mapping(curr)
+        if mapping and part in curr:
             curr = curr[part]
         elif isinstance(curr, list) and int(part) < len(curr):
             curr = curr[int(part)]
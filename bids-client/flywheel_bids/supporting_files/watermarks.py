@@ -0,0 +1,141 @@
+import hashlib
+import json
+import logging
+import os
+
+logger = logging.getLogger('curate-bids')
+
+# Watermarks are kept in their own key of the project info, next to the template namespace,
+# which is exported as dataset_description.json
+WATERMARK_KEY = 'BIDSCuration'
+WATERMARK_VERSION = 1
+# Keys that the server updates on its own, including when curation writes info
+VOLATILE_KEYS = ('modified', 'permissions', 'analyses', 'notes')
+
+def _strip(data, exclude=()):
+    """
+    Drop the volatile keys of a container's data. Only top-level keys are dropped: nested
+    values, such as info, are user data and are kept in full.
+    """
+    return dict((key, value) for key, value in data.items() if key not in VOLATILE_KEYS and key not in exclude)
+
+def _digest(obj):
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:32]
+
+def node_signature(node):
+    """
+    Hash everything curation reads from a tree node and its children: their data, including
+    all of info, but not the container fields the server updates on its own (such as modified
+    timestamps, which change whenever curation writes info).
+
+    Args:
+        node (TreeNode): The node
+
+    Returns:
+        str: The signature
+    """
+    def collect(n):
+        data = dict(n.data)
+        info = data.get('info')
+        if isinstance(info, dict) and WATERMARK_KEY in info:
+            data['info'] = dict((k, v) for k, v in info.items() if k != WATERMARK_KEY)
+        # Children are hashed as nodes, sessions are watermarked on their own
+        children = [child for child in n.children if child.type != 'session']
+        return [n.type, _strip(data, exclude=('files',)), [collect(child) for child in children]]
+    return _digest(collect(node))
+
+def template_signature(template_file=None):
+    """
+    Hash the template curation runs with.
+
+    Args:
+        template_file (str): The template file, or None for the default template
+
+    Returns:
+        str: The signature
+    """
+    if not template_file:
+        from .templates import DEFAULT_TEMPLATE_NAME
+        template_file = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                '../templates', DEFAULT_TEMPLATE_NAME + '.json')
+    with open(template_file, 'rb') as fp:
+        return hashlib.sha256(fp.read()).hexdigest()[:32]
+
+class CurationWatermarks(object):
+    """
+    Record of the state of each session after it was last curated, kept in the project info.
+
+    A session is current if neither it, its acquisitions and files, the project, nor the
+    template changed since it was curated, in which case curating it again would not change
+    anything. States are compared by signature (see node_signature) rather than by modified
+    timestamp, since sending curation updates bumps the timestamps of every curated container.
+
+    Args:
+        template (str): The template signature
+        project (str): The project signature when the watermarks were recorded
+        sessions (dict): The session signatures, by session id
+    """
+    def __init__(self, template, project=None, sessions=None):
+        self.template = template
+        self.project = project
+        self.sessions = sessions or {}
+
+    @classmethod
+    def load(cls, project, template):
+        """
+        Load the watermarks of a project.
+
+        Args:
+            project (TreeNode): The project node
+            template (str): The signature of the template curation runs with
+
+        Returns:
+            CurationWatermarks: The watermarks, empty if there are none, or they were recorded
+                with another template or for a project that changed since
+        """
+        data = (project.get('info') or {}).get(WATERMARK_KEY)
+        watermarks = cls(template)
+        if not isinstance(data, dict) or data.get('version') != WATERMARK_VERSION:
+            return watermarks
+        if data.get('template') != template:
+            logger.info('The template changed since the last curation, curating every session')
+        elif data.get('project') != node_signature(project):
+            logger.info('The project changed since the last curation, curating every session')
+        else:
+            watermarks.project = data.get('project')
+            watermarks.sessions = dict(data.get('sessions', {}))
+        return watermarks
+
+    def is_current(self, session):
+        """
+        Check if a session is unchanged since it was last curated
+        """
+        signature = self.sessions.get(session['id'])
+        return signature is not None and signature == node_signature(session)
+
+    def update(self, session):
+        """
+        Record the current state of a curated session
+        """
+        self.sessions[session['id']] = node_signature(session)
+
+    def to_dict(self):
+        return {
+            'version': WATERMARK_VERSION,
+            'template': self.template,
+            'project': self.project,
+            'sessions': self.sessions
+        }
+
+    def save(self, fw, project):
+        """
+        Store the watermarks in the project info, locally and on the server.
+
+        Args:
+            fw: Flywheel client
+            project (TreeNode): The curated project node
+        """
+        self.project = node_signature(project)
+        data = self.to_dict()
+        project.setdefault('info', {})[WATERMARK_KEY] = data
+        fw.modify_project_info(project['id'], {'set': {WATERMARK_KEY: data}})
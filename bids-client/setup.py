@@ -18,7 +18,8 @@ VERSION = "0.7.1"
 # prerequisite: setuptools
 # http://pypi.python.org/pypi/setuptools
 
-REQUIRES = ["jsonschema>=2.6.0", "flywheel-sdk>=2.4.0", "future>=0.16.0"]
+REQUIRES = ["jsonschema>=2.6.0", "flywheel-sdk>=2.4.0", "future>=0.16.0",
+        "futures; python_version < '3.2'", "scandir; python_version < '3.5'"]
 
 class VerifyVersionCommand(install):
     """Custom command to verify that the git tag matches our version"""
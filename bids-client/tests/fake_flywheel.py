@@ -0,0 +1,157 @@
+import collections
+import datetime
+
+import dateutil.parser
+
+MODIFIED = dateutil.parser.parse('2018-03-28T20:40:59.54Z')
+
+class FakeApiClient(object):
+    def sanitize_for_serialization(self, obj):
+        if isinstance(obj, dict):
+            return dict((k, self.sanitize_for_serialization(v)) for k, v in obj.items())
+        if isinstance(obj, list):
+            return [self.sanitize_for_serialization(x) for x in obj]
+        if isinstance(obj, datetime.datetime):
+            return obj.isoformat()
+        return obj
+
+class FakeFlywheel(object):
+    """
+    In-memory stand-in for the Flywheel client, covering the calls used by export and curation.
+
+    Args:
+        project (dict): The project document, with 'sessions' -> 'acquisitions' children
+        list_info (bool): If False, listing calls leave out container and file info, the way
+            the server does, so callers have to fetch containers individually
+
+    Attributes:
+        calls (Counter): The number of calls made, by method name
+        downloads (list): The (container_type, container_id, file_name) of downloaded files
+    """
+    def __init__(self, project, list_info=True):
+        self.project = project
+        self.list_info = list_info
+        self.api_client = FakeApiClient()
+        self.calls = collections.Counter()
+        self.downloads = []
+        self.on_get_acquisition = None
+
+    def _strip(self, container, child_key):
+        return dict((k, v) for k, v in container.items() if k != child_key)
+
+    def _listed(self, container, child_key):
+        container = self._strip(container, child_key)
+        if not self.list_info:
+            container.pop('info', None)
+            container['files'] = [dict((k, v) for k, v in f.items() if k != 'info')
+                    for f in container.get('files', [])]
+        return container
+
+    def _sessions(self):
+        return self.project.get('sessions', [])
+
+    def _find_session(self, session_id):
+        for session in self._sessions():
+            if session['_id'] == session_id:
+                return session
+        raise KeyError(session_id)
+
+    def _find_acquisition(self, acquisition_id):
+        for session in self._sessions():
+            for acq in session.get('acquisitions', []):
+                if acq['_id'] == acquisition_id:
+                    return acq
+        raise KeyError(acquisition_id)
+
+    def get_project(self, project_id):
+        self.calls['get_project'] += 1
+        return self._strip(self.project, 'sessions')
+
+    def get_project_sessions(self, project_id):
+        self.calls['get_project_sessions'] += 1
+        return [self._listed(x, 'acquisitions') for x in self._sessions()]
+
+    def get_session(self, session_id):
+        self.calls['get_session'] += 1
+        return self._strip(self._find_session(session_id), 'acquisitions')
+
+    def get_project_acquisitions(self, project_id):
+        self.calls['get_project_acquisitions'] += 1
+        return [self._listed(acq, None) for session in self._sessions() for acq in session.get('acquisitions', [])]
+
+    def get_session_acquisitions(self, session_id):
+        self.calls['get_session_acquisitions'] += 1
+        return [self._listed(acq, None) for acq in self._find_session(session_id).get('acquisitions', [])]
+
+    def get_acquisition(self, acquisition_id):
+        self.calls['get_acquisition'] += 1
+        if self.on_get_acquisition:
+            self.on_get_acquisition(acquisition_id)
+        return self._find_acquisition(acquisition_id)
+
+    def _download(self, container_type, container_id, file_name, dest_file):
+        self.calls['download_file_from_' + container_type] += 1
+        self.downloads.append((container_type, container_id, file_name))
+        with open(dest_file, 'w') as fp:
+            fp.write(file_name)
+
+    def download_file_from_project(self, *args):
+        self._download('project', *args)
+
+    def download_file_from_session(self, *args):
+        self._download('session', *args)
+
+    def download_file_from_acquisition(self, *args):
+        self._download('acquisition', *args)
+
+def make_file(name, path, filename, folder, info=None):
+    """ Create a curated file document """
+    info = dict(info or {})
+    info['BIDS'] = {'Path': path, 'Filename': filename, 'Folder': folder}
+    return {'id': '{0}/{1}'.format(path, filename), 'name': name, 'info': info, 'modified': MODIFIED, 'size': len(name)}
+
+def make_project(subjects=2, sessions=1, runs=2):
+    """ Create a curated project with anat and func acquisitions for each session """
+    project = {
+        '_id': 'project0',
+        'label': 'Project',
+        'info': {'BIDS': {'Name': 'Project', 'BIDSVersion': '1.0.2'}},
+        'files': [],
+        'sessions': []
+    }
+    created = datetime.datetime(2018, 1, 17, 7, 0, 0)
+    for sub in range(subjects):
+        for ses in range(sessions):
+            sub_label = 'sub-{0:02d}'.format(sub)
+            ses_label = 'ses-{0:02d}'.format(ses)
+            path = '{0}/{1}'.format(sub_label, ses_label)
+            session_id = 'session{0}{1}'.format(sub, ses)
+            session = {
+                '_id': session_id,
+                'label': ses_label,
+                'subject': {'code': sub_label},
+                'info': {'BIDS': {'Subject': sub_label, 'Label': ses_label}},
+                'files': [],
+                'acquisitions': [{
+                    '_id': '{0}_anat'.format(session_id),
+                    'session': session_id,
+                    'label': 'T1w',
+                    'created': created,
+                    'info': {},
+                    'files': [make_file('t1.nii.gz', path + '/anat', '{0}_{1}_T1w.nii.gz'.format(sub_label, ses_label), 'anat',
+                        {'EchoTime': 0.003})]
+                }]
+            }
+            for run in range(runs):
+                name = '{0}_{1}_task-rest_run-{2}_bold.nii.gz'.format(sub_label, ses_label, run + 1)
+                session['acquisitions'].append({
+                    '_id': '{0}_func{1}'.format(session_id, run),
+                    'session': session_id,
+                    'label': 'rest',
+                    'created': created + datetime.timedelta(minutes=run + 1),
+                    'info': {},
+                    'files': [make_file('bold{0}.nii.gz'.format(run), path + '/func', name, 'func',
+                        {'RepetitionTime': 2.0, 'EchoTime': 0.03})]
+                })
+            project['sessions'].append(session)
+    return project
@@ -0,0 +1,66 @@
+import filecmp
+import os
+import shutil
+import unittest
+import zipfile
+
+from flywheel_bids import export_bids
+from flywheel_bids.supporting_files import archives, downloader
+
+import fake_flywheel
+
+class ArchivesTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = 'testdir'
+        os.makedirs(self.testdir)
+        self.zip_path = os.path.join(self.testdir, 'derivatives.zip')
+        with zipfile.ZipFile(self.zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+            zip_ref.writestr('code/', '')
+            for i in range(10):
+                zip_ref.writestr('sub-{0:02d}/anat/sub-{0:02d}_T1w.nii'.format(i), 'x' * (i + 1) * 1000)
+            zip_ref.writestr('README', 'readme')
+        self.min_parallel_size = archives.MIN_PARALLEL_SIZE
+        archives.MIN_PARALLEL_SIZE = 0
+
+    def tearDown(self):
+        archives.MIN_PARALLEL_SIZE = self.min_parallel_size
+        if os.path.exists(self.testdir):
+            shutil.rmtree(self.testdir)
+
+    def assertSameTree(self, dir1, dir2):
+        cmp = filecmp.dircmp(dir1, dir2)
+        self.assertEqual((cmp.left_only, cmp.right_only, cmp.diff_files), ([], [], []))
+        for sub in cmp.common_dirs:
+            self.assertSameTree(os.path.join(dir1, sub), os.path.join(dir2, sub))
+
+    def test_partition_members(self):
+        with zipfile.ZipFile(self.zip_path) as zip_ref:
+            members = [m for m in zip_ref.infolist() if not m.filename.endswith('/')]
+        groups = archives.partition_members(members, 3)
+        self.assertEqual(len(groups), 3)
+        self.assertEqual(sorted(m.filename for g in groups for m in g), sorted(m.filename for m in members))
+        sizes = [sum(m.file_size for m in g) for g in groups]
+        self.assertTrue(max(sizes) - min(sizes) <= 10000)
+
+    def test_extract_zip_matches_extractall(self):
+        expected = os.path.join(self.testdir, 'expected')
+        with zipfile.ZipFile(self.zip_path) as zip_ref:
+            zip_ref.extractall(expected)
+
+        actual = os.path.join(self.testdir, 'actual')
+        archives.extract_zip(self.zip_path, actual, max_workers=4)
+
+        self.assertSameTree(expected, actual)
+        self.assertTrue(os.path.isdir(os.path.join(actual, 'code')))
+
+    def test_finalize_download_extracts_project_zip(self):
+        job = downloader.DownloadJob('project', 'project0', 'derivatives.zip', self.zip_path, fake_flywheel.MODIFIED)
+        export_bids.finalize_download(job)
+
+        self.assertFalse(os.path.exists(self.zip_path))
+        self.assertEqual(job.extracted_dir, os.path.join(self.testdir, 'derivatives'))
+        self.assertTrue(os.path.isfile(os.path.join(self.testdir, 'derivatives', 'sub-09', 'anat', 'sub-09_T1w.nii')))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,6 +8,8 @@ from flywheel_bids import curate_bids
 from flywheel_bids.supporting_files import project_tree
 from flywheel_bids.supporting_files.templates import BIDS_TEMPLATE
 
+import fake_flywheel
+
 class BidsCurateTestCases(unittest.TestCase):
 
     def setUp(self):
@@ -249,6 +251,62 @@ class BidsCurateTestCases(unittest.TestCase):
         self.assertEqual(len(file1['info']['IntendedFor']), 1)
         self.assertEqual(file1['info']['IntendedFor'][0], 'ses-session1/func/sub-subj1_ses-session1_task-rest_run-1_bold.nii.gz')
 
+    def test_curate_sessions_parallel(self):
+        def make_tree():
+            project = project_tree.TreeNode('project', {'id': 'proj1', 'label': 'testProj'})
+            for ses in range(3):
+                session = project_tree.TreeNode('session', {'id': 'ses{0}'.format(ses), 'label': 'session{0}'.format(ses),
+                    'subject': {'code': 'subj{0}'.format(ses % 2)}})
+                project.children.append(session)
+                acquisitions = [('fmap_LR', 'fieldmap.nii.gz', 'Fieldmap')]
+                acquisitions += [('task-rest_run+', 'rest{0}.nii.gz'.format(run), 'Functional') for run in range(ses + 2)]
+                for i, (label, name, intent) in enumerate(acquisitions):
+                    acq = project_tree.TreeNode('acquisition', {'id': 'acq{0}{1}'.format(ses, i), 'label': label})
+                    acq.children.append(project_tree.TreeNode('file', {
+                        'name': name,
+                        'type': 'nifti',
+                        'classification': {'Intent': intent}
+                    }))
+                    session.children.append(acq)
+            return project
+
+        def infos(project):
+            return [node.get('info') for node in curate_bids.iter_nodes(project)]
+
+        serial = make_tree()
+        curate_bids.curate_bids_tree(None, serial, update=False)
+        parallel = make_tree()
+        curate_bids.curate_bids_tree(None, parallel, update=False, processes=2)
+
+        self.assertEqual(infos(parallel), infos(serial))
+        # Run numbers restart in every session
+        runs = [acq.children[0]['info']['BIDS']['Run'] for acq in parallel.children[2].children[1:]]
+        self.assertEqual(runs, ['1', '2', '3', '4'])
+        self.assertEqual(len(parallel.children[2].children[0].children[0]['info']['IntendedFor']), 4)
+
+    def test_get_project_tree_bulk_listing(self):
+        fw = fake_flywheel.FakeFlywheel(fake_flywheel.make_project(subjects=2, runs=2))
+
+        project = project_tree.get_project_tree(fw, 'project0')
+
+        self.assertEqual(fw.calls['get_project_acquisitions'], 1)
+        self.assertEqual(fw.calls['get_acquisition'], 0)
+        self.assertEqual(len(project.children), 2)
+        session = project.children[0]
+        self.assertEqual([acq['_id'] for acq in session.children],
+                ['session00_anat', 'session00_func0', 'session00_func1'])
+        self.assertEqual(session.children[1].children[0]['info']['RepetitionTime'], 2.0)
+
+    def test_get_project_tree_session_only(self):
+        fw = fake_flywheel.FakeFlywheel(fake_flywheel.make_project(subjects=2, runs=1), list_info=False)
+
+        project = project_tree.get_project_tree(fw, 'project0', session_id='session10', session_only=True)
+
+        self.assertEqual([x['_id'] for x in project.children], ['session10'])
+        self.assertEqual(fw.calls['get_project_acquisitions'], 0)
+        self.assertEqual(fw.calls['get_session'], 1)
+        self.assertEqual(fw.calls['get_acquisition'], 2)
+
 
 if __name__ == "__main__":
 
@@ -0,0 +1,84 @@
+import os
+import shutil
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from flywheel_bids import export_bids
+from flywheel_bids.supporting_files.dir_snapshot import DirectorySnapshot
+
+import fake_flywheel
+
+class DirectorySnapshotTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = 'testdir'
+        os.makedirs(os.path.join(self.testdir, 'sub-01', 'anat'))
+        os.makedirs(os.path.join(self.testdir, '.bids_export'))
+        self.path = os.path.join(self.testdir, 'sub-01', 'anat', 'sub-01_T1w.nii.gz')
+        with open(self.path, 'w') as fp:
+            fp.write('data')
+        os.utime(self.path, (1000, 1000))
+        with open(os.path.join(self.testdir, '.bids_export', 'manifest.json'), 'w') as fp:
+            fp.write('{}')
+
+    def tearDown(self):
+        if os.path.exists(self.testdir):
+            shutil.rmtree(self.testdir)
+
+    def test_snapshot(self):
+        snapshot = DirectorySnapshot(self.testdir)
+        self.assertTrue(snapshot.isfile(self.path))
+        self.assertEqual(snapshot.getsize(self.path), 4)
+        self.assertEqual(snapshot.getmtime(self.path), 1000)
+        self.assertTrue(snapshot.isdir(os.path.join(self.testdir, 'sub-01')))
+        self.assertFalse(snapshot.isfile(os.path.join(self.testdir, 'sub-01')))
+        # Hidden directories are not scanned
+        self.assertFalse(snapshot.isfile(os.path.join(self.testdir, '.bids_export', 'manifest.json')))
+        self.assertEqual(snapshot.scans, 3)
+        with self.assertRaises(OSError):
+            snapshot.getmtime(self.path + '.missing')
+
+    def test_snapshot_stats_lazily(self):
+        snapshot = DirectorySnapshot(self.testdir)
+        self.assertTrue(snapshot.isfile(self.path))
+        # The scan only reads names, files are stat'd when first asked about
+        os.utime(self.path, (2000, 2000))
+        self.assertEqual(snapshot.getmtime(self.path), 2000)
+        os.utime(self.path, (3000, 3000))
+        self.assertEqual(snapshot.getmtime(self.path), 2000)
+
+    def test_snapshot_missing_root(self):
+        snapshot = DirectorySnapshot(os.path.join(self.testdir, 'missing'))
+        self.assertFalse(snapshot.isfile(self.path))
+        snapshot.makedirs(os.path.join(self.testdir, 'missing', 'sub-01'))
+        self.assertTrue(os.path.isdir(os.path.join(self.testdir, 'missing', 'sub-01')))
+
+    def test_makedirs_once(self):
+        snapshot = DirectorySnapshot(self.testdir)
+        func_dir = os.path.join(self.testdir, 'sub-02', 'ses-01', 'func')
+        for _ in range(3):
+            snapshot.makedirs(func_dir)
+        snapshot.makedirs(os.path.join(self.testdir, 'sub-01', 'anat'))
+
+        self.assertTrue(os.path.isdir(func_dir))
+        self.assertEqual(snapshot.created, 3)
+
+    def test_export_without_stats(self):
+        os.remove(self.path)
+        fw = fake_flywheel.FakeFlywheel(fake_flywheel.make_project(subjects=2, runs=1))
+        export_bids.download_bids_dir(fw, 'project0', 'project', self.testdir)
+        os.remove(os.path.join(self.testdir, '.bids_export', 'manifest.json'))
+
+        # Without a manifest, existing files are checked against the snapshot, not stat'd
+        fw = fake_flywheel.FakeFlywheel(fake_flywheel.make_project(subjects=2, runs=1))
+        with mock.patch('os.path.getmtime', side_effect=AssertionError('stat')):
+            with mock.patch('os.makedirs', side_effect=AssertionError('makedirs')):
+                export_bids.download_bids_dir(fw, 'project0', 'project', self.testdir, replace=True)
+        self.assertEqual(fw.downloads, [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import datetime
+import os
+import shutil
+import time
+import unittest
+
+from flywheel_bids import export_bids
+from flywheel_bids.supporting_files import download_cache
+
+import fake_flywheel
+
+class DownloadCacheTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = 'testdir'
+        self.cachedir = os.path.join(self.testdir, 'cache')
+        self.outdir = os.path.join(self.testdir, 'out')
+        os.makedirs(self.outdir)
+
+    def tearDown(self):
+        if os.path.exists(self.testdir):
+            shutil.rmtree(self.testdir)
+
+    def download_fn(self, content, calls):
+        def download(path):
+            calls.append(path)
+            with open(path, 'w') as fp:
+                fp.write(content)
+        return download
+
+    def test_cache_key(self):
+        modified = datetime.datetime(2018, 3, 28)
+        by_id = download_cache.cache_key('file1', modified)
+        self.assertEqual(by_id, download_cache.cache_key('file1', modified))
+        self.assertNotEqual(by_id, download_cache.cache_key('file1', modified + datetime.timedelta(seconds=1)))
+        # The server hash takes precedence over the id
+        self.assertEqual(download_cache.cache_key('file1', modified, 'v0-sha384-abc'),
+                download_cache.cache_key('file2', None, 'v0-sha384-abc'))
+        self.assertIsNone(download_cache.cache_key('file1', None))
+
+    def test_fetch_hit(self):
+        cache = download_cache.DownloadCache(self.cachedir)
+        calls = []
+        dest1 = os.path.join(self.outdir, 'a.nii.gz')
+        dest2 = os.path.join(self.outdir, 'b.nii.gz')
+
+        self.assertFalse(cache.fetch('abcd', dest1, self.download_fn('data', calls)))
+        self.assertTrue(cache.fetch('abcd', dest2, self.download_fn('other', calls)))
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        with open(dest2) as fp:
+            self.assertEqual(fp.read(), 'data')
+        # Hardlinked, not copied
+        self.assertTrue(os.path.samefile(dest1, cache.path_for('abcd')))
+
+    def test_fetch_replaces_link(self):
+        cache = download_cache.DownloadCache(self.cachedir)
+        dest = os.path.join(self.outdir, 'a.nii.gz')
+        cache.fetch('abcd', dest, self.download_fn('data', []))
+        cache.fetch('efgh', dest, self.download_fn('new', []))
+
+        # Replacing the destination leaves the first cached file intact
+        with open(cache.path_for('abcd')) as fp:
+            self.assertEqual(fp.read(), 'data')
+        with open(dest) as fp:
+            self.assertEqual(fp.read(), 'new')
+
+    def test_evict_lru(self):
+        cache = download_cache.DownloadCache(self.cachedir, max_size=10)
+        dest = os.path.join(self.outdir, 'f')
+        cache.fetch('aaaa', dest, self.download_fn('12345', []))
+        cache.fetch('bbbb', dest, self.download_fn('12345', []))
+        # Use the first file, so the second one is the least recently used
+        stamp = time.time() + 10
+        os.utime(cache.path_for('aaaa') + download_cache.USED_SUFFIX, (stamp, stamp))
+        cache.fetch('cccc', dest, self.download_fn('12345', []))
+
+        self.assertTrue(os.path.isfile(cache.path_for('aaaa')))
+        self.assertFalse(os.path.isfile(cache.path_for('bbbb')))
+        self.assertTrue(os.path.isfile(cache.path_for('cccc')))
+        self.assertEqual(cache.size(), 10)
+
+    def test_get_cache(self):
+        env = os.environ.pop(download_cache.CACHE_DIR_ENV, None)
+        try:
+            self.assertIsNone(download_cache.get_cache())
+            os.environ[download_cache.CACHE_DIR_ENV] = self.cachedir
+            self.assertEqual(download_cache.get_cache().cache_dir, os.path.abspath(self.cachedir))
+        finally:
+            os.environ.pop(download_cache.CACHE_DIR_ENV, None)
+            if env is not None:
+                os.environ[download_cache.CACHE_DIR_ENV] = env
+
+        cache = download_cache.get_cache(self.cachedir, max_size=5)
+        self.assertEqual(cache.max_size, 5)
+        self.assertTrue(os.path.isdir(self.cachedir))
+
+    def test_export_from_cache(self):
+        cache = download_cache.DownloadCache(self.cachedir)
+        fw = fake_flywheel.FakeFlywheel(fake_flywheel.make_project(subjects=2, runs=1))
+        export_bids.download_bids_dir(fw, 'project0', 'project', self.outdir, cache=cache)
+        self.assertEqual(len(fw.downloads), 4)
+
+        # A second export into a fresh directory is served entirely from the cache
+        shutil.rmtree(self.outdir)
+        os.makedirs(self.outdir)
+        fw = fake_flywheel.FakeFlywheel(fake_flywheel.make_project(subjects=2, runs=1))
+        export_bids.download_bids_dir(fw, 'project0', 'project', self.outdir, cache=cache)
+
+        self.assertEqual(len(fw.downloads), 0)
+        self.assertEqual(cache.hits, 4)
+        path = os.path.join(self.outdir, 'sub-01/ses-00/anat/sub-01_ses-00_T1w.nii.gz')
+        with open(path) as fp:
+            self.assertEqual(fp.read(), 't1.nii.gz')
+        self.assertEqual(int(os.path.getmtime(path)), export_bids.timestamp_to_int(fake_flywheel.MODIFIED))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,15 +1,88 @@
 import csv
 import datetime
+import hashlib
 import json
 import os
 import shutil
+import threading
+import time
 import unittest
 import dateutil.parser
 
 import flywheel
 
 from flywheel_bids import export_bids
+from flywheel_bids.supporting_files import downloader
+from flywheel_bids.supporting_files.downloader import DownloadEngine, DownloadJob
 from flywheel_bids.supporting_files.errors import BIDSExportError
+from flywheel_bids.supporting_files.manifest import ExportManifest
+
+import fake_flywheel
+
+class FakeDownloadClient(object):
+    """Fake client that writes the file name into the destination file"""
+    def __init__(self, fail_first=()):
+        self.downloads = []
+        self.fail_first = set(fail_first)
+
+    def _download(self, container_type, container_id, file_name, dest_file):
+        if file_name in self.fail_first:
+            self.fail_first.remove(file_name)
+            raise IOError('Connection reset')
+        self.downloads.append((container_type, container_id, file_name))
+        with open(dest_file, 'w') as fp:
+            fp.write(file_name)
+
+    def download_file_from_project(self, *args):
+        self._download('project', *args)
+
+    def download_file_from_session(self, *args):
+        self._download('session', *args)
+
+    def download_file_from_acquisition(self, *args):
+        self._download('acquisition', *args)
+
+class FakeStreamedResponse(object):
+    """Fake streamed download response, answering range requests with 206"""
+    def __init__(self, content, offset=0, status_code=200):
+        self.status_code = status_code
+        if status_code == 206:
+            self.headers = {'content-range': 'bytes {0}-{1}/{2}'.format(offset, len(content) - 1, len(content))}
+            self.content = content[offset:]
+        else:
+            self.headers = {}
+            self.content = content
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+class FakeStreamingClient(FakeDownloadClient):
+    """Fake client that streams acquisition files, writing the file name as the content"""
+    def __init__(self, range_status=206, truncate_first=(), corrupt_first=()):
+        super(FakeStreamingClient, self).__init__()
+        self.range_status = range_status
+        self.truncate_first = set(truncate_first)
+        self.corrupt_first = set(corrupt_first)
+        self.ranges = []
+        self.acquisitions_api = self
+
+    def download_file_from_acquisition_with_http_info(self, container_id, file_name, **kwargs):
+        offset = int(kwargs['range'][len('bytes='):-1]) if 'range' in kwargs else 0
+        self.ranges.append((file_name, offset))
+        content = file_name.encode('utf-8')
+        if file_name in self.truncate_first:
+            self.truncate_first.remove(file_name)
+            content = content[:2]
+        if file_name in self.corrupt_first:
+            self.corrupt_first.remove(file_name)
+            content = content.upper()
+        if offset:
+            return FakeStreamedResponse(content, offset, status_code=self.range_status)
+        return FakeStreamedResponse(content)
 
 class BidsExportTestCases(unittest.TestCase):
 
@@ -257,6 +330,414 @@ class BidsExportTestCases(unittest.TestCase):
 
         os.remove('filePath')
 
+    def test_download_bids_files_concurrent(self):
+        os.mkdir(self.testdir)
+        modified = dateutil.parser.parse("2018-03-28T20:40:59.54Z")
+        filepath_downloads = {'project': {}, 'session': {}, 'acquisition': {}, 'sidecars': {}}
+        for container_type in ['project', 'session', 'acquisition']:
+            for i in range(5):
+                name = '{0}{1}.txt'.format(container_type, i)
+                path = os.path.join(self.testdir, name)
+                filepath_downloads[container_type][path] = {'args': ('cid', name, path), 'modified': modified}
+        fw = FakeDownloadClient(fail_first=['acquisition3.txt'])
+
+        export_bids.download_bids_files(fw, filepath_downloads, False, max_workers=4)
+
+        # Every file is downloaded exactly once, and the failed file was retried
+        self.assertEqual(len(fw.downloads), 15)
+        self.assertEqual(len(set(fw.downloads)), 15)
+        for container_type in ['project', 'session', 'acquisition']:
+            for path in filepath_downloads[container_type]:
+                self.assertEqual(int(os.path.getmtime(path)), export_bids.timestamp_to_int(modified))
+
+    def test_download_bids_dir_max_per_host(self):
+        os.mkdir(self.testdir)
+        fw = fake_flywheel.FakeFlywheel(fake_flywheel.make_project(subjects=4, runs=3))
+        lock = threading.Lock()
+        state = {'active': 0, 'peak': 0}
+
+        def stream_file(fw, job, path, offset=0, hasher=None):
+            with lock:
+                state['active'] += 1
+                state['peak'] = max(state['peak'], state['active'])
+            time.sleep(0.02)
+            with open(path, 'w') as fp:
+                fp.write(job.file_name)
+            with lock:
+                state['active'] -= 1
+            return True
+
+        original = downloader.stream_file
+        downloader.stream_file = stream_file
+        try:
+            export_bids.download_bids_dir(fw, 'project0', 'project', self.testdir, max_workers=8, max_per_host=2)
+        finally:
+            downloader.stream_file = original
+
+        # The workers outnumber the host limit, but never fetch more files at once
+        self.assertEqual(state['peak'], 2)
+        self.assertTrue(os.path.isfile(os.path.join(self.testdir, 'sub-03/ses-00/anat/sub-03_ses-00_T1w.nii.gz')))
+
+    def test_download_bids_dir_pipelined(self):
+        os.mkdir(self.testdir)
+        # Listings without file info, so each session's acquisitions are fetched as it is walked
+        fw = fake_flywheel.FakeFlywheel(fake_flywheel.make_project(subjects=2), list_info=False)
+        seen = []
+
+        def wait_for_download(acquisition_id):
+            # The second session is resolved only after the first session's files started downloading
+            if acquisition_id.startswith('session10_'):
+                deadline = time.time() + 5
+                while not fw.downloads and time.time() < deadline:
+                    time.sleep(0.01)
+                seen.append(len(fw.downloads))
+        fw.on_get_acquisition = wait_for_download
+
+        export_bids.download_bids_dir(fw, 'project0', 'project', self.testdir)
+
+        self.assertTrue(seen[0] > 0)
+        self.assertEqual(len(fw.downloads), 6)
+        path = os.path.join(self.testdir, 'sub-01/ses-00/func/sub-01_ses-00_task-rest_run-2_bold')
+        self.assertTrue(os.path.isfile(path + '.nii.gz'))
+        with open(path + '.json') as fp:
+            self.assertEqual(json.load(fp), {'EchoTime': 0.03, 'RepetitionTime': 2.0})
+        self.assertTrue(os.path.isfile(os.path.join(self.testdir, 'dataset_description.json')))
+
+    def test_download_bids_dir_duplicate_paths(self):
+        os.mkdir(self.testdir)
+        project = fake_flywheel.make_project(subjects=1, runs=2)
+        # Map both runs to the same BIDS path
+        acqs = project['sessions'][0]['acquisitions']
+        acqs[2]['files'][0]['info']['BIDS'] = dict(acqs[1]['files'][0]['info']['BIDS'])
+        fw = fake_flywheel.FakeFlywheel(project)
+
+        with self.assertRaises(BIDSExportError):
+            export_bids.download_bids_dir(fw, 'project0', 'project', self.testdir)
+        self.assertFalse(os.path.exists(os.path.join(self.testdir, 'dataset_description.json')))
+
+    def test_download_bids_dir_bulk_listing(self):
+        os.mkdir(self.testdir)
+        fw = fake_flywheel.FakeFlywheel(fake_flywheel.make_project(subjects=3, runs=2))
+
+        export_bids.download_bids_dir(fw, 'project0', 'project', self.testdir)
+
+        # Acquisitions are listed once for the whole project, never one at a time
+        self.assertEqual(fw.calls['get_project_acquisitions'], 1)
+        self.assertEqual(fw.calls['get_session_acquisitions'], 0)
+        self.assertEqual(fw.calls['get_acquisition'], 0)
+        self.assertEqual(fw.calls['get_session'], 0)
+        self.assertEqual(len(fw.downloads), 9)
+
+    def test_download_bids_dir_incomplete_listing(self):
+        os.mkdir(self.testdir)
+        fw = fake_flywheel.FakeFlywheel(fake_flywheel.make_project(subjects=2, runs=2), list_info=False)
+
+        export_bids.download_bids_dir(fw, 'project0', 'project', self.testdir)
+
+        # Listings without file info fall back to fetching each container once
+        self.assertEqual(fw.calls['get_session'], 2)
+        self.assertEqual(fw.calls['get_acquisition'], 6)
+        self.assertEqual(len(fw.downloads), 6)
+        path = os.path.join(self.testdir, 'sub-00/ses-00/anat/sub-00_ses-00_T1w.json')
+        with open(path) as fp:
+            self.assertEqual(json.load(fp), {'EchoTime': 0.003})
+
+    def test_download_bids_dir_incremental(self):
+        os.mkdir(self.testdir)
+        fw = fake_flywheel.FakeFlywheel(fake_flywheel.make_project(subjects=2, runs=2))
+        export_bids.download_bids_dir(fw, 'project0', 'project', self.testdir)
+        self.assertEqual(len(fw.downloads), 6)
+        self.assertTrue(os.path.isfile(os.path.join(self.testdir, '.bids_export', 'manifest.json')))
+
+        # Change one file and delete an acquisition upstream
+        project = fake_flywheel.make_project(subjects=2, runs=2)
+        acqs = project['sessions'][0]['acquisitions']
+        acqs[1]['files'][0]['modified'] = fake_flywheel.MODIFIED + datetime.timedelta(days=1)
+        removed = acqs.pop(2)['files'][0]['info']['BIDS']
+        removed_path = os.path.join(self.testdir, removed['Path'], removed['Filename'])
+        self.assertTrue(os.path.isfile(removed_path))
+
+        fw = fake_flywheel.FakeFlywheel(project)
+        export_bids.download_bids_dir(fw, 'project0', 'project', self.testdir, replace=True)
+
+        self.assertEqual(fw.downloads, [('acquisition', 'session00_func0', 'bold0.nii.gz')])
+        self.assertFalse(os.path.exists(removed_path))
+        self.assertFalse(os.path.exists(removed_path.replace('.nii.gz', '.json')))
+        with open(os.path.join(self.testdir, '.bids_export', 'manifest.json')) as fp:
+            entries = json.load(fp)['files']
+        self.assertEqual(len(entries), 5)
+        self.assertNotIn(os.path.relpath(removed_path, self.testdir), entries)
+
+    def test_download_bids_dir_filtered_keeps_files(self):
+        os.mkdir(self.testdir)
+        fw = fake_flywheel.FakeFlywheel(fake_flywheel.make_project(subjects=2, runs=1))
+        export_bids.download_bids_dir(fw, 'project0', 'project', self.testdir)
+
+        # A filtered export must not remove the files of the other subjects
+        fw = fake_flywheel.FakeFlywheel(fake_flywheel.make_project(subjects=2, runs=1))
+        export_bids.download_bids_dir(fw, 'project0', 'project', self.testdir, replace=True, subjects=['sub-00'])
+
+        self.assertEqual(fw.downloads, [])
+        self.assertTrue(os.path.isfile(os.path.join(self.testdir, 'sub-01/ses-00/anat/sub-01_ses-00_T1w.nii.gz')))
+
+    def test_download_bids_dir_excluded_keeps_files(self):
+        os.mkdir(self.testdir)
+        fw = fake_flywheel.FakeFlywheel(fake_flywheel.make_project(subjects=1, runs=2))
+        export_bids.download_bids_dir(fw, 'project0', 'project', self.testdir)
+
+        # Files that are ignored or filtered out since are still in Flywheel
+        project = fake_flywheel.make_project(subjects=1, runs=2)
+        acqs = project['sessions'][0]['acquisitions']
+        acqs[1]['files'][0]['info']['BIDS']['ignore'] = True
+        acqs[2]['info'] = {'BIDS': {'ignore': True}}
+        fw = fake_flywheel.FakeFlywheel(project)
+        export_bids.download_bids_dir(fw, 'project0', 'project', self.testdir, replace=True)
+
+        self.assertEqual(fw.downloads, [])
+        for acq in acqs:
+            bids = acq['files'][0]['info']['BIDS']
+            self.assertTrue(os.path.isfile(os.path.join(self.testdir, bids['Path'], bids['Filename'])))
+
+    def test_download_bids_dir_missing_file(self):
+        os.mkdir(self.testdir)
+        fw = fake_flywheel.FakeFlywheel(fake_flywheel.make_project(subjects=1, runs=2))
+        export_bids.download_bids_dir(fw, 'project0', 'project', self.testdir)
+
+        # Files recorded in the manifest that are gone or truncated on disk are downloaded again
+        os.remove(os.path.join(self.testdir, 'sub-00/ses-00/anat/sub-00_ses-00_T1w.nii.gz'))
+        open(os.path.join(self.testdir, 'sub-00/ses-00/func/sub-00_ses-00_task-rest_run-1_bold.nii.gz'), 'w').close()
+        fw = fake_flywheel.FakeFlywheel(fake_flywheel.make_project(subjects=1, runs=2))
+        export_bids.download_bids_dir(fw, 'project0', 'project', self.testdir)
+
+        self.assertEqual(sorted(fw.downloads), [('acquisition', 'session00_anat', 't1.nii.gz'),
+            ('acquisition', 'session00_func0', 'bold0.nii.gz')])
+
+    def _stream_job(self, name):
+        file_hash = 'v0-sha384-' + hashlib.sha384(name.encode('utf-8')).hexdigest()
+        return DownloadJob('acquisition', 'acq0', name, os.path.join(self.testdir, name),
+                modified=fake_flywheel.MODIFIED, file_id='file0', file_hash=file_hash, size=len(name))
+
+    def test_download_engine_verify(self):
+        os.mkdir(self.testdir)
+        job = self._stream_job('sub-01_T1w.nii.gz')
+        fw = FakeStreamingClient()
+
+        with DownloadEngine(fw, max_workers=1) as engine:
+            engine.submit(job)
+
+        # The file was streamed and hashed, never downloaded to disk by the SDK
+        self.assertEqual(fw.ranges, [('sub-01_T1w.nii.gz', 0)])
+        self.assertEqual(fw.downloads, [])
+        self.assertEqual(job.verified_hash, job.file_hash)
+        with open(job.path) as fp:
+            self.assertEqual(fp.read(), 'sub-01_T1w.nii.gz')
+
+    def test_download_engine_verify_unsupported(self):
+        os.mkdir(self.testdir)
+        job = self._stream_job('sub-01_T1w.nii.gz')
+        fw = FakeDownloadClient()
+
+        with DownloadEngine(fw, max_workers=1) as engine:
+            engine.submit(job)
+
+        # Without streaming only the size is checked
+        self.assertEqual(len(fw.downloads), 1)
+        self.assertIsNone(job.verified_hash)
+        self.assertTrue(os.path.isfile(job.path))
+
+    def test_download_engine_hash_mismatch(self):
+        os.mkdir(self.testdir)
+        job = self._stream_job('sub-01_T1w.nii.gz')
+        fw = FakeStreamingClient(corrupt_first=['sub-01_T1w.nii.gz'])
+        states = []
+
+        def on_complete(job):
+            with open(job.path) as fp:
+                states.append(fp.read())
+
+        with DownloadEngine(fw, max_workers=1, retry_delay=0, on_complete=on_complete) as engine:
+            engine.submit(job)
+
+        # The corrupt download never replaced the destination, and was retried
+        self.assertEqual(job.attempts, 2)
+        self.assertEqual(states, ['sub-01_T1w.nii.gz'])
+        self.assertEqual(job.verified_hash, job.file_hash)
+
+    def test_download_engine_resume(self):
+        os.mkdir(self.testdir)
+        job = self._stream_job('sub-01_T1w.nii.gz')
+        with open(job.part_path, 'w') as fp:
+            fp.write('sub-01_')
+        fw = FakeStreamingClient()
+
+        with DownloadEngine(fw, max_workers=1) as engine:
+            engine.submit(job)
+
+        # Only the missing bytes were requested, and the file was moved into place
+        self.assertEqual(fw.ranges, [('sub-01_T1w.nii.gz', 7)])
+        self.assertEqual(job.resumed_from, 7)
+        self.assertEqual(job.verified_hash, job.file_hash)
+        self.assertEqual(engine.bytes_downloaded, 10)
+        self.assertFalse(os.path.exists(job.part_path))
+        with open(job.path) as fp:
+            self.assertEqual(fp.read(), 'sub-01_T1w.nii.gz')
+
+    def test_download_engine_resume_unsupported(self):
+        os.mkdir(self.testdir)
+        job = self._stream_job('sub-01_T1w.nii.gz')
+        with open(job.part_path, 'w') as fp:
+            fp.write('sub-01_')
+        # The server ignores the range and sends the whole file
+        fw = FakeStreamingClient(range_status=200)
+
+        with DownloadEngine(fw, max_workers=1) as engine:
+            engine.submit(job)
+
+        self.assertEqual(fw.ranges, [('sub-01_T1w.nii.gz', 7), ('sub-01_T1w.nii.gz', 0)])
+        self.assertIsNone(job.resumed_from)
+        self.assertEqual(job.verified_hash, job.file_hash)
+        with open(job.path) as fp:
+            self.assertEqual(fp.read(), 'sub-01_T1w.nii.gz')
+
+    def test_download_engine_part_dir(self):
+        os.mkdir(self.testdir)
+        part_dir = os.path.join(self.testdir, '.bids_export', 'partial')
+        os.makedirs(part_dir)
+        # A part file of an older version of the file, which will never be resumed
+        old_job = self._stream_job('sub-01_T1w.nii.gz')
+        old_job.file_hash = 'v0-sha384-' + hashlib.sha384(b'old').hexdigest()
+        with open(os.path.join(part_dir, old_job.part_name), 'w') as fp:
+            fp.write('sub-01_')
+        job = self._stream_job('sub-01_T1w.nii.gz')
+        failed = self._stream_job('sub-02_T1w.nii.gz')
+        fw = FakeStreamingClient(corrupt_first=['sub-02_T1w.nii.gz'])
+
+        engine = DownloadEngine(fw, max_workers=1, retries=0, part_dir=part_dir)
+        engine.submit(job)
+        engine.submit(failed)
+        with self.assertRaises(BIDSExportError):
+            engine.close()
+
+        # Part files are kept out of the destination directory, and none are left behind
+        self.assertEqual(sorted(os.listdir(self.testdir)), ['.bids_export', 'sub-01_T1w.nii.gz'])
+        self.assertEqual(os.listdir(part_dir), [])
+
+    def test_download_engine_size_mismatch(self):
+        os.mkdir(self.testdir)
+        job = self._stream_job('sub-01_T1w.nii.gz')
+        fw = FakeStreamingClient(truncate_first=['sub-01_T1w.nii.gz'])
+        states = []
+
+        def on_complete(job):
+            states.append(os.path.isfile(job.path))
+
+        with DownloadEngine(fw, max_workers=1, retry_delay=0, on_complete=on_complete) as engine:
+            engine.submit(job)
+
+        # The short download never replaced the destination, and was retried in full
+        self.assertEqual(job.attempts, 2)
+        self.assertEqual(states, [True])
+        self.assertEqual(fw.ranges, [('sub-01_T1w.nii.gz', 0), ('sub-01_T1w.nii.gz', 0)])
+        with open(job.path) as fp:
+            self.assertEqual(fp.read(), 'sub-01_T1w.nii.gz')
+
+    def test_download_engine_complete_error(self):
+        os.mkdir(self.testdir)
+        job = self._stream_job('sub-01_T1w.nii.gz')
+        fw = FakeStreamingClient()
+
+        def on_complete(job):
+            raise IOError('Disk full')
+
+        engine = DownloadEngine(fw, max_workers=1, retry_delay=0, on_complete=on_complete)
+        engine.submit(job)
+        with self.assertRaises(BIDSExportError) as ctx:
+            engine.close()
+
+        # The file was downloaded once, and the error is not reported as a download failure
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(len(fw.ranges), 1)
+        self.assertEqual(engine.failures, [])
+        self.assertEqual([(failed, str(err)) for failed, err in engine.complete_failures], [(job, 'Disk full')])
+        self.assertIn('process 1 downloaded file', str(ctx.exception))
+
+    def test_download_bids_dir_interrupted(self):
+        os.mkdir(self.testdir)
+        project = fake_flywheel.make_project(subjects=1, runs=1)
+        fw = fake_flywheel.FakeFlywheel(project)
+        anat = project['sessions'][0]['acquisitions'][0]['files'][0]
+        path = os.path.join(self.testdir, anat['info']['BIDS']['Path'], anat['info']['BIDS']['Filename'])
+
+        # Crash when creating compacted sidecars, after the files were downloaded, without saving the manifest
+        write_json = export_bids.write_json
+        save = ExportManifest.save
+        def interrupt(*args):
+            raise IOError('No space left on device')
+        export_bids.write_json = interrupt
+        ExportManifest.save = lambda self: None
+        try:
+            with self.assertRaises(IOError):
+                export_bids.download_bids_dir(fw, 'project0', 'project', self.testdir, compact_sidecars=True)
+        finally:
+            export_bids.write_json = write_json
+            ExportManifest.save = save
+        self.assertFalse(os.path.exists(os.path.join(self.testdir, '.bids_export', 'manifest.json')))
+        with open(os.path.join(self.testdir, '.bids_export', 'journal.jsonl'), 'a') as fp:
+            fp.write('{"path": "sub-00/ses-00/func/')
+        self.assertTrue(os.path.isfile(path))
+        self.assertFalse(os.path.exists(path.replace('.nii.gz', '.json')))
+
+        fw = fake_flywheel.FakeFlywheel(fake_flywheel.make_project(subjects=1, runs=1))
+        export_bids.download_bids_dir(fw, 'project0', 'project', self.testdir, compact_sidecars=True)
+
+        # The journaled files are not downloaded again, but their sidecars are created
+        self.assertEqual(fw.downloads, [])
+        with open(path.replace('.nii.gz', '.json')) as fp:
+            self.assertEqual(json.load(fp), {'EchoTime': 0.003})
+        self.assertFalse(os.path.exists(os.path.join(self.testdir, '.bids_export', 'journal.jsonl')))
+
+    def test_parse_container(self):
+        self.assertEqual(export_bids.parse_container('session:123'), ('session', '123'))
+        self.assertEqual(export_bids.parse_container(' acquisition:456\n'), ('acquisition', '456'))
+        for spec in ('session', 'subject:123', 'session:'):
+            with self.assertRaises(BIDSExportError):
+                export_bids.parse_container(spec)
+
+    def test_read_containers_file(self):
+        os.mkdir(self.testdir)
+        path = os.path.join(self.testdir, 'containers.txt')
+        with open(path, 'w') as fp:
+            fp.write('# Batch\nsession:123\n\nproject:456\n')
+        self.assertEqual(export_bids.read_containers_file(path), [('session', '123'), ('project', '456')])
+
+    def test_download_bids_containers(self):
+        os.mkdir(self.testdir)
+        project = fake_flywheel.make_project(subjects=3, runs=1)
+        # Map both acquisitions of the second subject to the same BIDS path
+        acqs = project['sessions'][1]['acquisitions']
+        acqs[1]['files'][0]['info']['BIDS'] = dict(acqs[0]['files'][0]['info']['BIDS'])
+        fw = fake_flywheel.FakeFlywheel(project)
+        containers = [('session', 'session00'), ('session', 'session10'), ('session', 'session20'),
+                ('session', 'session00')]
+
+        with self.assertRaises(BIDSExportError) as ctx:
+            export_bids.download_bids_containers(fw, containers, self.testdir)
+
+        # The failed session doesn't stop the others, and each session is fetched once
+        self.assertIn('session:session10', str(ctx.exception))
+        self.assertEqual(fw.calls['get_session'], 3)
+        self.assertEqual(sorted(x[1] for x in fw.downloads),
+                ['session00_anat', 'session00_func0', 'session20_anat', 'session20_func0'])
+        self.assertTrue(os.path.isfile(os.path.join(self.testdir, 'sub-02/ses-00/anat/sub-02_ses-00_T1w.nii.gz')))
+        self.assertFalse(os.path.exists(os.path.join(self.testdir, 'sub-01/ses-00/anat/sub-01_ses-00_T1w.nii.gz')))
+
+    def test_export_bids_containers_with_project(self):
+        os.mkdir(self.testdir)
+        fw = fake_flywheel.FakeFlywheel(fake_flywheel.make_project(subjects=1, runs=1))
+        with self.assertRaises(BIDSExportError):
+            export_bids.export_bids(fw, self.testdir, 'Project', containers=[('session', 'session00')])
+        self.assertEqual(fw.downloads, [])
+
     def test_determine_single_container(self):
         ctype = 'session'
         cid = '123456789009876543211224'
@@ -0,0 +1,94 @@
+import json
+import os
+import shutil
+import unittest
+
+from flywheel_bids import export_bids
+from flywheel_bids.supporting_files import export_plan, manifest
+from flywheel_bids.supporting_files.errors import BIDSExportError
+
+import fake_flywheel
+
+class ExportPlanTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = 'testdir'
+        os.makedirs(self.testdir)
+
+    def tearDown(self):
+        if os.path.exists(self.testdir):
+            shutil.rmtree(self.testdir)
+
+    def make_plan(self, outdir):
+        fw = fake_flywheel.FakeFlywheel(fake_flywheel.make_project(subjects=2, runs=2))
+        return export_bids.plan_bids_dir(fw, 'project0', 'project', outdir)
+
+    def test_plan_bids_dir(self):
+        outdir = os.path.join(self.testdir, 'bids')
+        os.makedirs(outdir)
+        plan = self.make_plan(outdir)
+
+        # Planning doesn't write anything
+        self.assertEqual(os.listdir(outdir), [])
+        self.assertEqual(len(plan.entries), 6)
+        self.assertEqual(len(plan.sidecars), 7)
+        entry = plan.entries[0]
+        self.assertEqual(entry['path'], os.path.join('sub-00', 'ses-00', 'anat', 'sub-00_ses-00_T1w.nii.gz'))
+        self.assertEqual(entry['size'], len('t1.nii.gz'))
+
+        totals = plan.totals()
+        self.assertEqual(totals['total']['files'], 6)
+        self.assertEqual(totals['total']['bytes'], 2 * (len('t1.nii.gz') + 2 * len('bold0.nii.gz')))
+        self.assertEqual(totals['subjects']['sub-01']['files'], 3)
+        self.assertEqual(totals['folders']['func']['files'], 4)
+        self.assertFalse(plan.estimate()['measured'])
+
+    def test_save_load(self):
+        plan = self.make_plan(self.testdir)
+        path = os.path.join(self.testdir, 'plan.json')
+        plan.save(path)
+
+        with open(path) as fp:
+            data = json.load(fp)
+        self.assertEqual(data['totals']['total']['files'], 6)
+        self.assertIn('seconds', data['estimate'])
+
+        loaded = export_plan.ExportPlan.load(path)
+        self.assertEqual(loaded.entries, plan.entries)
+        self.assertEqual(loaded.options['container_id'], 'project0')
+
+    def test_load_invalid(self):
+        path = os.path.join(self.testdir, 'plan.json')
+        with open(path, 'w') as fp:
+            json.dump({'version': 0}, fp)
+        with self.assertRaises(BIDSExportError):
+            export_plan.ExportPlan.load(path)
+
+    def test_execute_plan(self):
+        # Plan against one directory, execute into another
+        plan = self.make_plan(os.path.join(self.testdir, 'planned'))
+        path = os.path.join(self.testdir, 'plan.json')
+        plan.save(path)
+
+        outdir = os.path.join(self.testdir, 'bids')
+        os.makedirs(outdir)
+        fw = fake_flywheel.FakeFlywheel(fake_flywheel.make_project(subjects=2, runs=2))
+        export_bids.execute_plan(fw, export_plan.ExportPlan.load(path), outdir)
+
+        # Only downloads, no hierarchy calls
+        self.assertEqual(len(fw.downloads), 6)
+        self.assertEqual(fw.calls['get_project'], 0)
+        path = os.path.join(outdir, 'sub-01/ses-00/func/sub-01_ses-00_task-rest_run-1_bold')
+        self.assertTrue(os.path.isfile(path + '.nii.gz'))
+        with open(path + '.json') as fp:
+            self.assertEqual(json.load(fp), {'EchoTime': 0.03, 'RepetitionTime': 2.0})
+        self.assertTrue(os.path.isfile(os.path.join(outdir, 'dataset_description.json')))
+
+        # The measured throughput feeds the next estimate
+        export_manifest = manifest.ExportManifest.load(outdir)
+        self.assertEqual(len(export_manifest.entries), 6)
+        self.assertEqual(export_manifest.stats['throughput']['bytes'], plan.totals()['total']['bytes'])
+        self.assertTrue(export_bids.plan_bids_dir(fw, 'project0', 'project', outdir, replace=True).estimate()['measured'])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+import datetime
+import json
+import os
+import shutil
+import unittest
+
+from flywheel_bids.supporting_files.downloader import DownloadJob
+from flywheel_bids.supporting_files.manifest import ExportManifest
+
+MODIFIED = datetime.datetime(2018, 3, 28, 20, 40, 59)
+
+class ExportManifestTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = 'testdir'
+        os.makedirs(os.path.join(self.testdir, 'sub-01', 'anat'))
+        self.path = os.path.join(self.testdir, 'sub-01', 'anat', 'sub-01_T1w.nii.gz')
+
+    def tearDown(self):
+        if os.path.exists(self.testdir):
+            shutil.rmtree(self.testdir)
+
+    def test_save_load(self):
+        manifest = ExportManifest(self.testdir)
+        manifest.record(self.path, file_id='file1', modified=MODIFIED, size=10, file_hash='v0-sha384-abc')
+        manifest.save()
+
+        loaded = ExportManifest.load(self.testdir)
+        self.assertIn(self.path, loaded)
+        self.assertEqual(loaded.get(self.path), {
+            'file_id': 'file1',
+            'modified': '2018-03-28T20:40:59',
+            'size': 10,
+            'hash': 'v0-sha384-abc'
+        })
+        # Nothing is kept until the next export sees the file
+        self.assertEqual(loaded.stale(), ['sub-01/anat/sub-01_T1w.nii.gz'])
+
+    def test_journal_replay(self):
+        manifest = ExportManifest(self.testdir)
+        manifest.open_journal()
+        manifest.record(self.path, file_id='file1', modified=MODIFIED, size=10)
+        # The export is interrupted before the manifest is saved
+
+        loaded = ExportManifest.load(self.testdir)
+        self.assertEqual(loaded.get(self.path)['file_id'], 'file1')
+
+        loaded.save()
+        self.assertFalse(os.path.exists(loaded.journal_path))
+        self.assertEqual(ExportManifest.load(self.testdir).get(self.path)['file_id'], 'file1')
+
+    def test_sidecar_pending(self):
+        manifest = ExportManifest(self.testdir)
+        manifest.record(self.path, file_id='file1', sidecar_pending=True)
+        self.assertTrue(manifest.is_sidecar_pending(self.path))
+
+        manifest.record_sidecar(self.path, self.path.replace('.nii.gz', '.json'))
+        self.assertFalse(manifest.is_sidecar_pending(self.path))
+        self.assertEqual(manifest.get(self.path)['sidecar'], 'sub-01/anat/sub-01_T1w.json')
+
+    def test_record_verified_hash(self):
+        manifest = ExportManifest(self.testdir)
+        job = DownloadJob('acquisition', 'acq1', 't1.nii.gz', self.path, MODIFIED, file_id='file1', size=10)
+        job.verified_hash = 'v0-sha384-abc'
+        manifest.record_job(job)
+
+        # Without a server hash, the hash computed during the download is recorded
+        self.assertEqual(manifest.get(self.path)['hash'], 'v0-sha384-abc')
+        self.assertTrue(manifest.get(self.path)['verified'])
+        self.assertTrue(manifest.is_current(self.path, {'id': 'file1', 'hash': 'v0-sha384-abc'}))
+
+    def test_load_invalid(self):
+        os.makedirs(os.path.join(self.testdir, '.bids_export'))
+        with open(os.path.join(self.testdir, '.bids_export', 'manifest.json'), 'w') as fp:
+            fp.write('{not json')
+        self.assertEqual(ExportManifest.load(self.testdir).entries, {})
+
+    def test_is_current(self):
+        manifest = ExportManifest(self.testdir)
+        manifest.record(self.path, file_id='file1', modified=MODIFIED)
+
+        self.assertTrue(manifest.is_current(self.path, {'id': 'file1', 'modified': MODIFIED}))
+        self.assertFalse(manifest.is_current(self.path, {'id': 'file1', 'modified': MODIFIED + datetime.timedelta(seconds=1)}))
+        self.assertFalse(manifest.is_current(self.path, {'id': 'file2', 'modified': MODIFIED}))
+        self.assertFalse(manifest.is_current(self.path + '.other', {'id': 'file1', 'modified': MODIFIED}))
+
+        # The hash decides when both sides have one
+        manifest.record(self.path, file_id='file1', modified=MODIFIED, file_hash='abc')
+        self.assertTrue(manifest.is_current(self.path, {'id': 'file1', 'modified': None, 'hash': 'abc'}))
+        self.assertFalse(manifest.is_current(self.path, {'id': 'file1', 'modified': MODIFIED, 'hash': 'def'}))
+
+    def test_prune(self):
+        sidecar = self.path.replace('.nii.gz', '.json')
+        for path in (self.path, sidecar):
+            with open(path, 'w') as fp:
+                fp.write('data')
+        manifest = ExportManifest(self.testdir)
+        manifest.record(self.path, file_id='file1', modified=MODIFIED)
+        manifest.record_sidecar(self.path, sidecar)
+        manifest.kept.clear()
+
+        self.assertEqual(manifest.prune(dry_run=True), ['sub-01/anat/sub-01_T1w.nii.gz'])
+        self.assertTrue(os.path.isfile(self.path))
+
+        manifest.prune()
+        self.assertEqual(manifest.entries, {})
+        # Empty directories are removed up to the BIDS directory
+        self.assertFalse(os.path.exists(os.path.join(self.testdir, 'sub-01')))
+        self.assertTrue(os.path.isdir(self.testdir))
+
+if __name__ == "__main__":
+    unittest.main()
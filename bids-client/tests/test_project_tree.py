@@ -0,0 +1,81 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from flywheel_bids import curate_bids
+from flywheel_bids.supporting_files import project_tree
+from flywheel_bids.supporting_files.errors import BIDSCurationError
+
+def make_project():
+    project = project_tree.TreeNode('project', {'id': 'proj1', 'label': 'testProj', 'info': {}, 'files': []})
+    for s in range(2):
+        session = project_tree.TreeNode('session', {'id': 'ses{0}'.format(s), 'label': 'session{0}'.format(s),
+            'subject': {'code': 'subj{0}'.format(s)}})
+        project.children.append(session)
+        for i, (label, intent) in enumerate([('T1w', 'Structural'), ('task-rest', 'Functional')]):
+            files = [{'name': '{0}.nii.gz'.format(label), 'type': 'nifti',
+                'classification': {'Intent': [intent], 'Measurement': ['T1']}, 'info': {'header': {'x': i}}}]
+            acq = project_tree.TreeNode('acquisition', {'id': 'acq{0}_{1}'.format(s, i), 'label': label, 'files': files})
+            project_tree.add_file_nodes(acq)
+            session.children.append(acq)
+    return project
+
+class ProjectTreeTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.testdir, 'project.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def test_from_json(self):
+        project = make_project()
+        loaded = project_tree.TreeNode.from_json(json.loads(json.dumps(project.to_json())))
+        self.assertEqual(loaded.to_json(), project.to_json())
+
+    def test_snapshot_round_trip(self):
+        project = make_project()
+        project_tree.save_snapshot(project, self.path)
+        loaded = project_tree.load_snapshot(self.path)
+
+        self.assertEqual(loaded.to_json(), project.to_json())
+        self.assertEqual([node.type for node in curate_bids.iter_nodes(loaded)],
+                ['project'] + ['session', 'acquisition', 'file', 'acquisition', 'file'] * 2)
+        self.assertFalse(any(node.is_dirty() for node in curate_bids.iter_nodes(loaded)))
+
+        # File entries are still shared with their parent's files
+        acq = loaded.children[0].children[0]
+        self.assertIs(acq['files'][0], acq.children[0].data)
+
+    def test_curate_snapshot(self):
+        project_tree.save_snapshot(make_project(), self.path)
+        output = os.path.join(self.testdir, 'curated.json')
+        curated = curate_bids.curate_snapshot(self.path, output_file=output)
+
+        expected = make_project()
+        curate_bids.curate_bids_tree(None, expected, update=False)
+        self.assertEqual(curated.to_json(), expected.to_json())
+        with open(output) as f:
+            self.assertEqual(json.load(f), json.loads(json.dumps(expected.to_json())))
+
+    def test_curate_snapshot_project_template(self):
+        project = make_project()
+        project['files'].append({'name': 'project-template.json'})
+        project_tree.save_snapshot(project, self.path)
+
+        # A project template that isn't cached can't be downloaded offline
+        with self.assertRaises(BIDSCurationError) as ctx:
+            curate_bids.curate_snapshot(self.path)
+        self.assertIn('--template-file', str(ctx.exception))
+
+    def test_invalid_snapshot(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'{"type": "project"}')
+        with self.assertRaises(ValueError):
+            project_tree.load_snapshot(self.path)
+
+if __name__ == "__main__":
+    unittest.main()
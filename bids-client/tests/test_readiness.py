@@ -0,0 +1,149 @@
+import json
+import os
+import shutil
+import unittest
+
+from flywheel_bids import export_bids
+from flywheel_bids.supporting_files.readiness import ReadinessTracker, path_group
+
+import fake_flywheel
+
+class ReadinessTrackerTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = 'testdir'
+        os.mkdir(self.testdir)
+        self.written = []
+        self.tracker = ReadinessTracker(self.testdir, write_sidecars=self.written.extend)
+        self.tracker.start()
+
+    def tearDown(self):
+        if os.path.exists(self.testdir):
+            shutil.rmtree(self.testdir)
+
+    def _path(self, *parts):
+        return os.path.join(self.testdir, *parts)
+
+    def test_path_group(self):
+        self.assertEqual(path_group(self.testdir, self._path('sub-01', 'ses-01', 'anat', 'sub-01_T1w.nii.gz')),
+                ('sub-01', 'anat'))
+        self.assertEqual(path_group(self.testdir, self._path('sub-01', 'sub-01_sessions.tsv')), ('sub-01', None))
+        self.assertEqual(path_group(self.testdir, self._path('dataset_description.json')), (None, None))
+        self.assertEqual(path_group(self.testdir, self._path('sourcedata', 'file.zip')), (None, None))
+
+    def test_anat_ready_first(self):
+        description = (None, self._path('dataset_description.json'), 'BIDS')
+        anat = self._path('sub-01', 'anat', 'sub-01_T1w.nii.gz')
+        func = self._path('sub-01', 'func', 'sub-01_task-rest_bold.nii.gz')
+        self.tracker.add_sidecar(description)
+        for path in (anat, func):
+            self.tracker.expect(path)
+            self.tracker.add_sidecar((None, path, 'BIDS'))
+
+        # Sidecars are written right away, except for the top level until it is sealed
+        self.assertEqual(self.written, [(None, anat, 'BIDS'), (None, func, 'BIDS')])
+
+        # Nothing is ready until the walk is past the subject
+        self.tracker.complete(anat)
+        self.assertEqual(self.tracker.ready, [])
+        self.tracker.seal('anat')
+        self.assertEqual(self.written[-1], description)
+        self.assertEqual(self.tracker.ready, [('sub-01', 'anat')])
+        self.assertTrue(os.path.isfile(self.tracker.marker_path('sub-01', 'anat')))
+        self.assertFalse(os.path.exists(self.tracker.marker_path('sub-01')))
+
+        self.tracker.complete(func)
+        self.assertEqual(self.tracker.ready, [('sub-01', 'anat')])
+        self.tracker.seal()
+        self.assertEqual(self.tracker.ready, [('sub-01', 'anat'), ('sub-01', None)])
+        self.assertTrue(os.path.isfile(self.tracker.marker_path('sub-01')))
+        self.tracker.finish()
+        self.assertEqual(len(self.written), 3)
+
+    def test_top_level_pending(self):
+        zip_path = self._path('sourcedata', 'file.zip')
+        anat = self._path('sub-01', 'anat', 'sub-01_T1w.nii.gz')
+        self.tracker.expect(zip_path)
+        self.tracker.register(anat)
+        self.tracker.seal()
+
+        # Subjects wait for the top-level files
+        self.assertEqual(self.tracker.ready, [])
+        self.tracker.complete(zip_path)
+        self.assertEqual(self.tracker.ready, [('sub-01', 'anat'), ('sub-01', None)])
+
+    def test_sidecar_error(self):
+        def fail(sidecars):
+            raise IOError('No space left on device')
+        tracker = ReadinessTracker(self.testdir, write_sidecars=fail)
+        tracker.add_sidecar((None, self._path('dataset_description.json'), 'BIDS'))
+
+        # Held sidecars are written by the walk when it seals their group
+        with self.assertRaises(IOError):
+            tracker.seal()
+        with self.assertRaises(IOError):
+            tracker.add_sidecar((None, self._path('sub-01', 'anat', 'sub-01_T1w.nii.gz'), 'BIDS'))
+        self.assertEqual(tracker.ready, [])
+
+    def test_deferred(self):
+        # Without a sidecar writer, nothing is signalled until the export finishes
+        tracker = ReadinessTracker(self.testdir)
+        anat = self._path('sub-01', 'anat', 'sub-01_T1w.nii.gz')
+        tracker.expect(anat)
+        tracker.seal()
+        tracker.complete(anat)
+        self.assertEqual(tracker.ready, [])
+        tracker.finish()
+        self.assertEqual(tracker.ready, [('sub-01', 'anat'), ('sub-01', None)])
+
+    def test_start_removes_markers(self):
+        with open(self.tracker.marker_path('sub-01'), 'w'):
+            pass
+        ReadinessTracker(self.testdir).start(clear=True)
+        self.assertEqual(os.listdir(self.tracker.ready_dir), [])
+
+    def test_register_removes_subject_markers(self):
+        for subject in ('sub-01', 'sub-02'):
+            with open(self.tracker.marker_path(subject), 'w'):
+                pass
+        tracker = ReadinessTracker(self.testdir)
+        tracker.start()
+        # Only the markers of the subjects the export maps are removed
+        tracker.register(self._path('sub-01', 'anat', 'sub-01_T1w.nii.gz'))
+        self.assertEqual(os.listdir(self.tracker.ready_dir), ['sub-02.ready'])
+
+    def test_batch_keeps_markers(self):
+        fw = fake_flywheel.FakeFlywheel(fake_flywheel.make_project(subjects=2, runs=1))
+        export_bids.download_bids_containers(fw, [('session', 'session00'), ('session', 'session10')], self.testdir)
+
+        # Exporting the second session does not clear the markers of the first
+        self.assertEqual(sorted(os.listdir(self.tracker.ready_dir)),
+                ['sub-00.ready', 'sub-00_anat.ready', 'sub-01.ready', 'sub-01_anat.ready'])
+
+    def test_export_signals_subjects(self):
+        fw = fake_flywheel.FakeFlywheel(fake_flywheel.make_project(subjects=2, runs=2))
+        states = []
+
+        def on_ready(subject, folder):
+            anat = self._path(subject, 'ses-00', 'anat', '{0}_ses-00_T1w.json'.format(subject))
+            func = self._path(subject, 'ses-00', 'func', '{0}_ses-00_task-rest_run-2_bold.nii.gz'.format(subject))
+            states.append((subject, folder, os.path.isfile(self._path('dataset_description.json')),
+                os.path.isfile(anat), os.path.isfile(func)))
+
+        export_bids.download_bids_dir(fw, 'project0', 'project', self.testdir, max_workers=1, on_ready=on_ready)
+
+        # Each subject's anat folder is ready before its func files arrive, with its sidecars in place
+        self.assertEqual(sorted(states, key=lambda x: (x[0], x[1] or "")), [
+            ('sub-00', None, True, True, True),
+            ('sub-00', 'anat', True, True, False),
+            ('sub-01', None, True, True, True),
+            ('sub-01', 'anat', True, True, False),
+        ])
+        self.assertEqual(fw.downloads[0][2], 't1.nii.gz')
+        self.assertEqual(sorted(os.listdir(os.path.join(self.testdir, '.bids_export', 'ready'))),
+                ['sub-00.ready', 'sub-00_anat.ready', 'sub-01.ready', 'sub-01_anat.ready'])
+        with open(self._path('sub-01', 'ses-00', 'func', 'sub-01_ses-00_task-rest_run-2_bold.json')) as fp:
+            self.assertEqual(json.load(fp), {'EchoTime': 0.03, 'RepetitionTime': 2.0})
+
+if __name__ == "__main__":
+    unittest.main()
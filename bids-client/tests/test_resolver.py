@@ -0,0 +1,79 @@
+import unittest
+
+from flywheel_bids import curate_bids
+from flywheel_bids.supporting_files import project_tree, resolver, utils
+
+def make_session():
+    project = project_tree.TreeNode('project', {'id': 'proj1', 'label': 'testProj'})
+    session = project_tree.TreeNode('session', {'id': 'ses1', 'label': 'session1', 'subject': {'code': 'subj1'}})
+    project.children.append(session)
+    acquisitions = [('T1w', 'Structural', 'T1')] + [('task-rest_run-{0}'.format(i), 'Functional', 'T2*')
+            for i in range(3)] + [('fmap_{0}'.format(i), 'Fieldmap', 'B0') for i in range(3)]
+    for i, (label, intent, measurement) in enumerate(acquisitions):
+        acq = project_tree.TreeNode('acquisition', {'id': 'acq{0}'.format(i), 'label': label})
+        acq.children.append(project_tree.TreeNode('file', {
+            'name': '{0}.nii.gz'.format(label),
+            'type': 'nifti',
+            'classification': {'Intent': [intent], 'Measurement': [measurement]}
+        }))
+        session.children.append(acq)
+    return project, session
+
+def scan_resolve(res, context):
+    """ Resolve by testing every context of the session, as resolvers did before indexing """
+    results = []
+    filters = []
+    for entry in utils.dict_lookup(context, res.filter_field, {}):
+        fields = {'container_type': res.container_type}
+        for k, v in entry.items():
+            fields['{}.info.{}.{}'.format(res.container_type, res.namespace, k)] = v
+        filters.append(resolver.Filter(fields))
+    for ctx in context[res.resolve_for].context_iter():
+        for filt in filters:
+            if filt.test(ctx):
+                results.append(utils.process_string_template(res.format, ctx))
+    return results
+
+class ResolverTestCases(unittest.TestCase):
+
+    def test_intended_for_matches_scan(self):
+        project, session = make_session()
+        curate_bids.curate_bids_tree(None, project, update=False)
+
+        res = resolver.Resolver('BIDS', {
+            'templates': ['fieldmap_file'],
+            'update': 'file.info.IntendedFor',
+            'filter': 'file.info.BIDS.IntendedFor',
+            'resolveFor': 'session',
+            'type': 'file',
+            'format': '{file.info.BIDS.Folder}/{file.info.BIDS.Filename}'
+        })
+        index = resolver.ResolutionIndex()
+        fieldmaps = []
+        for ctx in session.context_iter():
+            if ctx['container_type'] == 'file' and ctx['file']['info']['BIDS']['Folder'] == 'fmap':
+                fieldmaps.append(ctx['file'])
+                for filters in ([{'Folder': 'func'}], [{'Folder': ['anat', 'func']}, {'Folder': 'func'}], [{}]):
+                    ctx['file']['info']['BIDS']['IntendedFor'] = filters
+                    expected = scan_resolve(res, ctx)
+                    res.resolve(ctx, index)
+                    self.assertEqual(ctx['file']['info']['IntendedFor'], expected)
+                self.assertEqual(len(expected), 7)
+
+        self.assertEqual(len(fieldmaps), 3)
+        self.assertEqual(len(index._indexes), 1)
+        self.assertEqual(len(fieldmaps[0]['info']['IntendedFor']), 7)
+
+    def test_curation_intended_for(self):
+        project, session = make_session()
+        curate_bids.curate_bids_tree(None, project, update=False)
+        for ctx in session.context_iter():
+            if ctx['container_type'] == 'file' and 'IntendedFor' in ctx['file']['info']:
+                self.assertEqual(ctx['file']['info']['IntendedFor'], [
+                    'ses-session1/anat/sub-subj1_ses-session1_T1w.nii.gz',
+                    'ses-session1/func/sub-subj1_ses-session1_task-rest_run-0_bold.nii.gz',
+                    'ses-session1/func/sub-subj1_ses-session1_task-rest_run-1_bold.nii.gz',
+                    'ses-session1/func/sub-subj1_ses-session1_task-rest_run-2_bold.nii.gz'])
+
+if __name__ == "__main__":
+    unittest.main()
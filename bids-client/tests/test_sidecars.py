@@ -0,0 +1,138 @@
+import collections
+import json
+import os
+import shutil
+import unittest
+
+from flywheel_bids import export_bids
+from flywheel_bids.supporting_files import sidecars
+
+import fake_flywheel
+
+class SidecarsTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = 'testdir'
+
+    def tearDown(self):
+        if os.path.exists(self.testdir):
+            shutil.rmtree(self.testdir)
+
+    def test_parse_filename(self):
+        self.assertEqual(sidecars.parse_filename('sub-01/func/sub-01_task-rest_run-1_bold.nii.gz'),
+                ([('sub', '01'), ('task', 'rest'), ('run', '1')], 'bold'))
+        self.assertEqual(sidecars.parse_filename('sub-01_T1w.json'), ([('sub', '01')], 'T1w'))
+        self.assertIsNone(sidecars.parse_filename('sub-01_task-rest.json'))
+        self.assertIsNone(sidecars.parse_filename('sub-01_bad_bold.json'))
+
+    def test_inherited_name(self):
+        self.assertEqual(sidecars.inherited_name([('sub', '01'), ('ses', '1'), ('task', 'rest'), ('run', '1')], 'bold'),
+                'task-rest_bold.json')
+        self.assertEqual(sidecars.inherited_name([('sub', '01'), ('acq', 'mprage')], 'T1w'), 'acq-mprage_T1w.json')
+
+    def test_compact_sidecars(self):
+        contents = collections.OrderedDict([
+            ('out/sub-01/anat/sub-01_acq-a_T1w.json', {'EchoTime': 1, 'FlipAngle': 8, 'Slices': 176}),
+            ('out/sub-02/anat/sub-02_acq-a_T1w.json', {'EchoTime': 1, 'FlipAngle': 8, 'Slices': 160}),
+            ('out/sub-01/anat/sub-01_acq-b_T1w.json', {'EchoTime': 1, 'FlipAngle': 9}),
+            ('out/sub-01/func/sub-01_task-rest_bold.json', {'EchoTime': True}),
+            ('out/dataset_description.json', {'Name': 'Project'}),
+        ])
+        top_level, per_file = sidecars.compact_sidecars(contents, 'out')
+
+        # acq-a_T1w.json only applies to the acq-a files
+        self.assertEqual(top_level, {'out/acq-a_T1w.json': {'EchoTime': 1, 'FlipAngle': 8}})
+        self.assertEqual(per_file['out/sub-01/anat/sub-01_acq-a_T1w.json'], {'Slices': 176})
+        self.assertEqual(per_file['out/sub-01/anat/sub-01_acq-b_T1w.json'], {'EchoTime': 1, 'FlipAngle': 9})
+        # A single file is not worth an inherited sidecar
+        self.assertEqual(per_file['out/sub-01/func/sub-01_task-rest_bold.json'], {'EchoTime': True})
+        self.assertEqual(per_file['out/dataset_description.json'], {'Name': 'Project'})
+
+    def test_compact_sidecars_keeps_effective_metadata(self):
+        contents = collections.OrderedDict()
+        for sub in range(3):
+            for run in range(2):
+                path = 'out/sub-{0}/func/sub-{0}_task-a_run-{1}_bold.json'.format(sub, run)
+                contents[path] = {'RepetitionTime': 2, 'SliceTiming': [0, run], 'Sub': sub}
+        # T1w.json applies to every T1w file, so only keys shared by all of them are hoisted
+        contents['out/sub-1/anat/sub-1_T1w.json'] = {'EchoTime': 1, 'Sub': 1}
+        contents['out/sub-2/anat/sub-2_T1w.json'] = {'EchoTime': 1, 'Sub': 2}
+        contents['out/sub-2/anat/sub-2_acq-b_T1w.json'] = {'EchoTime': 2}
+        top_level, per_file = sidecars.compact_sidecars(contents, 'out')
+        self.assertNotIn('out/T1w.json', top_level)
+
+        for path, data in contents.items():
+            effective = {}
+            for top_path, inherited in top_level.items():
+                entities, suffix = sidecars.parse_filename(top_path)
+                if path.endswith('_' + suffix + '.json') and all('{0}-{1}'.format(*e) in path for e in entities):
+                    effective.update(inherited)
+            effective.update(per_file[path])
+            self.assertEqual(effective, data)
+
+    def test_compact_sidecars_outside_files(self):
+        contents = collections.OrderedDict()
+        for sub in range(2):
+            for task in ('a', 'b'):
+                path = os.path.join(self.testdir, 'sub-{0}/func/sub-{0}_task-{1}_bold.json'.format(sub, task))
+                contents[path] = {'RepetitionTime': 2}
+        # A data file exported earlier, without a sidecar in this export
+        func_dir = os.path.join(self.testdir, 'sub-2', 'func')
+        os.makedirs(func_dir)
+        open(os.path.join(func_dir, 'sub-2_task-a_bold.nii.gz'), 'w').close()
+        top_level, per_file = sidecars.compact_sidecars(contents, self.testdir)
+
+        # task-a_bold.json would apply to it too, so only task-b is hoisted
+        self.assertEqual(list(top_level), [os.path.join(self.testdir, 'task-b_bold.json')])
+        self.assertEqual(per_file[os.path.join(self.testdir, 'sub-0/func/sub-0_task-a_bold.json')], {'RepetitionTime': 2})
+
+    def test_iter_compacted(self):
+        contents = collections.OrderedDict()
+        for sub in range(3):
+            path = 'out/sub-{0}/func/sub-{0}_task-a_bold.json'.format(sub)
+            contents[path] = {'RepetitionTime': 2, 'Sub': sub}
+        top_level, per_file = sidecars.compact_sidecars(contents, 'out')
+
+        # Streaming the contents gives the same sidecars, top level first
+        results = list(sidecars.iter_compacted(list(contents), contents.items, 'out'))
+        self.assertEqual(results, list(top_level.items()) + list(per_file.items()))
+        self.assertEqual(results[0], ('out/task-a_bold.json', {'RepetitionTime': 2}))
+
+    def test_sidecar_spool(self):
+        spool = sidecars.SidecarSpool(max_bytes=100)
+        for i in range(3):
+            spool.append(['sidecar{0}.json'.format(i), {'Index': i}])
+        self.assertFalse(spool.spilled)
+
+        # Past the threshold, records are spilled to disk and read back in order
+        spool.append(['large.json', {'Data': 'x' * 100}])
+        spool.append(['last.json', {}])
+        self.assertTrue(spool.spilled)
+        self.assertEqual(len(spool), 5)
+        records = list(spool)
+        self.assertEqual([x[0] for x in records], ['sidecar0.json', 'sidecar1.json', 'sidecar2.json',
+            'large.json', 'last.json'])
+        self.assertEqual(records[1][1], {'Index': 1})
+        # Iterating again reads the records from the start
+        self.assertEqual(len(list(spool)), 5)
+
+        spool.close()
+        self.assertEqual(list(spool), [])
+
+    def test_export_compact_sidecars(self):
+        os.mkdir(self.testdir)
+        fw = fake_flywheel.FakeFlywheel(fake_flywheel.make_project(subjects=2, runs=2))
+        export_bids.download_bids_dir(fw, 'project0', 'project', self.testdir, compact_sidecars=True)
+
+        with open(os.path.join(self.testdir, 'task-rest_bold.json')) as fp:
+            self.assertEqual(json.load(fp), {'EchoTime': 0.03, 'RepetitionTime': 2.0})
+        with open(os.path.join(self.testdir, 'T1w.json')) as fp:
+            self.assertEqual(json.load(fp), {'EchoTime': 0.003})
+        # Fully inherited sidecars are not written
+        func_dir = os.path.join(self.testdir, 'sub-00', 'ses-00', 'func')
+        self.assertEqual(sorted(os.listdir(func_dir)),
+                ['sub-00_ses-00_task-rest_run-1_bold.nii.gz', 'sub-00_ses-00_task-rest_run-2_bold.nii.gz'])
+        self.assertTrue(os.path.isfile(os.path.join(self.testdir, 'dataset_description.json')))
+
+if __name__ == "__main__":
+    unittest.main()
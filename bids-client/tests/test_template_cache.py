@@ -0,0 +1,81 @@
+import json
+import os
+import shutil
+import unittest
+
+from flywheel_bids import curate_bids
+from flywheel_bids.supporting_files import project_tree
+from flywheel_bids.supporting_files.template_cache import TemplateCache
+
+TEMPLATE = {
+    'extends': 'bids-v1',
+    'description': 'Project template',
+    'exclude_rules': ['bids_events_file']
+}
+
+class TemplateClient(object):
+    def __init__(self):
+        self.downloads = 0
+
+    def download_file_from_project(self, project_id, file_name, dest_file):
+        self.downloads += 1
+        with open(dest_file, 'w') as fp:
+            json.dump(TEMPLATE, fp)
+
+class TemplateCacheTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = 'testdir'
+        self.fw = TemplateClient()
+        self.f = {'id': 'file1', 'name': 'project-template.json', 'modified': '2018-01-17T07:00:00'}
+
+    def tearDown(self):
+        if os.path.exists(self.testdir):
+            shutil.rmtree(self.testdir)
+
+    def load(self, cache, f=None):
+        return cache.load_project_template(self.fw, {'id': 'proj1'}, f or self.f)
+
+    def test_memory_and_disk(self):
+        cache = TemplateCache(self.testdir)
+        template, path = self.load(cache)
+        self.assertEqual(self.fw.downloads, 1)
+        self.assertTrue(path.startswith(self.testdir))
+        self.assertEqual(template.namespace, 'BIDS')
+
+        # Same process
+        self.assertIs(self.load(cache)[0], template)
+        # Another process
+        other, other_path = self.load(TemplateCache(self.testdir))
+        self.assertEqual(self.fw.downloads, 1)
+        self.assertEqual(other_path, path)
+        self.assertEqual([rule.template for rule in other.rules], [rule.template for rule in template.rules])
+        self.assertEqual(sorted(other.resolver_map), sorted(template.resolver_map))
+
+        # A new version of the file is downloaded again
+        self.load(cache, dict(self.f, modified='2018-01-18T07:00:00'))
+        self.assertEqual(self.fw.downloads, 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_unreadable_compiled_template(self):
+        cache = TemplateCache(self.testdir)
+        self.load(cache)
+        key = cache.key(self.f)
+        with open(os.path.join(self.testdir, key + '.pickle'), 'wb') as fp:
+            fp.write(b'garbage')
+
+        # The cached file is compiled again instead of downloaded
+        template, path = self.load(TemplateCache(self.testdir))
+        self.assertEqual(self.fw.downloads, 1)
+        self.assertEqual(template.namespace, 'BIDS')
+
+    def test_curate_bids_tree(self):
+        cache = TemplateCache(self.testdir)
+        for i in range(2):
+            project = project_tree.TreeNode('project', {'id': 'proj1', 'label': 'testProj', 'files': [self.f]})
+            curate_bids.curate_bids_tree(self.fw, project, update=False, template_cache=cache)
+        self.assertEqual(self.fw.downloads, 1)
+        self.assertEqual(cache.hits, 1)
+
+if __name__ == "__main__":
+    unittest.main()
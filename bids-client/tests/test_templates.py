@@ -4,7 +4,7 @@ import re
 import shutil
 import unittest
 
-from flywheel_bids.supporting_files import utils, templates
+from flywheel_bids.supporting_files import matching, utils, templates
 
 class RuleTestCases(unittest.TestCase):
 
@@ -178,3 +178,87 @@ class RuleTestCases(unittest.TestCase):
         context = {'x': 'Something'}
         self.assertTrue(rule.test(context))
 
+
+    def test_rule_where_or_and(self):
+        rule = templates.Rule({
+            'template': 'test',
+            'where': {
+                'container_type': 'file',
+                '$or': [
+                    {'file.type': 'nifti', 'file.classification.Intent': 'Structural'},
+                    {'file.type': 'bval'}
+                ],
+                '$and': {
+                    'file.name': {'$regex': r'\.(nii\.gz|bval)$'},
+                    'file.classification.Measurement': {'$not': {'$in': ['B0']}}
+                }
+            }
+        })
+        def context(ftype, name, intent, measurement='T1'):
+            return {'container_type': 'file', 'file': {'type': ftype, 'name': name,
+                'classification': {'Intent': [intent], 'Measurement': [measurement]}}}
+
+        self.assertTrue(rule.test(context('nifti', 'a.nii.gz', 'Structural')))
+        self.assertTrue(rule.test(context('bval', 'a.bval', 'Functional')))
+        self.assertFalse(rule.test(context('nifti', 'a.nii.gz', 'Functional')))
+        self.assertFalse(rule.test(context('bval', 'a.bvec', 'Functional')))
+        self.assertFalse(rule.test(context('nifti', 'a.nii.gz', 'Structural', 'B0')))
+
+    def test_where_clause_matches_interpreter_semantics(self):
+        # (match, value, expected), as the where-clause interpreter matched them
+        cases = [
+            ('a', 'a', True), ('a', ['b', 'a'], True), ('a', ['b'], False), (1, None, False),
+            ({'$in': ['a', 'b']}, 'xbx', True), ({'$in': ['a', 'b']}, ['c', 'b'], True),
+            ({'$in': ['a', 'b']}, ['xbx'], False), ({'$in': [1, 2]}, 2, True), ({'$in': [1, 2]}, None, False),
+            ({'$regex': '^T1'}, 'T1w', True), ({'$regex': '^T1'}, ['T2', 'T1w'], True),
+            ({'$regex': '^T1'}, None, False), ({'$not': {'$regex': '^T1'}}, None, True),
+            ({'$not': 'a'}, ['a'], False), ({'unknown': 1}, 1, False), ({'$not': {'unknown': 1}}, 1, True)
+        ]
+        for match, value, expected in cases:
+            self.assertEqual(templates.processValueMatch(value, match), expected, (match, value))
+            self.assertEqual(templates.test_where_clause({'a.0.b': match}, {'a': [{'b': value}]}), expected)
+
+    def test_rule_pickles(self):
+        import pickle
+        rule = pickle.loads(pickle.dumps(templates.Rule({
+            'template': 'test',
+            'where': {'x': {'$regex': '^a'}},
+            'initialize': {'Property': {'x': {'$regex': '^a(?P<value>.*)', '$format': [{'$upper': True}]}}}
+        }), pickle.HIGHEST_PROTOCOL))
+        self.assertTrue(rule.test({'x': 'abc'}))
+        info = {}
+        rule.initializeProperties(info, {'x': 'abc'})
+        self.assertEqual(info, {'Property': 'BC'})
+
+    def test_rule_index_candidates(self):
+        def first_match(rules, context):
+            return next((rule for rule in rules if rule.test(context)), None)
+
+        template = templates.DEFAULT_TEMPLATE
+        rules = template.rules + template.upload_rules + [
+            templates.Rule({'template': 'a', 'where': {'container_type': 'file', 'ext': '.tsv'}}),
+            templates.Rule({'template': 'b', 'where': {'file.type': ['nifti'], 'ext': {'$regex': 'gz$'}}})
+        ]
+        index = matching.RuleIndex(rules)
+        contexts = [{'container_type': 'project', 'parent_container_type': 'group'}]
+        for parent in ('project', 'session', 'acquisition'):
+            for ftype in ('nifti', 'NIfTI', 'my nifti', 'bval', 'tabular data', 'dicom', 'JSON', None):
+                for intent in ('Structural', 'Functional', 'Fieldmap'):
+                    contexts.append({'container_type': 'file', 'parent_container_type': parent,
+                        'ext': '.tsv' if ftype == 'tabular data' else '.nii.gz',
+                        'acquisition': {'label': 'fmap_AP'}, 'file': {'name': 'x_events.tsv', 'type': ftype,
+                        'classification': {'Intent': [intent], 'Measurement': ['T1', 'Diffusion']}}})
+        contexts.append({'container_type': ['file'], 'file': {'type': 'nifti'}, 'ext': ['.gz']})
+
+        matched = 0
+        for context in contexts:
+            candidates = index.candidates(context)
+            self.assertEqual([rule for rule in rules if rule in candidates], candidates)
+            expected = first_match(rules, context)
+            self.assertIs(first_match(candidates, context), expected)
+            matched += expected is not None
+        self.assertGreater(matched, len(contexts) // 2)
+
+        context = contexts[1]
+        self.assertIs(first_match(template.candidate_rules(context), context), first_match(template.rules, context))
+        self.assertLess(len(template.candidate_rules(context)), len(template.rules))
@@ -0,0 +1,105 @@
+import copy
+import pickle
+import unittest
+
+import six
+
+from flywheel_bids import curate_bids
+from flywheel_bids.supporting_files import project_tree
+from flywheel_bids.supporting_files.tracking import TrackedDict
+
+class TrackedDictTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.header = {'dicom': {'ImageType': ['ORIGINAL', 'PRIMARY'], 'EchoTime': 0.03}}
+        self.info = TrackedDict({'header': self.header, 'BIDS': {'Filename': 'a.nii.gz'}})
+
+    def test_nested_changes(self):
+        self.assertFalse(self.info.is_changed())
+
+        # Reads don't count as changes
+        self.assertEqual(self.info['header']['dicom'].get('ImageType')[0], 'ORIGINAL')
+        self.assertEqual(self.info.changed_keys(), [])
+
+        self.info['BIDS']['Filename'] = 'b.nii.gz'
+        self.info['header']['dicom']['ImageType'].append('M')
+        self.assertEqual(sorted(self.info.changed_keys()), ['BIDS', 'header'])
+        self.assertEqual(self.info.original(), {'header': self.header, 'BIDS': {'Filename': 'a.nii.gz'}})
+        self.assertEqual(self.header['dicom']['ImageType'], ['ORIGINAL', 'PRIMARY'])
+
+    @unittest.skipUnless(six.PY2, 'Python 2 dict iterators')
+    def test_py2_iterators(self):
+        for key, value in self.info.iteritems():
+            if key == 'BIDS':
+                value['Filename'] = 'b.nii.gz'
+        for value in self.info.itervalues():
+            if 'dicom' in value:
+                value['dicom']['EchoTime'] = 0.04
+        self.assertEqual(sorted(self.info.changed_keys()), ['BIDS', 'header'])
+
+        info = TrackedDict({'BIDS': {'Filename': 'a.nii.gz'}})
+        for key, value in info.viewitems():
+            value['Filename'] = 'b.nii.gz'
+        self.assertEqual(info.changed_keys(), ['BIDS'])
+        info = TrackedDict({'BIDS': {'Filename': 'a.nii.gz'}})
+        for value in info.viewvalues():
+            value['Filename'] = 'b.nii.gz'
+        self.assertEqual(info.changed_keys(), ['BIDS'])
+
+    def test_revert(self):
+        # Changing a value back leaves the dict unchanged, as comparing whole copies would
+        self.info['BIDS']['Filename'] = 'b.nii.gz'
+        self.info['BIDS'] = {'Filename': 'a.nii.gz'}
+        self.assertFalse(self.info.is_changed())
+
+        del self.info['header']
+        self.assertEqual(self.info.changed_keys(), ['header'])
+        self.info.setdefault('new', {})['x'] = 1
+        self.assertEqual(sorted(self.info.changed_keys()), ['header', 'new'])
+        self.assertNotIn('new', self.info.original())
+
+    def test_moved_values(self):
+        other = TrackedDict({'BIDS': {'template': 'anat_file'}})
+        bids = other['BIDS']
+        self.info['BIDS'] = bids
+
+        # The moved value now reports its changes to its new root
+        bids['Run'] = '1'
+        self.assertEqual(other.changed_keys(), [])
+        self.assertEqual(self.info.changed_keys(), ['BIDS'])
+
+    def test_copies_are_plain(self):
+        self.info['BIDS']['Filename'] = 'b.nii.gz'
+        for result in (copy.deepcopy(self.info), pickle.loads(pickle.dumps(self.info)), self.info.copy()):
+            self.assertIs(type(result), dict)
+            self.assertEqual(result, self.info)
+        self.assertIs(type(copy.deepcopy(self.info)['BIDS']), dict)
+        self.assertIs(type(pickle.loads(pickle.dumps(self.info))['header']['dicom']['ImageType']), list)
+
+    def test_tree_dirty(self):
+        def make_tree():
+            project = project_tree.TreeNode('project', {'id': 'proj1', 'label': 'testProj', 'info': {'BIDS': 'NA'}})
+            session = project_tree.TreeNode('session', {'id': 'ses1', 'label': 'session1', 'subject': {'code': 'subj1'},
+                'info': {'other': {'value': 1}}})
+            project.children.append(session)
+            for i, label in enumerate(['T1w', 'task-rest_run+', 'fmap_LR']):
+                acq = project_tree.TreeNode('acquisition', {'id': 'acq{0}'.format(i), 'label': label})
+                acq.children.append(project_tree.TreeNode('file', {
+                    'name': '{0}.nii.gz'.format(i),
+                    'type': 'nifti',
+                    'classification': {'Intent': ['Structural', 'Functional', 'Fieldmap'][i], 'Measurement': 'T1'},
+                    'info': {'header': copy.deepcopy(self.header)}
+                }))
+                session.children.append(acq)
+            return project
+
+        # Dirty nodes are the same as when comparing with a deep copy of the original info
+        project = make_tree()
+        originals = [copy.deepcopy(node.get('info')) for node in curate_bids.iter_nodes(project)]
+        curate_bids.curate_bids_tree(None, project, update=False)
+        expected = [node.get('info') != original for node, original in zip(curate_bids.iter_nodes(project), originals)]
+        self.assertEqual([node.is_dirty() for node in curate_bids.iter_nodes(project)], expected)
+        self.assertEqual(expected, [False, True, True, True, True, True, True, True])
+
+if __name__ == "__main__":
+    unittest.main()
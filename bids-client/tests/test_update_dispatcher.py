@@ -0,0 +1,124 @@
+import threading
+import unittest
+
+from flywheel_bids import curate_bids
+from flywheel_bids.supporting_files import project_tree
+from flywheel_bids.supporting_files.errors import BIDSCurationError
+from flywheel_bids.supporting_files.update_dispatcher import UpdateDispatcher, get_update
+
+class RecordingClient(object):
+    """
+    Records info updates, failing every update to the containers in fail_ids
+    """
+    def __init__(self, fail_ids=()):
+        self.fail_ids = set(fail_ids)
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if not name.startswith(('set_', 'replace_', 'modify_')):
+            raise AttributeError(name)
+
+        def update(container_id, *args):
+            with self._lock:
+                self.calls.append((name, container_id) + args[:-1])
+            if container_id in self.fail_ids:
+                raise IOError('Server error')
+        return update
+
+def file_context(parent_type, parent_id, name, info):
+    return {
+        'container_type': 'file',
+        'parent_container_type': parent_type,
+        parent_type: {'id': parent_id},
+        'file': {'name': name, 'info': info}
+    }
+
+class UpdateDispatcherTestCases(unittest.TestCase):
+
+    def test_get_update(self):
+        context = file_context('acquisition', 'acq1', 'a.nii.gz', {'BIDS': {}})
+        self.assertEqual(get_update(context), (('acquisition', 'acq1'), 'a.nii.gz', 'set_acquisition_file_info',
+            ('acq1', 'a.nii.gz', {'BIDS': {}})))
+        context = {'container_type': 'session', 'parent_container_type': 'project', 'session': {'id': 'ses1', 'info': {}}}
+        self.assertEqual(get_update(context), (('session', 'ses1'), None, 'replace_session_info', ('ses1', {})))
+        self.assertIsNone(get_update(file_context('subject', 'sub1', 'a.nii.gz', {})))
+
+    def test_coalesce(self):
+        fw = RecordingClient()
+        progress = []
+        dispatcher = UpdateDispatcher(fw, max_workers=2, on_progress=lambda done, total: progress.append(done))
+        dispatcher.add(file_context('acquisition', 'acq1', 'a.nii.gz', {'n': 1}))
+        dispatcher.add(file_context('acquisition', 'acq1', 'b.nii.gz', {}))
+        dispatcher.add(file_context('acquisition', 'acq1', 'a.nii.gz', {'n': 2}))
+        dispatcher.add(file_context('session', 'ses1', 'c.tsv', {}))
+        self.assertEqual(dispatcher.pending, 3)
+
+        self.assertEqual(dispatcher.run(), {})
+        self.assertEqual((dispatcher.submitted, dispatcher.coalesced, dispatcher.completed), (4, 1, 3))
+        self.assertEqual(sorted(progress), [1, 2, 3])
+        self.assertIsNotNone(dispatcher.throughput)
+
+        # Updates of one container are sent in order, each node once
+        acq_calls = [call for call in fw.calls if call[1] == 'acq1']
+        self.assertEqual(acq_calls, [('set_acquisition_file_info', 'acq1', 'b.nii.gz'),
+            ('set_acquisition_file_info', 'acq1', 'a.nii.gz')])
+
+    def test_failures_do_not_abort(self):
+        fw = RecordingClient(fail_ids=['acq1'])
+        dispatcher = UpdateDispatcher(fw, retries=1, retry_delay=0)
+        dispatcher.add(file_context('acquisition', 'acq1', 'a.nii.gz', {}))
+        dispatcher.add(file_context('acquisition', 'acq1', 'b.nii.gz', {}))
+        dispatcher.add(file_context('acquisition', 'acq2', 'a.nii.gz', {}))
+
+        failures = dispatcher.run()
+        self.assertEqual(list(failures), [('acquisition', 'acq1')])
+        self.assertEqual([target for target, err in failures[('acquisition', 'acq1')]], ['a.nii.gz', 'b.nii.gz'])
+        self.assertEqual((dispatcher.completed, dispatcher.failed), (1, 2))
+        # Each failed update was retried once
+        self.assertEqual(len(fw.calls), 5)
+
+    def test_curate_bids_tree_reports_failures(self):
+        project = project_tree.TreeNode('project', {'id': 'proj1', 'label': 'testProj'})
+        session = project_tree.TreeNode('session', {'id': 'ses1', 'label': 'session1', 'subject': {'code': 'subj1'}})
+        project.children.append(session)
+        for i in range(2):
+            acq = project_tree.TreeNode('acquisition', {'id': 'acq{0}'.format(i), 'label': 'T1w_{0}'.format(i)})
+            acq.children.append(project_tree.TreeNode('file', {
+                'name': 't1_{0}.nii.gz'.format(i),
+                'type': 'nifti',
+                'classification': {'Intent': 'Structural', 'Measurement': 'T1'}
+            }))
+            session.children.append(acq)
+
+        fw = RecordingClient(fail_ids=['acq0'])
+        with self.assertRaises(BIDSCurationError) as ctx:
+            curate_bids.curate_bids_tree(fw, project, max_workers=2)
+        self.assertEqual(list(ctx.exception.errors), ['acquisition/acq0'])
+
+        # The other containers were still updated
+        self.assertIn(('modify_acquisition_file_info', 'acq1', 't1_1.nii.gz'), fw.calls)
+
+    def test_changed_keys_only(self):
+        node = project_tree.TreeNode('file', {'name': 'a.nii.gz', 'info': {
+            'header': {'dicom': {'EchoTime': 0.03}}, 'BIDS': {'Filename': 'a.nii.gz'}, 'old': 1}})
+        node['info']['BIDS']['Filename'] = 'b.nii.gz'
+        del node['info']['old']
+        context = {'container_type': 'file', 'parent_container_type': 'acquisition',
+            'acquisition': {'id': 'acq1'}, 'file': node}
+
+        container, target, method, args = get_update(context)
+        self.assertEqual(method, 'modify_acquisition_file_info')
+        self.assertEqual(args, ('acq1', 'a.nii.gz', {'set': {'BIDS': {'Filename': 'b.nii.gz'}}, 'delete': ['old']}))
+
+        # A reset sends the whole info
+        container, target, method, args = get_update(context, replace=True)
+        self.assertEqual(method, 'set_acquisition_file_info')
+        self.assertEqual(args[2], node['info'])
+
+        node['info']['BIDS']['Filename'] = 'a.nii.gz'
+        node['info']['old'] = 1
+        self.assertIsNone(get_update(context))
+
+if __name__ == "__main__":
+    unittest.main()
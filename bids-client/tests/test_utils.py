@@ -4,7 +4,7 @@ import shutil
 import unittest
 
 import flywheel
-from flywheel_bids.supporting_files import utils
+from flywheel_bids.supporting_files import project_tree, utils
 
 class UtilsTestCases(unittest.TestCase):
 
@@ -77,6 +77,23 @@ class UtilsTestCases(unittest.TestCase):
         ext = utils.get_extension(fname)
         self.assertEqual('.nii.gz', ext)
 
+    def test_node_extension(self):
+        """ """
+        node = project_tree.TreeNode('file', {'name': 'T1w.nii'})
+        self.assertEqual(node.extension, '.nii')
+        node['name'] = 'T1w.nii.gz'
+        self.assertEqual([ctx['ext'] for ctx in node.context_iter()], ['.nii.gz'])
+
+    def test_dict_lookup_mappings(self):
+        """ """
+        node = project_tree.TreeNode('file', {'name': 'T1w.nii', 'info': {'BIDS': {'Run': '1'}}})
+        context = {'file': node, 'list': [node]}
+        self.assertEqual(utils.dict_lookup(context, 'file.info.BIDS.Run'), '1')
+        self.assertEqual(utils.dict_lookup(context, 'list.0.name'), 'T1w.nii')
+        self.assertIsNone(utils.dict_lookup(context, 'file.name.x'))
+        self.assertTrue(utils.is_mapping(node))
+        self.assertFalse(utils.is_mapping('T1w.nii'))
+
     @unittest.skip("Integration test")
     def test_validate_project_label_invalidproject(self):
         """ Get project that does not exist. Assert function returns None.
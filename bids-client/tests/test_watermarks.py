@@ -0,0 +1,152 @@
+import copy
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from flywheel_bids import curate_bids
+from flywheel_bids.supporting_files import project_tree
+from flywheel_bids.supporting_files.watermarks import WATERMARK_KEY, CurationWatermarks, node_signature
+
+class FakeServer(object):
+    """
+    Keeps the project data, applying the info updates curation sends
+    """
+    def __init__(self, project):
+        self.project = project
+        self.calls = []
+
+    def _find(self, container_id):
+        for node in curate_bids.iter_nodes(self.project):
+            if node.type != 'file' and node['id'] == container_id:
+                return node
+
+    def __getattr__(self, name):
+        if not name.startswith(('set_', 'replace_', 'modify_')):
+            raise AttributeError(name)
+
+        def update(container_id, *args):
+            self.calls.append((name, container_id))
+            node = self._find(container_id)
+            if name.endswith('_file_info'):
+                node = [child for child in node.children if child['name'] == args[0]][0]
+            body = copy.deepcopy(args[-1])
+            if name.startswith('replace_'):
+                node['info'] = body
+            elif name.startswith('set_'):
+                node.setdefault('info', {}).update(body)
+            else:
+                node.setdefault('info', {}).update(body.get('set', {}))
+                for key in body.get('delete', []):
+                    node['info'].pop(key, None)
+            node['modified'] = len(self.calls)
+        return update
+
+    def tree(self):
+        """ Get the project tree, as a new curation would fetch it """
+        def clone(node):
+            result = project_tree.TreeNode(node.type, copy.deepcopy(node.data))
+            result.children = [clone(child) for child in node.children]
+            return result
+        return clone(self.project)
+
+def make_session(ses, runs):
+    session = project_tree.TreeNode('session', {'id': 'ses{0}'.format(ses), 'label': 'session{0}'.format(ses),
+        'subject': {'code': 'subj{0}'.format(ses)}})
+    for run in range(runs):
+        add_acquisition(session, 'task-rest_run+', 'rest{0}.nii.gz'.format(run))
+    return session
+
+def add_acquisition(session, label, name):
+    acq = project_tree.TreeNode('acquisition', {'id': '{0}_acq{1}'.format(session['id'], len(session.children)),
+        'label': label})
+    acq.children.append(project_tree.TreeNode('file', {
+        'name': name,
+        'type': 'nifti',
+        'classification': {'Intent': 'Functional'}
+    }))
+    session.children.append(acq)
+
+class CurationWatermarksTestCases(unittest.TestCase):
+
+    def setUp(self):
+        project = project_tree.TreeNode('project', {'id': 'proj1', 'label': 'testProj'})
+        for ses in range(3):
+            project.children.append(make_session(ses, 2))
+        self.server = FakeServer(project)
+
+    def curate(self, **kwargs):
+        self.server.calls = []
+        curate_bids.curate_bids_tree(self.server, self.server.tree(), incremental=True, **kwargs)
+        return sorted(set(container_id for name, container_id in self.server.calls))
+
+    def test_signature_ignores_modified(self):
+        session = make_session(0, 1)
+        signature = node_signature(session)
+        session.children[0]['modified'] = 'now'
+        self.assertEqual(node_signature(session), signature)
+        session.children[0].children[0]['info'] = {'BIDS': 'NA'}
+        self.assertNotEqual(node_signature(session), signature)
+
+    def test_signature_keeps_info(self):
+        sessions = []
+        for notes, modified in (('x', 1), ('y', 1), ('x', 2)):
+            session = make_session(0, 1)
+            session['info'] = {'notes': notes, 'BIDS': {'modified': modified}}
+            sessions.append(session)
+        # Volatile key names are only ignored on the container itself, not in its info
+        signatures = [node_signature(session) for session in sessions]
+        self.assertEqual(len(set(signatures)), 3)
+
+    def test_info_change(self):
+        self.curate()
+        session = self.server.project.children[1]
+        session['info'] = dict(session.get('info') or {}, notes='reviewed')
+
+        # The changed session is curated again, the others are still current
+        with mock.patch('flywheel_bids.curate_bids.match_context', wraps=curate_bids.match_context) as match:
+            self.curate()
+        sessions = [args[0]['session']['id'] for args, kwargs in match.call_args_list
+                if args[0]['container_type'] == 'session']
+        self.assertEqual(sessions, ['ses1'])
+
+    def test_incremental(self):
+        self.assertEqual(self.curate(), ['proj1', 'ses0', 'ses0_acq0', 'ses0_acq1', 'ses1', 'ses1_acq0',
+            'ses1_acq1', 'ses2', 'ses2_acq0', 'ses2_acq1'])
+        self.assertEqual(sorted(self.server.project['info'][WATERMARK_KEY]['sessions']), ['ses0', 'ses1', 'ses2'])
+
+        # Nothing changed, only the watermarks are written
+        self.assertEqual(self.curate(), ['proj1'])
+
+        # Only the new acquisition is curated, with the same result as a full curation
+        add_acquisition(self.server.project.children[1], 'task-rest_run+', 'rest2.nii.gz')
+        full = self.server.tree()
+        curate_bids.curate_bids_tree(None, full, update=False)
+        self.assertEqual(self.curate(), ['proj1', 'ses1_acq2'])
+        self.assertEqual([node.get('info') for node in curate_bids.iter_nodes(self.server.project.children[1])],
+                [node.get('info') for node in curate_bids.iter_nodes(full.children[1])])
+
+        # Reset curates every session again
+        with mock.patch('flywheel_bids.curate_bids.match_context', wraps=curate_bids.match_context) as match:
+            self.curate(reset=True)
+        sessions = [args[0]['session']['id'] for args, kwargs in match.call_args_list
+                if args[0]['container_type'] == 'session']
+        self.assertEqual(sessions, ['ses0', 'ses1', 'ses2'])
+
+    def test_project_change(self):
+        self.curate()
+        self.assertEqual(len(CurationWatermarks.load(self.server.project, self.template()).sessions), 3)
+        self.server.project['label'] = 'renamed'
+        self.assertEqual(CurationWatermarks.load(self.server.project, self.template()).sessions, {})
+
+    def test_template_change(self):
+        self.curate()
+        self.assertEqual(CurationWatermarks.load(self.server.project, 'other').sessions, {})
+
+    def template(self):
+        return self.server.project['info'][WATERMARK_KEY]['template']
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,15 +6,33 @@ import shutil
 
 import flywheel
 from flywheel_bids import export_bids
+from flywheel_bids.supporting_files import download_cache
+from flywheel_bids.supporting_files.hierarchy import HierarchyFetcher
 
 from create_archive_funcs import (get_flywheel_hierarchy, determine_fmap_intendedfor,
                                   create_bids_hierarchy)
 
 
-def create_and_download_bids(fw, rootdir, flywheel_basedir, analysis_id):
+def download_acquisition_file(fw, fetcher, cache, acq_id, filename, dest_file):
+    """
+    Download an acquisition file, through the download cache if there is one
+    """
+    if cache is not None:
+        # The acquisition was already fetched while building the flywheel hierarchy
+        for f in fetcher.get_acquisition(acq_id).get('files', []):
+            if f.get('name') != filename:
+                continue
+            key = download_cache.cache_key(f.get('file_id') or f.get('id'), f.get('modified'), f.get('hash'))
+            if key:
+                cache.fetch(key, dest_file, lambda path: fw.download_file_from_acquisition(acq_id, filename, path))
+                return
+    fw.download_file_from_acquisition(acq_id, filename, dest_file)
+
+def create_and_download_bids(fw, rootdir, flywheel_basedir, analysis_id, cache=None):
     ## Create flywheel hierarchy
     print("Create Flywheel Hierarchy")
-    flywheel_hierarchy = get_flywheel_hierarchy(fw, analysis_id)
+    fetcher = HierarchyFetcher(fw)
+    flywheel_hierarchy = get_flywheel_hierarchy(fw, analysis_id, fetcher=fetcher)
     #pprint.pprint(flywheel_hierarchy)
 
     # Determine what fieldmaps and functionals are connected...
@@ -51,7 +69,7 @@ def create_and_download_bids(fw, rootdir, flywheel_basedir, analysis_id):
             # Get flywheel info in order to download file
             project_id, session_id, acq_id, filename = flywheel_file.split('/')
             # Download file
-            fw.download_file_from_acquisition(acq_id, filename, os.path.join(rootdir, bids_file))
+            download_acquisition_file(fw, fetcher, cache, acq_id, filename, os.path.join(rootdir, bids_file))
 
     download_optional_inputs(flywheel_basedir, sub_dir, ses_dir)
 
@@ -113,6 +131,8 @@ if __name__ == '__main__':
     ## Create SDK client
     print("Create SDK client")
     fw = flywheel.Flywheel(api_key)
+    # Reuse files downloaded by earlier runs, if a cache directory is configured
+    cache = download_cache.get_cache()
 
     # Get analysis
     analysis = fw.get_analysis(analysis_id)
@@ -132,7 +152,8 @@ if __name__ == '__main__':
     BIDS_metadata = container.get('info', {}).get('BIDS')
     if BIDS_metadata:
         try:
-            export_bids.export_bids(fw, rootdir, None, container_type=container_type, container_id=container_id)
+            export_bids.export_bids(fw, rootdir, None, container_type=container_type, container_id=container_id,
+                    cache_dir=cache.cache_dir if cache else None)
             if BIDS_metadata != 'NA':
                 if container_type == 'session':
                     download_optional_inputs(flywheel_basedir, "sub-{}".format(BIDS_metadata.get('Subject')), "ses-{}".format(BIDS_metadata.get('label')))
@@ -144,6 +165,6 @@ if __name__ == '__main__':
             # Clean rootdir
             shutil.rmtree(rootdir)
             os.makedirs(rootdir)
-            create_and_download_bids(fw, rootdir, flywheel_basedir, analysis_id)
+            create_and_download_bids(fw, rootdir, flywheel_basedir, analysis_id, cache=cache)
     else:
-        create_and_download_bids(fw, rootdir, flywheel_basedir, analysis_id)
+        create_and_download_bids(fw, rootdir, flywheel_basedir, analysis_id, cache=cache)
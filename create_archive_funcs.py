@@ -9,6 +9,8 @@ from datetime import datetime
 
 from pprint import pprint
 
+from flywheel_bids.supporting_files.hierarchy import HierarchyFetcher
+
 #### Define functions
 def merge_classification(dst, src):
     if src is None:
@@ -37,11 +39,12 @@ def get_anatomy_measurement(classification):
 
     return None
 
-def get_flywheel_hierarchy(fw, analysis_id):
+def get_flywheel_hierarchy(fw, analysis_id, fetcher=None):
     """
         Takes fw client, a container id and container_type as input
 
         analysis_id: the ID of the analysis
+        fetcher: optional HierarchyFetcher, acquisitions are fetched in bulk through it
 
         Returns the flywheel tree
 
@@ -87,14 +90,19 @@ def get_flywheel_hierarchy(fw, analysis_id):
     container_type = analysis.parent.type
     container_id = analysis.parent.id
 
+    if fetcher is None:
+        fetcher = HierarchyFetcher(fw)
+
     # Determine if ID is a project or a session ID
     if container_type == 'project':
         # Get list of sessions within project
-        project_sessions = fw.get_project_sessions(container_id)
+        project_sessions = fetcher.get_project_sessions(container_id, complete=False)
         project_id = container_id
+        # Get all acquisitions within the project in one go
+        fetcher.prefetch_project_acquisitions(project_id)
     elif container_type == 'session':
         # If container type is a session, get the specific session
-        session = fw.get_session(container_id)
+        session = fetcher.get_session(container_id)
         # Place the single session within a list to iterate over (mirrors project_sessions above)
         project_sessions = [session]
         project_id = session.get('project')
@@ -117,14 +125,12 @@ def get_flywheel_hierarchy(fw, analysis_id):
                                                      'subject_code': p_ses['subject']['code'],
                                                      'acquisitions': {}
                                                      }
-        # Get all acquisitions within session
-        session_acqs = fw.get_session_acquisitions(session_id)
+        # Get all acquisitions within session, with the meta information of their files
+        session_acqs = fetcher.get_session_acquisitions(session_id)
         # Iterate over all acquisitions within session
-        for s_acq in session_acqs:
+        for acq in session_acqs:
             # Get acquistiion ID and place in dictionary
-            acq_id = s_acq.get('_id')
-            # Get true acquisition in order to get meta information
-            acq = fw.get_acquisition(acq_id)
+            acq_id = acq.get('_id')
             # Initiate acquisition information
             flywheel_hierarchy[project_id][session_id]['acquisitions'][acq_id] = {
                     'label': acq.get('label'),